@@ -0,0 +1,202 @@
+"""
+throughput and latency benchmarks for the launcher and the listeners, against the in-process FakeSqsClient
+
+usage: python benchmarks/throughput.py [--messages N] [--latency SECONDS] [--only NAME ...] [--json FILE]
+                                       [--compare FILE] [--tolerance FRACTION]
+
+Every scenario reports messages per second and the p50 / p99 latency in milliseconds.  For listener scenarios the
+latency is end-to-end, from sending a message to its handler running; for launcher scenarios it is the time until a
+message is accepted by the (fake) queue.  `--latency` adds a delay to every sqs call, to emulate network round trips.
+Save a run with `--json`, and fail a later run (exit status 1) if a scenario got slower than the saved one by more
+than `--tolerance` with `--compare`.
+"""
+
+# ================
+# start imports
+# ================
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+# benchmark the checkout, not an installed copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqs_launcher import SqsLauncher
+from sqs_listener import SqsListener
+from sqs_listener.async_listener import AsyncSqsListener
+from sqs_listener.metrics import InMemoryMetrics
+from sqs_listener.polling import PollingStrategy
+from sqs_listener.testing import FakeSqsClient
+
+# ================
+# start class
+# ================
+
+QUEUE = 'benchmark-queue'
+LATENCY = 'latency'
+
+
+class BenchmarkDone(Exception):
+    pass
+
+
+class UntilHandled(PollingStrategy):
+    """
+    receives full batches without pausing, and stops the listener once every message was handled
+    """
+
+    def __init__(self, results, expected):
+        self._results = results
+        self._expected = expected
+
+    def receive_options(self):
+        return 0, 10
+
+    def on_empty(self):
+        if len(self._results.timings[LATENCY]) >= self._expected:
+            raise BenchmarkDone
+        return 0.0005
+
+
+class BenchmarkListener(SqsListener):
+
+    def __init__(self, queue, results, **kwargs):
+        self._results = results
+        SqsListener.__init__(self, queue, **kwargs)
+
+    def handle_message(self, body, attributes, messages_attributes):
+        self._results.timing(LATENCY, time.time() - body['sent'])
+
+
+class BenchmarkAsyncListener(AsyncSqsListener):
+
+    def __init__(self, queue, results, expected, **kwargs):
+        self._results = results
+        self._expected = expected
+        AsyncSqsListener.__init__(self, queue, **kwargs)
+
+    async def handle_message(self, body, attributes, messages_attributes):
+        self._results.timing(LATENCY, time.time() - body['sent'])
+        if len(self._results.timings[LATENCY]) >= self._expected:
+            self.stop()
+
+
+def fill_queue(client, count):
+    launcher = SqsLauncher(QUEUE, create_queue=True, client=client)
+    launcher.launch_messages({'i': i, 'sent': time.time()} for i in range(count))
+
+
+def run_listener(client, count, **kwargs):
+    results = InMemoryMetrics()
+    fill_queue(client, count)
+    listener = BenchmarkListener(QUEUE, results, client=client, polling=UntilHandled(results, count), **kwargs)
+    try:
+        listener.listen()
+    except BenchmarkDone:
+        pass
+    return results
+
+
+def run_async_listener(client, count, **kwargs):
+    results = InMemoryMetrics()
+    fill_queue(client, count)
+    listener = BenchmarkAsyncListener(QUEUE, results, count, client=client, **kwargs)
+    asyncio.run(listener.listen())
+    return results
+
+
+def run_launcher(client, count, mode):
+    results = InMemoryMetrics()
+    launcher = SqsLauncher(QUEUE, create_queue=True, client=client, buffered=(mode == 'buffered'))
+    if mode == 'single':
+        for i in range(count):
+            started = time.time()
+            launcher.launch_message({'i': i})
+            results.timing(LATENCY, time.time() - started)
+    elif mode == 'batch':
+        for start in range(0, count, 100):
+            started = time.time()
+            launcher.launch_messages({'i': i} for i in range(start, min(count, start + 100)))
+            for _ in range(start, min(count, start + 100)):
+                results.timing(LATENCY, time.time() - started)
+    else:
+        for i in range(count):
+            started = time.time()
+            future = launcher.launch_message({'i': i})
+            future.add_done_callback(lambda f, started=started: results.timing(LATENCY, time.time() - started))
+        launcher.close()
+    return results
+
+
+SCENARIOS = [
+    ('launcher-single', lambda client, count: run_launcher(client, count, 'single')),
+    ('launcher-batch', lambda client, count: run_launcher(client, count, 'batch')),
+    ('launcher-buffered', lambda client, count: run_launcher(client, count, 'buffered')),
+    ('listener-serial', lambda client, count: run_listener(client, count)),
+    ('listener-batch-delete', lambda client, count: run_listener(client, count, batch_delete=True)),
+    ('listener-workers', lambda client, count: run_listener(client, count, batch_delete=True, workers=8)),
+    ('listener-prefetch', lambda client, count: run_listener(client, count, batch_delete=True, workers=8, prefetch=40)),
+    ('async-listener', lambda client, count: run_async_listener(client, count, poll_concurrency=4, handler_concurrency=50)),
+]
+
+
+def run(names, count, latency):
+    report = {}
+    for name, scenario in SCENARIOS:
+        if names and name not in names:
+            continue
+        client = FakeSqsClient(latency=latency)
+        started = time.time()
+        results = scenario(client, count)
+        elapsed = time.time() - started
+        report[name] = {
+            'messages': count,
+            'seconds': elapsed,
+            'messages_per_second': count / elapsed,
+            'p50_ms': results.percentile(LATENCY, 50) * 1000,
+            'p99_ms': results.percentile(LATENCY, 99) * 1000,
+        }
+        print('{:<24} {:>8} msgs {:>9.0f} msgs/s   p50 {:>8.2f} ms   p99 {:>8.2f} ms'.format(
+            name, count, report[name]['messages_per_second'], report[name]['p50_ms'], report[name]['p99_ms']))
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """
+    :return: (list) names of the scenarios whose throughput dropped by more than `tolerance` compared to `baseline`
+    """
+    slower = []
+    for name, result in report.items():
+        if name in baseline and result['messages_per_second'] < baseline[name]['messages_per_second'] * (1 - tolerance):
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQS listener and launcher benchmarks')
+    parser.add_argument('--messages', type=int, default=5000, help='number of messages per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every sqs call')
+    parser.add_argument('--only', nargs='*', default=[], help='scenarios to run: ' + ', '.join(s[0] for s in SCENARIOS))
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='results file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput drop, as a fraction')
+    args = parser.parse_args()
+
+    report = run(args.only, args.messages, args.latency)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        if slower:
+            print('Throughput regression in: ' + ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,11 @@ import os
 import boto3
 import boto3.session
 
+from sqs_listener import registry, serialization
+from sqs_launcher.buffer import MessageBuffer
+from sqs_listener.batching import MAX_BATCH_BYTES, entry_size, pack_entries, send_message_batch
+from sqs_listener.claimcheck import DEFAULT_OFFLOAD_THRESHOLD, offload_entry
+
 # ================
 # start class
 # ================
@@ -27,7 +32,10 @@ sqs_logger = logging.getLogger('sqs_listener')
 
 class SqsLauncher(object):
 
-    def __init__(self, queue=None, queue_url=None, create_queue=False, visibility_timeout='600', serializer=json.dumps):
+    def __init__(self, queue=None, queue_url=None, create_queue=False, visibility_timeout='600', serializer=json.dumps,
+                 client=None, shared_client=True, lazy=False, buffered=False, linger=0.005, buffer_size=10000,
+                 overflow='block', content_type=None, compression=None, compress_threshold=0, blob_store=None,
+                 offload_threshold=DEFAULT_OFFLOAD_THRESHOLD):
         """
         :param queue: (str) name of queue to listen to
         :param queue_url: (str) url of queue to listen to
@@ -37,46 +45,77 @@ class SqsLauncher(object):
                                     Typically this should reflect the maximum amount of time your handler method will take
                                     to finish execution. See http://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html
                                     for more information
+        :param client: a ready-made boto3 sqs client (or a compatible stub) to use instead of creating one
+        :param shared_client: (boolean) use the process-wide shared session and client, rather than creating new ones
+        :param lazy: (boolean) defer looking up the queue until the first message is sent
+        :param buffered: (boolean) launch_message() returns a Future immediately, and messages are sent in batches
+                                    by a background thread
+        :param linger: (float) with `buffered`, max number of seconds a message waits for a batch to fill up
+        :param buffer_size: (int) with `buffered`, max number of messages waiting to be sent
+        :param overflow: (str) with `buffered`, what to do when the buffer is full: 'block' waits for room, 'drop'
+                                    fails the message's Future with queue.Full
+        :param content_type: (str) encode messages with the codec registered for this content type (e.g.
+                                    'application/json' or 'application/msgpack') instead of `serializer`, and send the
+                                    content type as a message attribute so listeners decode them accordingly
+        :param compression: (str) 'zlib' or 'zstd': compress message bodies larger than `compress_threshold` bytes
+        :param compress_threshold: (int) see `compression`
+        :param blob_store: (BlobStore) store message bodies larger than `offload_threshold` bytes in this store, and
+                                    send a pointer to them instead (claim-check).  Listeners need the same store
+        :param offload_threshold: (int) see `blob_store`.  Set to 250 KiB by default
         """
         if not any([queue, queue_url]):
             raise ValueError('Either `queue` or `queue_url` should be provided.')
-        
-        if (
-            not os.environ.get('AWS_ACCOUNT_ID', None) and 
-            not (boto3.Session().get_credentials().method in ['iam-role', 'assume-role', 'assume-role-with-web-identity'])
+
+        if client is None and (
+            not os.environ.get('AWS_ACCOUNT_ID', None) and
+            not (registry.get_session().get_credentials().method in ['iam-role', 'assume-role', 'assume-role-with-web-identity'])
         ):
             raise EnvironmentError('Environment variable `AWS_ACCOUNT_ID` not set and no role found.')
-        
-        # new session for each instantiation
-        self._session = boto3.session.Session()
-        self._client = self._session.client('sqs')
+
+        if client is not None:
+            self._session = None
+            self._client = client
+        elif shared_client:
+            self._session = registry.get_session()
+            self._client = registry.get_client()
+        else:
+            # new session for each instantiation
+            self._session = boto3.session.Session()
+            self._client = self._session.client('sqs')
 
         self._queue_name = queue
         self._queue_url = queue_url
         self._serializer = serializer
+        self._content_type = content_type
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._blob_store = blob_store
+        self._offload_threshold = offload_threshold
+        if compression is not None and content_type is None:
+            self._content_type = serialization.JSON
+        self._create_queue = create_queue
+        self._visibility_timeout = visibility_timeout
 
-        if not queue_url:
-            queues = self._client.list_queues(QueueNamePrefix=self._queue_name)
-            exists = False
-            for q in queues.get('QueueUrls', []):
-                qname = q.split('/')[-1]
-                if qname == self._queue_name:
-                    exists = True
-                    self._queue_url = q
-
-            if not exists:
-                if create_queue:
-                    q = self._client.create_queue(
-                        QueueName=self._queue_name,
-                        Attributes={
-                            'VisibilityTimeout': visibility_timeout  # 10 minutes
-                        }
-                    )
-                    self._queue_url = q['QueueUrl']
-                else:
-                    raise ValueError('No queue found with name ' + self._queue_name)
-        else:
+        if queue_url:
             self._queue_name = self._get_queue_name_from_url(queue_url)
+        elif not lazy:
+            self._resolve_queue()
+
+        self._buffer = None
+        if buffered:
+            self._buffer = MessageBuffer(self._send_buffered, max_size=buffer_size, linger=linger, overflow=overflow)
+
+    def _resolve_queue(self):
+        self._queue_url = registry.resolve_queue_url(
+            self._client,
+            self._queue_name,
+            create=self._create_queue,
+            attributes={
+                'VisibilityTimeout': self._visibility_timeout  # 10 minutes
+            }
+        )
+        if self._queue_url is None:
+            raise ValueError('No queue found with name ' + self._queue_name)
 
     def launch_message(self, message, **kwargs):
         """
@@ -84,14 +123,103 @@ class SqsLauncher(object):
         :param message: (dict)
         :param kwargs: additional optional keyword arguments (DelaySeconds, MessageAttributes, MessageDeduplicationId, or MessageGroupId)
                         See http://boto3.readthedocs.io/en/latest/reference/services/sqs.html#SQS.Client.send_message for more information
-        :return: (dict) the message response from SQS
+        :return: (dict) the message response from SQS.  If the launcher is buffered, a Future resolving to the
+                        Successful entry of the batch response
         """
+        if self._buffer is not None:
+            entry = self._entry(message, kwargs)
+            if entry_size(entry) > MAX_BATCH_BYTES:
+                raise ValueError('Message exceeds the maximum size of {} bytes'.format(MAX_BATCH_BYTES))
+            return self._buffer.add(entry)
+
         sqs_logger.info("Sending message to queue " + self._queue_name)
+        if self._queue_url is None:
+            self._resolve_queue()
         return self._client.send_message(
             QueueUrl=self._queue_url,
-            MessageBody=self._serializer(message),
-            **kwargs
+            **self._entry(message, kwargs)
         )
 
+    def launch_messages(self, messages, entry_kwargs=None, max_retries=3, **kwargs):
+        """
+        sends many messages to the queue, packed into as few ``send_message_batch`` requests as the SQS limits
+        (10 messages and 256 KiB per request) allow.  Entries which fail on the SQS side, and requests which raise (e.g.
+        throttling or a connection reset), are retried with backoff; entries which still fail are reported rather than
+        raised, so the results of the batches already sent are never lost.
+        :param messages: iterable of (dict).  May be a generator, which is consumed one batch at a time
+        :param entry_kwargs: (function dict -> dict) optional, returns additional per-message keyword arguments,
+                        e.g. MessageDeduplicationId or MessageGroupId
+        :param max_retries: (int) number of times failed entries are retried
+        :param kwargs: additional optional keyword arguments applied to every message (DelaySeconds, MessageAttributes,
+                        MessageDeduplicationId, or MessageGroupId)
+        :return: (list) one result per message, in input order: the Successful entry (with `MessageId`) or Failed
+                        entry (with `Code`, `Message` and `SenderFault`) returned by SQS
+        """
+        if self._queue_url is None:
+            self._resolve_queue()
+        results = {}
+        count = [0]
+
+        def entries():
+            for index, message in enumerate(messages):
+                count[0] = index + 1
+                options = dict(kwargs)
+                if entry_kwargs is not None:
+                    options.update(entry_kwargs(message))
+                entry = self._entry(message, options)
+                entry['Id'] = str(index)
+                if entry_size(entry) > MAX_BATCH_BYTES:
+                    results[entry['Id']] = {
+                        'Id': entry['Id'],
+                        'SenderFault': True,
+                        'Code': 'MessageTooLong',
+                        'Message': 'Message exceeds the maximum size of {} bytes'.format(MAX_BATCH_BYTES)
+                    }
+                    continue
+                yield entry
+
+        for batch in pack_entries(entries()):
+            sqs_logger.info("Sending {} messages to queue {}".format(len(batch), self._queue_name))
+            results.update(send_message_batch(self._client, self._queue_url, batch, max_retries=max_retries))
+        return [results[str(i)] for i in range(count[0])]
+
+    def _entry(self, message, kwargs):
+        # the send_message arguments for a message: its serialized body, plus content attributes if a codec is used
+        entry = dict(kwargs)
+        if self._content_type is None:
+            entry['MessageBody'] = self._serializer(message)
+        else:
+            body, attributes = serialization.encode_body(
+                message,
+                content_type=self._content_type,
+                compression=self._compression,
+                compress_threshold=self._compress_threshold
+            )
+            entry['MessageBody'] = body
+            entry['MessageAttributes'] = dict(kwargs.get('MessageAttributes', {}), **attributes)
+        if self._blob_store is not None:
+            entry = offload_entry(entry, self._blob_store, self._offload_threshold)
+        return entry
+
+    def flush(self, timeout=None):
+        """
+        buffered launchers only: send all buffered messages, and wait for them to complete
+        """
+        if self._buffer is not None:
+            self._buffer.flush(timeout)
+
+    def close(self, timeout=None):
+        """
+        buffered launchers only: send all buffered messages and stop the background thread
+        """
+        if self._buffer is not None:
+            self._buffer.close(timeout)
+
+    def _send_buffered(self, batch):
+        if self._queue_url is None:
+            self._resolve_queue()
+        sqs_logger.info("Sending {} messages to queue {}".format(len(batch), self._queue_name))
+        return send_message_batch(self._client, self._queue_url, batch)
+
     def _get_queue_name_from_url(self, url):
         return url.split('/')[-1]
@@ -0,0 +1,171 @@
+"""
+background buffer for batched, fire-and-forget message sending
+"""
+
+# ================
+# start imports
+# ================
+
+import atexit
+import logging
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import Future
+
+from sqs_listener.batching import MAX_BATCH_ENTRIES, pack_entries
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP = 'drop'
+
+_live_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    for buf in list(_live_buffers):
+        buf.close()
+
+
+class MessageSendError(Exception):
+    """
+    set on the future of a buffered message which SQS refused.  `result` holds the Failed entry returned by SQS
+    """
+
+    def __init__(self, result):
+        Exception.__init__(self, "{}: {}".format(result.get('Code'), result.get('Message')))
+        self.result = result
+
+
+class MessageBuffer(object):
+    """
+    Accumulates send_message_batch entries and sends them from a background thread, once a full batch is available,
+    once the oldest entry has waited `linger` seconds, or on flush()/close().  Pending entries are flushed at
+    interpreter exit.
+    """
+
+    def __init__(self, send_batch, max_size=10000, linger=0.005, overflow=OVERFLOW_BLOCK, block_timeout=None):
+        """
+        :param send_batch: (function list -> dict) sends one batch of entries, returns Id -> SQS result entry
+        :param max_size: (int) max number of entries waiting to be sent
+        :param linger: (float) max number of seconds an entry waits for a batch to fill up
+        :param overflow: (str) 'block' to wait for room when the buffer is full, 'drop' to fail the message immediately
+        :param block_timeout: (float) with 'block', max number of seconds to wait before failing the message.
+                              None waits indefinitely
+        """
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP):
+            raise ValueError('overflow should be one of `block` or `drop`')
+        self._send_batch = send_batch
+        self._max_size = max_size
+        self._linger = linger
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._pending = deque()
+        self._unfinished = 0
+        self._flushing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='sqs-launcher-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+        _live_buffers.add(self)
+
+    def add(self, entry):
+        """
+        :param entry: (dict) send_message_batch entry, without an `Id`
+        :return: (Future) resolved with the SQS result entry once sent
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise ValueError('buffer is closed')
+            if len(self._pending) >= self._max_size:
+                if self._overflow == OVERFLOW_DROP or not self._condition.wait_for(
+                        lambda: len(self._pending) < self._max_size or self._closed, self._block_timeout):
+                    sqs_logger.warning("Launcher buffer full, dropping message")
+                    future.set_exception(queue.Full())
+                    return future
+            self._pending.append((entry, future, time.time()))
+            self._unfinished += 1
+            self._condition.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        """
+        send everything buffered so far, and wait for it to complete
+        :return: (boolean) False if the timeout expired first
+        """
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            done = self._condition.wait_for(lambda: self._unfinished == 0, timeout)
+            self._flushing = False
+            return done
+
+    def close(self, timeout=None):
+        """
+        flush and stop the background thread
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        _live_buffers.discard(self)
+
+    def _ready(self):
+        if not self._pending:
+            return False
+        if self._flushing or self._closed or len(self._pending) >= MAX_BATCH_ENTRIES:
+            return True
+        return time.time() - self._pending[0][2] >= self._linger
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready():
+                    if self._closed and not self._pending:
+                        return
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0, self._pending[0][2] + self._linger - time.time())
+                    self._condition.wait(timeout)
+                taken = [self._pending.popleft() for _ in range(min(len(self._pending), MAX_BATCH_ENTRIES))]
+                self._condition.notify_all()
+
+            futures = {}
+            entries = []
+            for index, (entry, future, _) in enumerate(taken):
+                entry = dict(entry, Id=str(index))
+                futures[entry['Id']] = future
+                entries.append(entry)
+            for batch in pack_entries(entries):
+                self._send(batch, futures)
+
+            with self._condition:
+                self._unfinished -= len(taken)
+                self._condition.notify_all()
+
+    def _send(self, batch, futures):
+        try:
+            results = self._send_batch(batch)
+        except Exception as ex:
+            sqs_logger.exception("Unable to send {} buffered messages".format(len(batch)))
+            for entry in batch:
+                futures[entry['Id']].set_exception(ex)
+            return
+        for entry in batch:
+            result = results.get(entry['Id'], {'Id': entry['Id'], 'Code': 'Unknown', 'Message': 'No result returned'})
+            if 'Code' in result:
+                futures[entry['Id']].set_exception(MessageSendError(result))
+            else:
+                futures[entry['Id']].set_result(result)
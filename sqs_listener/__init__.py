@@ -9,18 +9,38 @@ Created December 21st, 2016
 # start imports
 # ================
 
-import json
 import logging
+import _thread
 import os
+import signal
 import sys
+import threading
 import time
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import boto3.session
 from botocore.exceptions import SSOTokenLoadError
 
-from sqs_launcher import SqsLauncher
+from sqs_listener import registry
+from sqs_listener.batching import DeleteBatcher, MAX_BATCH_ENTRIES, chunks
+from sqs_listener.claimcheck import CLAIM_CHECK_ATTRIBUTE, CachingBlobStore, retrieve_body
+from sqs_listener.dedup import message_id_key
+from sqs_listener.errors import ErrorPublisher, RecordTooLarge, error_record
+from sqs_listener.governor import TokenBucket
+from sqs_listener.heartbeat import VisibilityHeartbeat
+from sqs_listener.messages import BatchMessage, MessageAccumulator
+from sqs_listener.metrics import (DECODE_TIME, DELETE_LATENCY, DUPLICATES, EMPTY_RECEIVES, ERROR_QUEUE_PUSHES, HANDLER_ERRORS,
+                                  HANDLER_TIME, IN_FLIGHT, MESSAGES_RECEIVED, RECEIVE_ERRORS, RECEIVE_LATENCY, RECEIVES,
+                                  RETRIES, SLOW_HANDLERS, SlowHandlerProfiler)
+from sqs_listener.polling import FixedPolling
+from sqs_listener.prefetch import EXPIRY_RELEASE, PrefetchBuffer
+from sqs_listener.retry import RECEIVE_COUNT_ATTRIBUTE, receive_count
+from sqs_listener.serialization import (CONTENT_ENCODING_ATTRIBUTE, CONTENT_TYPE_ATTRIBUTE, LazyBody, MessageDecodeError,
+                                        decode_message, json_loads)
+from sqs_listener.workers import InFlightLimiter
 
 # ================
 # start class
@@ -39,18 +59,26 @@ class SqsListener(object):
         """
         aws_access_key = kwargs.get('aws_access_key', '')
         aws_secret_key = kwargs.get('aws_secret_key', '')
+        client = kwargs.get('client', None)
+        self._shared_client = kwargs.get('shared_client', True)
 
         boto3_session = None
-        if len(aws_access_key) != 0 and len(aws_secret_key) != 0:
-            boto3_session = boto3.Session(
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key
-            )
+        if client is not None:
+            # a ready-made (or stub) client needs neither a session nor credentials
+            pass
+        elif len(aws_access_key) != 0 and len(aws_secret_key) != 0:
+            if self._shared_client:
+                boto3_session = registry.get_session(aws_access_key, aws_secret_key)
+            else:
+                boto3_session = boto3.Session(
+                    aws_access_key_id=aws_access_key,
+                    aws_secret_access_key=aws_secret_key
+                )
         else:
             boto3_session = None
             if (
                     not os.environ.get('AWS_ACCOUNT_ID', None) and
-                    not (boto3.Session().get_credentials().method in ['sso', 'iam-role', 'assume-role', 'assume-role-with-web-identity'])
+                    not (registry.get_session().get_credentials().method in ['sso', 'iam-role', 'assume-role', 'assume-role-with-web-identity'])
             ):
                 raise EnvironmentError('Environment variable `AWS_ACCOUNT_ID` not set and no role found.')
 
@@ -66,150 +94,940 @@ class SqsListener(object):
         self._endpoint_name = kwargs.get('endpoint_name', None)
         self._wait_time = kwargs.get('wait_time', 0)
         self._max_number_of_messages = kwargs.get('max_number_of_messages', 1)
-        self._deserializer = kwargs.get("deserializer", json.loads)
+        self._polling = kwargs.get('polling', None) or FixedPolling(
+            wait_time=self._wait_time,
+            max_number_of_messages=self._max_number_of_messages,
+            interval=self._poll_interval
+        )
+        self._deserializer = kwargs.get("deserializer", json_loads)
+        self._lazy_body = kwargs.get('lazy_body', False)
+        self._blob_store = kwargs.get('blob_store', None)
+        if self._blob_store is not None and kwargs.get('blob_cache_size', 0):
+            self._blob_store = CachingBlobStore(self._blob_store, kwargs['blob_cache_size'])
+        if not set(self._message_attribute_names) & {'All', '.*'}:
+            # needed to pick the right codec for each message, and to find offloaded bodies
+            required = [CONTENT_TYPE_ATTRIBUTE, CONTENT_ENCODING_ATTRIBUTE]
+            if self._blob_store is not None:
+                required.append(CLAIM_CHECK_ATTRIBUTE)
+            self._message_attribute_names = list(self._message_attribute_names) + [
+                name for name in required if name not in self._message_attribute_names
+            ]
+        self._batch_delete = kwargs.get('batch_delete', False)
+        self._delete_batch_size = kwargs.get('delete_batch_size', MAX_BATCH_ENTRIES)
+        self._delete_batch_wait = kwargs.get('delete_batch_wait', 0)
+        self._autoscaler = kwargs.get('autoscaler', None)
+        self._workers = kwargs.get('workers', 0)
+        if self._autoscaler is not None:
+            self._workers = max(self._autoscaler.min_workers, min(self._autoscaler.max_workers, self._workers))
+        self._max_in_flight = kwargs.get('max_in_flight', self._workers + self._max_number_of_messages)
+        self._lazy = kwargs.get('lazy', False)
+        self._error_buffer_size = kwargs.get('error_buffer_size', 1000)
+        self._heartbeat_enabled = kwargs.get('heartbeat', False)
+        self._heartbeat_visibility_timeout = kwargs.get('heartbeat_visibility_timeout', 60)
+        self._heartbeat_interval = kwargs.get('heartbeat_interval', None)
+        self._handler_batch_size = kwargs.get('handler_batch_size', None)
+        self._handler_batch_wait = kwargs.get('handler_batch_wait', 0)
+        self._batch_failure_visibility_timeout = kwargs.get('batch_failure_visibility_timeout', None)
+        self._dedup_store = kwargs.get('dedup_store', None)
+        self._dedup_key = kwargs.get('dedup_key', None) or message_id_key
+        self._prefetch = kwargs.get('prefetch', 0)
+        self._prefetch_visibility_timeout = int(kwargs.get('prefetch_visibility_timeout', self._queue_visibility_timeout))
+        self._prefetch_margin = kwargs.get('prefetch_margin', None)
+        self._prefetch_expiry = kwargs.get('prefetch_expiry', EXPIRY_RELEASE)
+        self._shutdown_timeout = kwargs.get('shutdown_timeout', 20)
+        self._handle_signals = kwargs.get('handle_signals', True)
+        self._fifo = kwargs.get('fifo', (self._queue_url or queue or '').endswith('.fifo'))
+        if self._fifo and not set(self._attribute_names) & {'All', 'MessageGroupId'}:
+            # needed to keep the messages of each group in order
+            self._attribute_names = list(self._attribute_names) + ['MessageGroupId']
+        self._retry_policy = kwargs.get('retry_policy', None)
+        if self._retry_policy is not None and not set(self._attribute_names) & {'All', RECEIVE_COUNT_ATTRIBUTE}:
+            # the attempt number
+            self._attribute_names = list(self._attribute_names) + [RECEIVE_COUNT_ATTRIBUTE]
+        self._rate_limiter = kwargs.get('rate_limit', None)
+        if self._rate_limiter is not None and not isinstance(self._rate_limiter, TokenBucket):
+            self._rate_limiter = TokenBucket(self._rate_limiter)
+        self._circuit_breaker = kwargs.get('circuit_breaker', None)
+        self._metrics = kwargs.get('metrics', None)
+        self._profiler = None
+        if kwargs.get('slow_handler_threshold', None) is not None:
+            self._profiler = SlowHandlerProfiler(
+                kwargs['slow_handler_threshold'],
+                callback=kwargs.get('slow_handler_callback', None)
+            )
+        self._aws_access_key = aws_access_key
+        self._aws_secret_key = aws_secret_key
 
         # must come last
-        if boto3_session:
+        if client is not None:
+            self._session = None
+            self._region_name = kwargs.get('region_name', None)
+        elif boto3_session:
             self._session = boto3_session
+        elif self._shared_client:
+            self._session = registry.get_session()
         else:
             self._session = boto3.session.Session()
-        self._region_name = kwargs.get('region_name', self._session.region_name)
-        self._client = self._initialize_client()
+        if self._session is not None:
+            self._region_name = kwargs.get('region_name', self._session.region_name)
+        self._client = self._initialize_client(client)
+        self._queues_resolved = False
+        self._delete_batcher = None
+        self._error_publisher = None
+        # ids of the messages too large for the error queue, so they're only logged once
+        self._unmovable = OrderedDict()
+        self._heartbeat = None
+        if not self._lazy:
+            self._resolve_queues()
+        self._accumulator = None
+        if type(self).handle_messages is not SqsListener.handle_messages:
+            # batch handler: each receive is handled as one batch, unless micro-batching is configured
+            self._accumulator = MessageAccumulator(self._handler_batch_size, self._handler_batch_wait)
+        self._executor = None
+        self._in_flight = None
+        # messages handed to the executor, by future, until a worker finished them
+        self._queued = {}
+        self._stop_requested = threading.Event()
+        self._deadline_timer = None
+        self._deadline_expired = False
+        self._completed = 0
+        self._completed_lock = threading.Lock()
+        self._concurrency = None
+        self._prefetcher = None
+        if self._workers:
+            self._in_flight = InFlightLimiter(self._max_in_flight)
+            if self._autoscaler is not None:
+                # the pool has room for max_workers threads; the concurrency limiter decides how many are active
+                self._executor = ThreadPoolExecutor(max_workers=self._autoscaler.max_workers)
+                self._concurrency = InFlightLimiter(self._workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers)
 
-    def _initialize_client(self):
-        # new session for each instantiation
+    def _initialize_client(self, sqs=None):
         ssl = True
         if self._region_name == 'elasticmq':
             ssl = False
 
-        sqs = self._session.client('sqs', region_name=self._region_name, endpoint_url=self._endpoint_name, use_ssl=ssl)
-        try:
-            queues = sqs.list_queues(QueueNamePrefix=self._queue_name)
-        except SSOTokenLoadError:
-            raise EnvironmentError('Error loading SSO Token. Reauthenticate via aws sso login.')
-
-        main_queue_exists = False
-        error_queue_exists = False
-        if 'QueueUrls' in queues:
-            for q in queues['QueueUrls']:
-                qname = q.split('/')[-1]
-                if qname == self._queue_name:
-                    main_queue_exists = True
-                if self._error_queue_name and qname == self._error_queue_name:
-                    error_queue_exists = True
+        if sqs is not None:
+            return sqs
+        if self._shared_client:
+            return registry.get_client(
+                region_name=self._region_name,
+                endpoint_url=self._endpoint_name,
+                use_ssl=ssl,
+                aws_access_key=self._aws_access_key,
+                aws_secret_key=self._aws_secret_key
+            )
+        # new session for each instantiation
+        return self._session.client('sqs', region_name=self._region_name, endpoint_url=self._endpoint_name, use_ssl=ssl)
 
+    def _resolve_queues(self):
+        """
+        look up (and if necessary create) the main and error queues.  Called on instantiation, or on the first receive
+        if the listener is lazy
+        """
         # create queue if necessary.
         # creation is idempotent, no harm in calling on a queue if it already exists.
-        if self._queue_url is None:
-            if not main_queue_exists:
-                sqs_logger.warning("main queue not found, creating now")
-
+        try:
+            if self._queue_url is None:
+                attributes = {
+                    'VisibilityTimeout': self._queue_visibility_timeout,  # 10 minutes
+                }
                 # is this a fifo queue?
+                # need to avoid FifoQueue property for normal non-fifo queues
                 if self._queue_name.endswith(".fifo"):
-                    fifo_queue = "true"
-                    q = sqs.create_queue(
-                        QueueName=self._queue_name,
-                        Attributes={
-                            'VisibilityTimeout': self._queue_visibility_timeout,  # 10 minutes
-                            'FifoQueue': fifo_queue
-                        }
-                    )
-                else:
-                    # need to avoid FifoQueue property for normal non-fifo queues
-                    q = sqs.create_queue(
-                        QueueName=self._queue_name,
-                        Attributes={
-                            'VisibilityTimeout': self._queue_visibility_timeout,  # 10 minutes
-                        }
-                    )
-                self._queue_url = q['QueueUrl']
-
-        if self._error_queue_name and not error_queue_exists:
-            sqs_logger.warning("error queue not found, creating now")
-            q = sqs.create_queue(
-                QueueName=self._error_queue_name,
-                Attributes={
-                    'VisibilityTimeout': self._queue_visibility_timeout  # 10 minutes
-                }
-            )
+                    attributes['FifoQueue'] = "true"
+                self._queue_url = registry.resolve_queue_url(
+                    self._client,
+                    self._queue_name,
+                    create=True,
+                    attributes=attributes,
+                    owner_account_id=os.environ.get('AWS_ACCOUNT_ID', None)
+                )
 
-        if self._queue_url is None:
-            if os.environ.get('AWS_ACCOUNT_ID', None):
-                qs = sqs.get_queue_url(QueueName=self._queue_name,
-                                       QueueOwnerAWSAccountId=os.environ.get('AWS_ACCOUNT_ID', None))
-            else:
-                qs = sqs.get_queue_url(QueueName=self._queue_name)
-            self._queue_url = qs['QueueUrl']
-        return sqs
+            if self._error_queue_name:
+                error_queue_url = registry.resolve_queue_url(
+                    self._client,
+                    self._error_queue_name,
+                    create=True,
+                    attributes={
+                        'VisibilityTimeout': self._queue_visibility_timeout  # 10 minutes
+                    }
+                )
+        except SSOTokenLoadError:
+            raise EnvironmentError('Error loading SSO Token. Reauthenticate via aws sso login.')
+
+        if self._error_queue_name:
+            self._error_publisher = ErrorPublisher(
+                self._client,
+                error_queue_url,
+                max_queued=self._error_buffer_size,
+                on_sent=self._delete_moved
+            )
+        if self._heartbeat_enabled:
+            self._heartbeat = VisibilityHeartbeat(
+                self._client,
+                self._queue_url,
+                visibility_timeout=self._heartbeat_visibility_timeout,
+                interval=self._heartbeat_interval
+            )
+        if self._batch_delete:
+            self._delete_batcher = DeleteBatcher(
+                self._client,
+                self._queue_url,
+                max_size=self._delete_batch_size,
+                max_wait=self._delete_batch_wait,
+                metrics=self._metrics
+            )
+        self._queues_resolved = True
 
     def _start_listening(self):
         # TODO consider incorporating output processing from here: https://github.com/debrouwere/sqs-antenna/blob/master/antenna/__init__.py
-        while True:
-            # calling with WaitTimeSecconds of zero show the same behavior as
-            # not specifiying a wait time, ie: short polling
-            messages = self._client.receive_message(
+        if not self._queues_resolved:
+            self._resolve_queues()
+        if self._heartbeat:
+            self._heartbeat.start()
+        if self._profiler is not None:
+            self._profiler.start()
+        if self._autoscaler is not None and self._executor:
+            self._autoscaler.start(self)
+        if self._prefetch:
+            self._prefetcher = PrefetchBuffer(
+                lambda wait_time, count: self._receive(
+                    wait_time, count, VisibilityTimeout=self._prefetch_visibility_timeout
+                ),
+                self._release_messages,
+                self._polling,
+                self._prefetch,
+                self._prefetch_visibility_timeout,
+                margin=self._prefetch_margin,
+                on_expiry=self._prefetch_expiry
+            )
+            self._prefetcher.start()
+        while not self._stop_requested.is_set():
+            wait_time, max_number_of_messages = self._polling.receive_options()
+            if self._in_flight:
+                # backpressure: never receive more messages than there are free in-flight slots
+                free = self._in_flight.wait_for_capacity(1)
+                if not free:
+                    # check for a stop request every second while the workers are busy
+                    continue
+                max_number_of_messages = min(max_number_of_messages, free)
+            if self._rate_limiter is not None or self._circuit_breaker is not None:
+                allowed = self._govern(max_number_of_messages)
+                if not allowed:
+                    # rate limited, or the circuit breaker is open: no receiving for now
+                    if self._delete_batcher:
+                        self._delete_batcher.flush_if_due()
+                    self._stop_requested.wait(self._governor_pause())
+                    continue
+                max_number_of_messages = allowed
+
+            if self._prefetcher is not None:
+                # the prefetch thread receives, and applies the polling strategy's pauses
+                messages = self._prefetcher.get(max_number_of_messages, timeout=1)
+            else:
+                try:
+                    messages = self._receive(wait_time, max_number_of_messages)
+                except Exception as ex:
+                    self._ungovern(max_number_of_messages)
+                    self._stop_requested.wait(self._polling.on_error(ex))
+                    continue
+            self._ungovern(max_number_of_messages - len(messages))
+
+            pause = 0
+            if messages and self._stop_requested.is_set():
+                # stopped while receiving: hand the messages straight back
+                self._abandon(messages)
+            elif messages:
+                sqs_logger.info("{} messages received".format(len(messages)))
+                if self._prefetcher is None:
+                    pause = self._polling.on_messages(len(messages))
+                if self._force_delete and self._delete_batcher:
+                    # delete the whole batch up front, in a single request
+                    self._delete_batcher.delete([m['ReceiptHandle'] for m in messages])
+                if self._heartbeat and not self._force_delete:
+                    for m in messages:
+                        self._heartbeat.register(m['ReceiptHandle'])
+                if self._accumulator is not None:
+                    for batch in self._accumulator.add(messages):
+                        self._dispatch_batch(batch)
+                elif self._fifo:
+                    self._dispatch_groups(messages)
+                else:
+                    for i, m in enumerate(messages):
+                        if self._stop_requested.is_set():
+                            self._abandon(messages[i:])
+                            break
+                        if self._executor:
+                            self._submit_message(m)
+                            continue
+                        try:
+                            self._process_message(m)
+                        except BaseException:
+                            # e.g. the shutdown deadline expired: the interrupted message and the rest of the batch
+                            # are handed back
+                            self._abandon(messages[i:])
+                            raise
+                if self._delete_batcher:
+                    self._delete_batcher.flush_if_due()
+            else:
+                # with prefetching, get() also comes back empty when it times out while a receive is in progress
+                idle = self._prefetcher is None or self._prefetcher.idle
+                if self._accumulator is not None:
+                    if idle:
+                        # the queue is idle, no point in waiting for the micro-batch to fill up
+                        pending = self._accumulator.drain()
+                    else:
+                        pending = self._accumulator.due()
+                    if pending:
+                        self._dispatch_batch(pending)
+                if self._delete_batcher:
+                    if idle:
+                        self._delete_batcher.flush()
+                    else:
+                        self._delete_batcher.flush_if_due()
+                if self._prefetcher is None:
+                    pause = self._polling.on_empty()
+            if pause:
+                self._stop_requested.wait(pause)
+
+    def _receive(self, wait_time, max_number_of_messages, **options):
+        """
+        :return: (list) the received messages
+        """
+        # calling with WaitTimeSecconds of zero show the same behavior as
+        # not specifiying a wait time, ie: short polling
+        started = time.time()
+        try:
+            response = self._client.receive_message(
                 QueueUrl=self._queue_url,
                 MessageAttributeNames=self._message_attribute_names,
                 AttributeNames=self._attribute_names,
-                WaitTimeSeconds=self._wait_time,
-                MaxNumberOfMessages=self._max_number_of_messages
+                WaitTimeSeconds=wait_time,
+                MaxNumberOfMessages=max_number_of_messages,
+                **options
             )
-            if 'Messages' in messages:
-
-                sqs_logger.debug(messages)
-                sqs_logger.info("{} messages received".format(len(messages['Messages'])))
-                for m in messages['Messages']:
-                    receipt_handle = m['ReceiptHandle']
-                    m_body = m['Body']
-                    message_attribs = None
-                    attribs = None
-
-                    try:
-                        deserialized = self._deserializer(m_body)
-                    except:
-                        sqs_logger.exception("Unable to parse message")
-                        continue
-
-                    if 'MessageAttributes' in m:
-                        message_attribs = m['MessageAttributes']
-                    if 'Attributes' in m:
-                        attribs = m['Attributes']
-                    try:
-                        if self._force_delete:
-                            self._client.delete_message(
-                                QueueUrl=self._queue_url,
-                                ReceiptHandle=receipt_handle
-                            )
-                            self.handle_message(deserialized, message_attribs, attribs)
-                        else:
-                            self.handle_message(deserialized, message_attribs, attribs)
-                            self._client.delete_message(
-                                QueueUrl=self._queue_url,
-                                ReceiptHandle=receipt_handle
-                            )
-                    except Exception as ex:
-                        sqs_logger.exception(ex)
-                        if self._error_queue_name:
-                            exc_type, exc_obj, exc_tb = sys.exc_info()
-
-                            sqs_logger.info("Pushing exception to error queue")
-                            error_launcher = SqsLauncher(queue=self._error_queue_name, create_queue=True)
-                            error_launcher.launch_message(
-                                {
-                                    'exception_type': str(exc_type),
-                                    'error_message': str(ex.args)
-                                }
-                            )
+        except Exception:
+            if self._metrics is not None:
+                self._metrics.increment(RECEIVE_ERRORS)
+            raise
+        if self._metrics is not None:
+            self._record_receive(started, len(response.get('Messages', [])))
+        if sqs_logger.isEnabledFor(logging.DEBUG) and 'Messages' in response:
+            sqs_logger.debug(response)
+        return response.get('Messages', [])
+
+    def _govern(self, wanted):
+        """
+        :return: (int) number of messages the circuit breaker and the rate limit allow receiving now, up to `wanted`
+        """
+        if self._circuit_breaker is not None:
+            wanted = self._circuit_breaker.take(wanted)
+        if self._rate_limiter is not None and wanted:
+            granted = self._rate_limiter.take(wanted)
+            if self._circuit_breaker is not None and granted < wanted:
+                self._circuit_breaker.give_back(wanted - granted)
+            wanted = granted
+        return wanted
+
+    def _ungovern(self, count):
+        # hand back the allowance of messages which weren't received
+        if count <= 0:
+            return
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.give_back(count)
+        if self._rate_limiter is not None:
+            self._rate_limiter.give_back(count)
+
+    def _governor_pause(self):
+        """
+        :return: (float) number of seconds to wait before asking _govern() again, at most 1 to check for stop requests
+        """
+        pause = 0.05
+        if self._circuit_breaker is not None:
+            pause = max(pause, self._circuit_breaker.retry_after())
+        if self._rate_limiter is not None:
+            pause = max(pause, self._rate_limiter.retry_after())
+        return min(pause, 1.0)
+
+    def _record_receive(self, started, count):
+        self._metrics.timing(RECEIVE_LATENCY, time.time() - started)
+        self._metrics.increment(RECEIVES)
+        if count:
+            self._metrics.increment(MESSAGES_RECEIVED, count)
+        else:
+            self._metrics.increment(EMPTY_RECEIVES)
+        if self._in_flight:
+            self._metrics.gauge(IN_FLIGHT, self._in_flight.in_flight)
 
+    def _run_handler(self, message_ids, handler, *args):
+        """
+        call a handler, timing (and profiling) it if metrics, a slow handler threshold or a circuit breaker are configured
+        """
+        if self._metrics is None and self._profiler is None and self._circuit_breaker is None:
+            return handler(*args)
+        token = self._profiler.begin(message_ids) if self._profiler is not None else None
+        started = time.time()
+        # stays None if the handler was interrupted, e.g. by the shutdown deadline
+        success = None
+        try:
+            result = handler(*args)
+            success = True
+            return result
+        except Exception:
+            success = False
+            if self._metrics is not None:
+                self._metrics.increment(HANDLER_ERRORS)
+            raise
+        finally:
+            if self._metrics is not None:
+                self._metrics.timing(HANDLER_TIME, time.time() - started)
+            if self._circuit_breaker is not None:
+                if success is None:
+                    self._circuit_breaker.give_back(len(message_ids))
+                else:
+                    self._circuit_breaker.record(time.time() - started, success, len(message_ids))
+            if token is not None and self._profiler.end(token) and self._metrics is not None:
+                self._metrics.increment(SLOW_HANDLERS)
+
+    def _dispatch_batch(self, messages):
+        if not self._executor:
+            self._process_batch(messages)
+            return
+        self._submit_messages(self._process_batch, messages)
+
+    def _dispatch_groups(self, messages):
+        """
+        FIFO mode: the messages of each message group are handled in order, by a single worker.  Different groups are
+        handled concurrently
+        """
+        groups = OrderedDict()
+        for m in messages:
+            groups.setdefault((m.get('Attributes') or {}).get('MessageGroupId'), []).append(m)
+        for group in groups.values():
+            if self._executor:
+                self._submit_messages(self._process_group, group)
             else:
-                time.sleep(self._poll_interval)
+                self._process_group(group)
+
+    def _submit_messages(self, target, messages):
+        # run target(messages) on a worker, holding one in-flight slot per message
+        for _ in messages:
+            self._in_flight.acquire()
+        try:
+            future = self._executor.submit(self._run_worker, target, messages, messages)
+        except:
+            for _ in messages:
+                self._in_flight.release()
+            raise
+        self._queued[future] = messages
+        future.add_done_callback(lambda f: self._batch_done(f, len(messages)))
+
+    def _run_worker(self, target, arg, messages):
+        if self._concurrency is not None:
+            # only as many workers as the autoscaler decided handle messages at once
+            while not self._concurrency.acquire(block=True, timeout=1):
+                if self._stop_requested.is_set():
+                    self._abandon(messages)
+                    return
+        try:
+            target(arg)
+        finally:
+            if self._concurrency is not None:
+                self._concurrency.release()
+            with self._completed_lock:
+                self._completed += len(messages)
+
+    def _batch_done(self, future, count):
+        self._queued.pop(future, None)
+        for _ in range(count):
+            self._in_flight.release()
+        if not future.cancelled() and future.exception() is not None:
+            sqs_logger.error("Unexpected error in worker", exc_info=future.exception())
+
+    def _process_batch(self, messages):
+        try:
+            self._handle_received_batch(messages)
+        finally:
+            if self._heartbeat:
+                for m in messages:
+                    self._heartbeat.unregister(m['ReceiptHandle'])
+
+    def _handle_received_batch(self, messages):
+        received = []
+        batch = []
+        for m in messages:
+            if self._is_duplicate(m):
+                if not (self._force_delete and self._delete_batcher):
+                    self._delete_message(m['ReceiptHandle'])
+                continue
+            try:
+                deserialized = self._decode(m)
+            except:
+                self._decode_failed(m, sys.exc_info(), deleted=bool(self._force_delete and self._delete_batcher))
+                continue
+            received.append(m)
+            batch.append(BatchMessage(deserialized, m.get('MessageAttributes'), m.get('Attributes'), m.get('MessageId')))
+        if not batch:
+            return
+
+        if self._force_delete and not self._delete_batcher:
+            for m in received:
+                self._delete_message(m['ReceiptHandle'])
+        try:
+            results = self._run_handler([message.message_id for message in batch], self.handle_messages, batch)
+        except Exception as ex:
+            sqs_logger.exception(ex)
+            results = [ex] * len(batch)
+        if results is None:
+            results = [True] * len(batch)
+        elif not isinstance(results, (list, tuple)) or len(results) != len(batch):
+            # can't tell which messages were handled: none is deleted
+            sqs_logger.error("handle_messages returned {!r} for {} messages, expected None or one result per "
+                             "message; failing the whole batch".format(results, len(batch)))
+            results = [RuntimeError('handle_messages returned an invalid result')] * len(batch)
+
+        for m, result in zip(received, results):
+            if result is True or result is None:
+                if not self._force_delete:
+                    self._delete_message(m['ReceiptHandle'])
+                self._remember(m)
+                continue
+            if not isinstance(result, BaseException):
+                result = RuntimeError('handle_messages reported a failure')
+            sqs_logger.error("Failed to handle message {}: {!r}".format(m.get('MessageId'), result))
+            self._handle_failure(m, (type(result), result, getattr(result, '__traceback__', None)))
+            if (self._batch_failure_visibility_timeout is not None and self._retry_policy is None
+                    and not self._force_delete):
+                self._client.change_message_visibility(
+                    QueueUrl=self._queue_url,
+                    ReceiptHandle=m['ReceiptHandle'],
+                    VisibilityTimeout=self._batch_failure_visibility_timeout
+                )
+
+    def _process_group(self, messages):
+        try:
+            for i, m in enumerate(messages):
+                if self._stop_requested.is_set():
+                    self._abandon(messages[i:])
+                    return
+                try:
+                    handled = self._handle_received(m)
+                except BaseException:
+                    self._abandon(messages[i:])
+                    raise
+                if not handled and not self._force_delete:
+                    # handling the rest of the group now would break its order; SQS redelivers it after the failed message
+                    rest = messages[i + 1:]
+                    if rest:
+                        sqs_logger.warning("Message {} failed, releasing the {} following messages of its group".format(
+                            m.get('MessageId'), len(rest)))
+                        self._release_messages([m['ReceiptHandle'] for m in rest])
+                    return
+        finally:
+            if self._heartbeat:
+                for m in messages:
+                    self._heartbeat.unregister(m['ReceiptHandle'])
+
+    def _abandon(self, messages):
+        """
+        give up on received messages which weren't handled, making them visible again for other listeners
+        """
+        if not messages:
+            return
+        self._skip_breaker(len(messages))
+        if self._heartbeat:
+            for m in messages:
+                self._heartbeat.unregister(m['ReceiptHandle'])
+        if self._force_delete and self._delete_batcher:
+            sqs_logger.warning("{} messages were deleted, but will not be handled".format(len(messages)))
+            return
+        sqs_logger.info("Releasing {} unhandled messages".format(len(messages)))
+        self._release_messages([m['ReceiptHandle'] for m in messages])
+
+    def _release_messages(self, receipt_handles, visibility_timeout=0):
+        """
+        make received messages visible again right away, without handling them - or after `visibility_timeout`
+        seconds
+        """
+        for chunk in chunks(list(receipt_handles)):
+            try:
+                response = self._client.change_message_visibility_batch(
+                    QueueUrl=self._queue_url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': handle, 'VisibilityTimeout': visibility_timeout}
+                        for i, handle in enumerate(chunk)
+                    ]
+                )
+            except Exception:
+                sqs_logger.exception("Unable to change the visibility of {} messages".format(len(chunk)))
+                continue
+            for failure in response.get('Failed', []):
+                sqs_logger.warning("Unable to change the visibility of message: {} ({})".format(
+                    failure.get('Message'), failure.get('Code')))
+
+    def _submit_message(self, m):
+        # the message is deleted, or pushed to the error queue, by the worker when its handler completes
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(self._run_worker, self._process_message, m, [m])
+        except:
+            self._in_flight.release()
+            raise
+        self._queued[future] = [m]
+        future.add_done_callback(self._message_done)
+
+    def _message_done(self, future):
+        self._queued.pop(future, None)
+        self._in_flight.release()
+        if not future.cancelled() and future.exception() is not None:
+            sqs_logger.error("Unexpected error in worker", exc_info=future.exception())
+
+    def _process_message(self, m):
+        try:
+            self._handle_received(m)
+        finally:
+            if self._heartbeat:
+                self._heartbeat.unregister(m['ReceiptHandle'])
+
+    def _handle_received(self, m):
+        """
+        :return: (boolean) True if the message was handled, or moved to the error queue because it can't be decoded
+        """
+        receipt_handle = m['ReceiptHandle']
+        message_attribs = None
+        attribs = None
+
+        if self._is_duplicate(m):
+            if not (self._force_delete and self._delete_batcher):
+                self._delete_message(receipt_handle)
+            return True
+        try:
+            deserialized = self._decode(m)
+        except:
+            return self._decode_failed(m, sys.exc_info(), deleted=bool(self._force_delete and self._delete_batcher))
+
+        if 'MessageAttributes' in m:
+            message_attribs = m['MessageAttributes']
+        if 'Attributes' in m:
+            attribs = m['Attributes']
+        try:
+            if self._force_delete:
+                if not self._delete_batcher:
+                    self._delete_message(receipt_handle)
+                self._run_handler([m.get('MessageId')], self.handle_message, deserialized, message_attribs, attribs)
+            else:
+                self._run_handler([m.get('MessageId')], self.handle_message, deserialized, message_attribs, attribs)
+                self._delete_message(receipt_handle)
+            self._remember(m)
+        except MessageDecodeError:
+            # a lazy body which turned out to be undecodable
+            return self._reject_undecodable(m, sys.exc_info(), deleted=self._force_delete)
+        except Exception as ex:
+            sqs_logger.exception(ex)
+            self._handle_failure(m, sys.exc_info())
+            return False
+        return True
+
+    def _handle_failure(self, m, exc_info):
+        """
+        a handler failed on a message: push it to the error queue, or with a retry policy, have it delivered again
+        after a delay, and move it to the error queue once the attempts are exhausted
+        """
+        if self._retry_policy is None or self._force_delete:
+            # a message deleted up front can't be retried
+            if self._error_queue_name:
+                self._push_error(m, exc_info)
+            return
+        if self._heartbeat:
+            # or the next extension would override the delay
+            self._heartbeat.unregister(m['ReceiptHandle'])
+        attempt = receive_count(m)
+        if not self._retry_policy.exhausted(attempt):
+            delay = self._retry_policy.delay(attempt)
+            sqs_logger.info("Retrying message {} in {} seconds (attempt {} of {})".format(
+                m.get('MessageId'), delay, attempt, self._retry_policy.max_attempts))
+            if self._metrics is not None:
+                self._metrics.increment(RETRIES)
+            try:
+                self._client.change_message_visibility(
+                    QueueUrl=self._queue_url,
+                    ReceiptHandle=m['ReceiptHandle'],
+                    VisibilityTimeout=delay
+                )
+            except Exception:
+                sqs_logger.exception("Unable to delay the retry of message {}".format(m.get('MessageId')))
+            return
+        if not self._error_queue_name:
+            sqs_logger.error("Giving up on message {} after {} attempts, leaving it to the queue's redrive policy".format(
+                m.get('MessageId'), attempt))
+            return
+        if m.get('MessageId') in self._unmovable:
+            # already logged by _push_error
+            return
+        sqs_logger.error("Moving message {} to the error queue after {} attempts".format(m.get('MessageId'), attempt))
+        # deleted by _delete_moved once it reached the error queue
+        self._push_error(m, exc_info, move=True)
+
+    def _delete_moved(self, receipt_handles):
+        # called by the error publisher with the messages which were moved to the error queue
+        if self._delete_batcher:
+            self._delete_batcher.delete(receipt_handles)
+        else:
+            DeleteBatcher(self._client, self._queue_url, metrics=self._metrics).delete(receipt_handles)
+
+    def _is_duplicate(self, m):
+        """
+        :return: (boolean) True if the dedup store has already seen the message, which should then be deleted without
+                 being handled
+        """
+        if self._dedup_store is None:
+            return False
+        try:
+            seen = self._dedup_store.contains(self._dedup_key(m))
+        except Exception:
+            # better to handle a duplicate than to drop a message
+            sqs_logger.exception("Unable to check message {} for duplicates".format(m.get('MessageId')))
+            return False
+        if not seen:
+            return False
+        sqs_logger.info("Deleting duplicate message {}".format(m.get('MessageId')))
+        if self._metrics is not None:
+            self._metrics.increment(DUPLICATES)
+        self._skip_breaker(1)
+        return True
+
+    def _skip_breaker(self, count):
+        # messages which never reach the handler say nothing about the downstream: their circuit breaker allowance is
+        # handed back, or a half open breaker would wait forever for the outcome of its probes
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.give_back(count)
+
+    def _remember(self, m):
+        # called once a message was handled successfully
+        if self._dedup_store is None:
+            return
+        try:
+            self._dedup_store.add(self._dedup_key(m))
+        except Exception:
+            sqs_logger.exception("Unable to record message {} in the dedup store".format(m.get('MessageId')))
+
+    def _decode(self, m):
+        """
+        :raises MessageDecodeError: if the body can't be decoded.  Any other exception means the body couldn't be fetched
+                                    from the blob store
+        """
+        if self._blob_store is not None:
+            # fetched up front even for a lazy body, so that a failed fetch isn't mistaken for an undecodable body
+            m = retrieve_body(m, self._blob_store)
+        if self._lazy_body:
+            return LazyBody(m, self._decode_message)
+        return self._decode_message(m)
+
+    def _decode_message(self, m):
+        if self._metrics is None:
+            return decode_message(m, default=self._deserializer)
+        started = time.time()
+        try:
+            return decode_message(m, default=self._deserializer)
+        finally:
+            self._metrics.timing(DECODE_TIME, time.time() - started)
+
+    def _decode_failed(self, m, exc_info, deleted=False):
+        """
+        _decode() raised.  An undecodable body is rejected for good, while a failure to fetch the body from the blob
+        store (e.g. throttling) is most likely transient, and goes through _handle_failure like a handler failure
+        :param deleted: (boolean) see _reject_undecodable()
+        :return: (boolean) True if the message was rejected, see _reject_undecodable()
+        """
+        if issubclass(exc_info[0], MessageDecodeError):
+            return self._reject_undecodable(m, exc_info, deleted)
+        sqs_logger.error("Unable to fetch the body of message {}".format(m.get('MessageId')), exc_info=exc_info)
+        self._skip_breaker(1)
+        self._handle_failure(m, exc_info)
+        return False
+
+    def _reject_undecodable(self, m, exc_info, deleted=False):
+        """
+        a message which can't be decoded would fail on every delivery, so it is moved to the error queue if there is one:
+        it is deleted by _delete_moved once its record reached the error queue, and delivered again otherwise
+        :param deleted: (boolean) True if the message was already deleted (force_delete), and only needs its record pushed
+        :return: (boolean) True if the record was queued for the error queue
+        """
+        sqs_logger.error("Unable to parse message", exc_info=exc_info)
+        self._skip_breaker(1)
+        if not self._error_queue_name:
+            return False
+        return self._push_error(m, exc_info, move=not deleted)
+
+    def _push_error(self, m, exc_info, move=False):
+        """
+        :param move: (boolean) delete the message once its record reached the error queue
+        :return: (boolean) False if the record was dropped (the error buffer is full), or the message is too large for
+                 the error queue.  A message to move is then left on the queue
+        """
+        sqs_logger.info("Pushing exception to error queue")
+        try:
+            if not self._error_publisher.publish(error_record(m, exc_info), token=m['ReceiptHandle'] if move else None):
+                return False
+        except RecordTooLarge:
+            message_id = m.get('MessageId')
+            if message_id not in self._unmovable:
+                sqs_logger.error("Message {} is too large for the error queue, leaving it to the queue's redrive "
+                                 "policy".format(message_id))
+                self._unmovable[message_id] = True
+                if len(self._unmovable) > 1000:
+                    self._unmovable.popitem(last=False)
+            return False
+        if self._metrics is not None:
+            self._metrics.increment(ERROR_QUEUE_PUSHES)
+        return True
+
+    def _delete_message(self, receipt_handle):
+        if self._delete_batcher:
+            self._delete_batcher.add(receipt_handle)
+        elif self._metrics is None:
+            self._client.delete_message(
+                QueueUrl=self._queue_url,
+                ReceiptHandle=receipt_handle
+            )
+        else:
+            started = time.time()
+            self._client.delete_message(
+                QueueUrl=self._queue_url,
+                ReceiptHandle=receipt_handle
+            )
+            self._metrics.timing(DELETE_LATENCY, time.time() - started)
 
     def listen(self):
         sqs_logger.info("Listening to queue " + self._queue_name)
         if self._error_queue_name:
             sqs_logger.info("Using error queue " + self._error_queue_name)
 
-        self._start_listening()
+        previous_handlers = self._install_signal_handlers()
+        try:
+            self._start_listening()
+        except KeyboardInterrupt:
+            if not self._deadline_expired:
+                raise
+        finally:
+            if self._deadline_timer is not None:
+                self._deadline_timer.cancel()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            if self._prefetcher is not None:
+                self._abandon(self._prefetcher.close())
+                self._prefetcher = None
+            if self._accumulator is not None:
+                pending = self._accumulator.drain()
+                if pending:
+                    self._abandon(pending)
+            if self._executor:
+                self._drain_workers()
+            if self._heartbeat:
+                self._heartbeat.stop()
+            if self._profiler is not None:
+                self._profiler.stop()
+            if self._autoscaler is not None:
+                self._autoscaler.stop()
+            if self._delete_batcher:
+                self._delete_batcher.flush()
+            if self._error_publisher:
+                self._error_publisher.close()
+
+    @property
+    def completed(self):
+        """
+        number of messages the workers finished handling (successfully or not) so far
+        """
+        return self._completed
+
+    @property
+    def active_workers(self):
+        return self._concurrency.limit if self._concurrency is not None else self._workers
+
+    def queue_depth(self):
+        """
+        :return: (tuple) the ApproximateNumberOfMessages and ApproximateNumberOfMessagesNotVisible of the queue
+        """
+        attributes = self._client.get_queue_attributes(
+            QueueUrl=self._queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']), int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def scale_workers(self, workers):
+        """
+        change the number of messages handled at once, and receive accordingly.  Requires the `autoscaler` option
+        """
+        if self._concurrency is None:
+            raise ValueError('Scaling workers requires the autoscaler option')
+        headroom = self._max_in_flight - self._workers
+        self._concurrency.resize(workers)
+        self._in_flight.resize(workers + headroom)
+
+    def stop(self):
+        """
+        stop listening.  listen() returns once the messages being handled are finished, or `shutdown_timeout`
+        seconds after the stop was requested, whichever comes first.  Received messages which weren't handled yet,
+        including those whose handler is still running at the deadline, are made visible again right away.  Safe to
+        call from any thread, or from a signal handler
+        """
+        self._stop_requested.set()
+
+    def _install_signal_handlers(self):
+        """
+        :return: (dict) the handlers which were replaced, by signal number
+        """
+        if not self._handle_signals or threading.current_thread() is not threading.main_thread():
+            # signal handlers can only be installed from the main thread
+            return {}
+        previous = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handler = signal.signal(signum, self._handle_stop_signal)
+            if handler is not None:
+                previous[signum] = handler
+        return previous
+
+    def _handle_stop_signal(self, signum, frame):
+        if self._stop_requested.is_set():
+            sqs_logger.warning("Received signal {} again, stopping right away".format(signum))
+            raise KeyboardInterrupt
+        sqs_logger.info("Received signal {}, stopping".format(signum))
+        self.stop()
+        if self._shutdown_timeout is not None and not self._executor:
+            # the main thread may be busy handling a message (or long polling) for longer than the deadline
+            self._deadline_timer = threading.Timer(self._shutdown_timeout, self._expire_deadline)
+            self._deadline_timer.daemon = True
+            self._deadline_timer.start()
+
+    def _expire_deadline(self):
+        sqs_logger.warning("Not stopped after {} seconds, abandoning the message being handled".format(self._shutdown_timeout))
+        self._deadline_expired = True
+        if hasattr(signal, 'pthread_kill'):
+            # a real signal also interrupts a blocking call, e.g. a sleep in the handler
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+        else:
+            _thread.interrupt_main()
+
+    def _drain_workers(self):
+        # messages still waiting for a worker are released rather than handled
+        abandoned = []
+        for future, messages in list(self._queued.items()):
+            if future.cancel():
+                abandoned.extend(messages)
+        if abandoned:
+            self._abandon(abandoned)
+        # let the workers finish (and delete) the messages they're handling
+        sqs_logger.info("Waiting for {} in-flight messages".format(self._in_flight.in_flight))
+        if not self._in_flight.wait_until_idle(self._shutdown_timeout):
+            # the handlers can't be interrupted, but their messages can be handed to other listeners right away
+            running = [m for messages in list(self._queued.values()) for m in messages]
+            sqs_logger.warning("Abandoning {} in-flight messages after {} seconds; python waits for their handlers "
+                               "to return before exiting".format(len(running), self._shutdown_timeout))
+            self._abandon(running)
+        self._executor.shutdown(wait=False)
 
     def _prepare_logger(self):
         logger = logging.getLogger('eg_daemon')
@@ -234,3 +1052,15 @@ class SqsListener(object):
         :return:
         """
         return
+
+    def handle_messages(self, messages):
+        """
+        Optionally implement this method, instead of handle_message(), to handle a whole batch of messages at once -
+        e.g. for bulk inserts.  The batch is a receive batch, or a micro-batch collected across polls if the
+        `handler_batch_size` / `handler_batch_wait` options are set.
+        :param messages: list of BatchMessage (body, message_attributes, attributes, message_id)
+        :return: None if all messages were handled, otherwise a list with one result per message: True for success,
+                 False or an Exception instance for failure.  Only successful messages are deleted.  Raising fails the
+                 whole batch
+        """
+        raise NotImplementedError
@@ -0,0 +1,477 @@
+"""
+asyncio-native listener, for services which already run an event loop
+
+Requires python 3.7+.  Not imported by the ``sqs_listener`` package itself; use
+``from sqs_listener.async_listener import AsyncSqsListener``
+"""
+
+# ================
+# start imports
+# ================
+
+import asyncio
+import functools
+import inspect
+import logging
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqs_listener import SqsListener
+from sqs_listener.batching import chunks, MAX_BATCH_ENTRIES
+from sqs_listener.metrics import DELETE_LATENCY, HANDLER_ERRORS, HANDLER_TIME, RECEIVE_ERRORS
+from sqs_listener.serialization import MessageDecodeError
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+
+class ThreadedTransport(object):
+    """
+    Default transport: runs the calls of a blocking boto3 client in a thread pool.
+
+    Any object exposing the same coroutine methods can be passed to ``AsyncSqsListener`` as its ``transport``,
+    e.g. a native async client or an in-memory stub.
+    """
+
+    def __init__(self, client, max_workers=10):
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _call(self, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(getattr(self._client, method), **kwargs))
+
+    async def receive_message(self, **kwargs):
+        return await self._call('receive_message', **kwargs)
+
+    async def delete_message(self, **kwargs):
+        return await self._call('delete_message', **kwargs)
+
+    async def delete_message_batch(self, **kwargs):
+        return await self._call('delete_message_batch', **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncDeleteBatcher(object):
+    """
+    asyncio counterpart of ``DeleteBatcher``: receipt handles are deleted in batches of up to 10, at most
+    `max_wait` seconds after they were added
+    """
+
+    def __init__(self, transport, queue_url, max_wait=0.05, max_retries=3, metrics=None):
+        self._transport = transport
+        self._queue_url = queue_url
+        self._max_wait = max_wait
+        self._max_retries = max_retries
+        self._metrics = metrics
+        self._pending = []
+        self._flusher = None
+        self._requests = set()
+
+    def add(self, receipt_handle):
+        self._pending.append(receipt_handle)
+        if len(self._pending) >= MAX_BATCH_ENTRIES:
+            self._spawn(self.flush())
+        elif self._flusher is None:
+            self._flusher = self._spawn(self._flush_later())
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+        return task
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self._max_wait)
+            await self.flush()
+        finally:
+            self._flusher = None
+
+    async def flush(self):
+        handles = self._pending
+        self._pending = []
+        await self.delete(handles)
+
+    async def close(self):
+        """
+        flush pending handles and wait for delete requests which are already running
+        """
+        await self.flush()
+        current = asyncio.current_task()
+        running = [task for task in self._requests if task is not current]
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def delete(self, receipt_handles):
+        await asyncio.gather(*[self._delete_chunk(chunk) for chunk in chunks(list(receipt_handles))])
+
+    async def _delete_chunk(self, receipt_handles):
+        entries = dict((str(i), handle) for i, handle in enumerate(receipt_handles))
+        attempt = 0
+        while entries:
+            started = time.time()
+            try:
+                response = await self._transport.delete_message_batch(
+                    QueueUrl=self._queue_url,
+                    Entries=[{'Id': i, 'ReceiptHandle': handle} for i, handle in entries.items()]
+                )
+            except Exception:
+                sqs_logger.exception("Unable to delete {} messages".format(len(entries)))
+                return
+            if self._metrics is not None:
+                self._metrics.timing(DELETE_LATENCY, time.time() - started)
+            retry = {}
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    sqs_logger.error("Unable to delete message: {} ({})".format(failure.get('Message'), failure.get('Code')))
+                else:
+                    retry[failure['Id']] = entries[failure['Id']]
+            attempt += 1
+            if retry and attempt > self._max_retries:
+                sqs_logger.error("Giving up on deleting {} messages after {} retries".format(len(retry), self._max_retries))
+                return
+            if retry:
+                await asyncio.sleep(min(0.1 * 2 ** (attempt - 1), 2))
+            entries = retry
+
+
+class AsyncSqsListener(SqsListener):
+    """
+    Listener which runs on an asyncio event loop.  Several long-polls are kept open at once to hide receive latency,
+    and each message is handled in its own task.  ``handle_message`` may be a regular method (it then runs in a thread)
+    or an ``async def`` coroutine.
+
+    Usage: ``asyncio.run(listener.listen())``
+    """
+
+    def __init__(self, queue, **kwargs):
+        """
+        :param queue: (str) name of queue to listen to
+        :param kwargs: the SqsListener options, plus:
+            poll_concurrency (int) - number of receive calls kept open at once. Set to 2 by default
+            handler_concurrency (int) - max number of messages handled at once. Set to 10 by default
+            transport - object providing coroutine versions of the sqs client calls. Defaults to a ThreadedTransport
+                        around the listener's boto3 client
+        """
+        self._poll_concurrency = kwargs.get('poll_concurrency', 2)
+        self._handler_concurrency = kwargs.get('handler_concurrency', 10)
+        self._transport = kwargs.get('transport', None)
+        SqsListener.__init__(self, queue, **kwargs)
+        if self._transport is None:
+            self._transport = ThreadedTransport(self._client, max_workers=self._poll_concurrency + self._handler_concurrency)
+        self._async_delete_batcher = None
+        self._slots = None
+        self._free_slots = 0
+        self._tasks = set()
+        self._loop = None
+        self._stopping = None
+
+    async def listen(self):
+        sqs_logger.info("Listening to queue " + self._queue_name)
+        if self._error_queue_name:
+            sqs_logger.info("Using error queue " + self._error_queue_name)
+
+        loop = asyncio.get_running_loop()
+        if not self._queues_resolved:
+            await loop.run_in_executor(None, self._resolve_queues)
+        self._loop = loop
+        self._stopping = asyncio.Event()
+        if self._stop_requested.is_set():
+            self._stopping.set()
+        signals = self._install_async_signal_handlers(loop)
+        self._slots = asyncio.Condition()
+        self._free_slots = self._handler_concurrency
+        self._async_delete_batcher = AsyncDeleteBatcher(
+            self._transport,
+            self._queue_url,
+            max_wait=self._delete_batch_wait or 0.05,
+            metrics=self._metrics
+        )
+        if self._heartbeat:
+            self._heartbeat.start()
+        if self._profiler is not None:
+            self._profiler.start()
+        pollers = [asyncio.ensure_future(self._poll()) for _ in range(self._poll_concurrency)]
+        try:
+            await asyncio.gather(*pollers)
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            for poller in pollers:
+                poller.cancel()
+            # drain: finish the messages already handed to handler tasks, within the shutdown timeout
+            if self._tasks:
+                _, pending = await asyncio.wait(set(self._tasks), timeout=self._shutdown_timeout)
+                if pending:
+                    sqs_logger.warning("Abandoning {} handler tasks after {} seconds".format(len(pending), self._shutdown_timeout))
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+            if self._heartbeat:
+                self._heartbeat.stop()
+            if self._profiler is not None:
+                self._profiler.stop()
+            await self._async_delete_batcher.close()
+            if self._error_publisher:
+                await asyncio.get_running_loop().run_in_executor(None, self._error_publisher.close)
+
+    def stop(self):
+        """
+        stop polling; listen() returns once in-flight messages are handled, or after `shutdown_timeout` seconds.
+        Safe to call from any thread
+        """
+        SqsListener.stop(self)
+        if self._stopping is not None:
+            self._loop.call_soon_threadsafe(asyncio.ensure_future, self._set_stopping())
+
+    async def _set_stopping(self):
+        self._stopping.set()
+        async with self._slots:
+            # wake up the pollers waiting for a free handler slot
+            self._slots.notify_all()
+
+    def _install_async_signal_handlers(self, loop):
+        """
+        :return: (list) the signals handled by the listener
+        """
+        if not self._handle_signals or threading.current_thread() is not threading.main_thread():
+            return []
+        installed = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self._handle_async_stop_signal, signum)
+            except (NotImplementedError, RuntimeError):
+                # not supported by this event loop, e.g. on windows
+                continue
+            installed.append(signum)
+        return installed
+
+    def _handle_async_stop_signal(self, signum):
+        if self._stopping.is_set():
+            sqs_logger.warning("Received signal {} again, cancelling {} handler tasks".format(signum, len(self._tasks)))
+            for task in list(self._tasks):
+                task.cancel()
+            return
+        sqs_logger.info("Received signal {}, stopping".format(signum))
+        self.stop()
+
+    async def _reserve_slots(self, wanted):
+        """
+        :return: (int) number of handler slots reserved, up to `wanted`.  0 once stopping
+        """
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._free_slots > 0 or self._stopping.is_set())
+            if self._stopping.is_set():
+                return 0
+            reserved = min(wanted, self._free_slots)
+            self._free_slots -= reserved
+            return reserved
+
+    async def _release_slots(self, count):
+        async with self._slots:
+            self._free_slots += count
+            self._slots.notify_all()
+
+    async def _poll(self):
+        while not self._stopping.is_set():
+            wait_time, max_number_of_messages = self._polling.receive_options()
+            reserved = await self._reserve_slots(max_number_of_messages)
+            if not reserved:
+                break
+            if self._rate_limiter is not None or self._circuit_breaker is not None:
+                allowed = self._govern(reserved)
+                if not allowed:
+                    # rate limited, or the circuit breaker is open: no receiving for now
+                    await self._release_slots(reserved)
+                    await self._sleep(self._governor_pause())
+                    continue
+                await self._release_slots(reserved - allowed)
+                reserved = allowed
+            if self._stopping.is_set():
+                # stopped while waiting for a slot: don't receive messages which would only be handed back
+                await self._release_slots(reserved)
+                self._ungovern(reserved)
+                break
+            started = time.time()
+            try:
+                messages = await self._transport.receive_message(
+                    QueueUrl=self._queue_url,
+                    MessageAttributeNames=self._message_attribute_names,
+                    AttributeNames=self._attribute_names,
+                    WaitTimeSeconds=wait_time,
+                    MaxNumberOfMessages=reserved
+                )
+            except Exception as ex:
+                await self._release_slots(reserved)
+                self._ungovern(reserved)
+                if self._metrics is not None:
+                    self._metrics.increment(RECEIVE_ERRORS)
+                try:
+                    pause = self._polling.on_error(ex)
+                except Exception:
+                    # a failed poll must not take the other pollers down with it
+                    sqs_logger.exception("Unable to receive messages")
+                    pause = self._poll_interval
+                await self._sleep(pause)
+                continue
+
+            received = messages.get('Messages', [])
+            if self._metrics is not None:
+                self._record_receive(started, len(received))
+            await self._release_slots(reserved - len(received))
+            self._ungovern(reserved - len(received))
+            if received and self._stopping.is_set():
+                # stopped while receiving: hand the messages straight back
+                await self._release_slots(len(received))
+                await asyncio.get_running_loop().run_in_executor(None, self._abandon, received)
+                break
+            if not received:
+                await self._sleep(self._polling.on_empty())
+                continue
+
+            pause = self._polling.on_messages(len(received))
+            sqs_logger.info("{} messages received".format(len(received)))
+            if self._force_delete:
+                await self._async_delete_batcher.delete([m['ReceiptHandle'] for m in received])
+            if self._heartbeat and not self._force_delete:
+                for m in received:
+                    self._heartbeat.register(m['ReceiptHandle'])
+            if self._fifo:
+                groups = OrderedDict()
+                for m in received:
+                    groups.setdefault((m.get('Attributes') or {}).get('MessageGroupId'), []).append(m)
+                handlers = [self._handle_group(group) for group in groups.values()]
+            else:
+                handlers = [self._handle(m) for m in received]
+            for handler in handlers:
+                task = asyncio.ensure_future(handler)
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            if pause:
+                await self._sleep(pause)
+
+    async def _run_handler_async(self, coroutine):
+        # sampling a thread's stack tells nothing about a coroutine, so coroutine handlers are only timed
+        if self._metrics is None and self._circuit_breaker is None:
+            return await coroutine
+        started = time.time()
+        try:
+            result = await coroutine
+        except Exception:
+            if self._metrics is not None:
+                self._metrics.increment(HANDLER_ERRORS)
+                self._metrics.timing(HANDLER_TIME, time.time() - started)
+            if self._circuit_breaker is not None:
+                self._circuit_breaker.record(time.time() - started, False)
+            raise
+        except BaseException:
+            # cancelled: no outcome
+            self._skip_breaker(1)
+            raise
+        if self._metrics is not None:
+            self._metrics.timing(HANDLER_TIME, time.time() - started)
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.record(time.time() - started, True)
+        return result
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _handle(self, m):
+        try:
+            await self._process_message_async(m)
+        except asyncio.CancelledError:
+            await self._release_cancelled(m)
+            raise
+        finally:
+            if self._heartbeat:
+                self._heartbeat.unregister(m['ReceiptHandle'])
+            await self._release_slots(1)
+
+    async def _handle_group(self, messages):
+        # FIFO mode: a group's messages are handled one after the other, different groups concurrently
+        pending = list(messages)
+        try:
+            while pending:
+                if self._stopping.is_set():
+                    await asyncio.get_running_loop().run_in_executor(None, self._abandon, list(pending))
+                    return
+                m = pending.pop(0)
+                try:
+                    handled = await self._process_message_async(m)
+                except asyncio.CancelledError:
+                    await self._release_cancelled(m)
+                    raise
+                finally:
+                    if self._heartbeat:
+                        self._heartbeat.unregister(m['ReceiptHandle'])
+                    await self._release_slots(1)
+                if not handled and not self._force_delete and pending:
+                    sqs_logger.warning("Message {} failed, releasing the {} following messages of its group".format(
+                        m.get('MessageId'), len(pending)))
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self._release_messages, [p['ReceiptHandle'] for p in pending]
+                    )
+                    return
+        finally:
+            for m in pending:
+                if self._heartbeat:
+                    self._heartbeat.unregister(m['ReceiptHandle'])
+                await self._release_slots(1)
+
+    async def _release_cancelled(self, m):
+        # the shutdown deadline expired while handling the message: hand it to other listeners right away
+        if not self._force_delete:
+            await asyncio.get_running_loop().run_in_executor(None, self._release_messages, [m['ReceiptHandle']])
+
+    async def _process_message_async(self, m):
+        """
+        :return: (boolean) True if the message was handled, or moved to the error queue because it can't be decoded
+        """
+        if self._dedup_store is not None and await asyncio.get_running_loop().run_in_executor(None, self._is_duplicate, m):
+            if not self._force_delete:
+                self._async_delete_batcher.add(m['ReceiptHandle'])
+            return True
+        loop = asyncio.get_running_loop()
+        try:
+            if self._blob_store is None:
+                deserialized = self._decode(m)
+            else:
+                # fetching the body from the blob store blocks
+                deserialized = await loop.run_in_executor(None, self._decode, m)
+        except Exception:
+            return await loop.run_in_executor(None, self._decode_failed, m, sys.exc_info(), self._force_delete)
+
+        message_attribs = m.get('MessageAttributes')
+        attribs = m.get('Attributes')
+        try:
+            if inspect.iscoroutinefunction(self.handle_message):
+                await self._run_handler_async(self.handle_message(deserialized, message_attribs, attribs))
+            else:
+                await loop.run_in_executor(
+                    None, self._run_handler, [m.get('MessageId')], self.handle_message, deserialized, message_attribs, attribs
+                )
+            if not self._force_delete:
+                self._async_delete_batcher.add(m['ReceiptHandle'])
+            if self._dedup_store is not None:
+                await loop.run_in_executor(None, self._remember, m)
+        except MessageDecodeError:
+            return await loop.run_in_executor(None, self._reject_undecodable, m, sys.exc_info(), self._force_delete)
+        except Exception as ex:
+            sqs_logger.exception(ex)
+            await loop.run_in_executor(None, self._handle_failure, m, sys.exc_info())
+            return False
+        return True
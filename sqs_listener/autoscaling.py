@@ -0,0 +1,149 @@
+"""
+queue depth driven scaling of the number of active workers
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+SCALE_UP = 'up'
+SCALE_DOWN = 'down'
+HOLD = 'hold'
+
+ScalingDecision = namedtuple(
+    'ScalingDecision',
+    ['time', 'action', 'previous', 'target', 'visible', 'not_visible', 'throughput']
+)
+ScalingDecision.__doc__ = """
+The outcome of one autoscaler evaluation, as passed to its `on_decision` callback.
+`visible` and `not_visible` are the sampled ApproximateNumberOfMessages and ApproximateNumberOfMessagesNotVisible;
+`throughput` is the number of messages the listener finished per second since the previous evaluation
+"""
+
+
+class WorkerAutoscaler(object):
+    """
+    Periodically samples the queue depth, and the listener's own throughput, and adjusts the number of active workers
+    between `min_workers` and `max_workers`.
+
+    The target is the number of workers needed to keep up with the current throughput while draining the visible
+    backlog within `target_drain_time` seconds, at the throughput per worker measured so far.  Scaling up happens as
+    soon as the target is higher (at most doubling per evaluation); scaling down only once the target stayed below
+    `scale_down_ratio` of the current workers for `scale_down_after` evaluations in a row, so that a short lull
+    doesn't shrink the pool right before the next burst.
+
+    Pass an instance as the listener's `autoscaler` kwarg; the listener's `workers` is the starting point.
+    """
+
+    def __init__(self, min_workers=1, max_workers=32, interval=15, target_drain_time=60, scale_down_ratio=0.75,
+                 scale_down_after=3, on_decision=None):
+        """
+        :param min_workers: (int)
+        :param max_workers: (int) also the size of the listener's thread pool
+        :param interval: (int|float) number of seconds between evaluations
+        :param target_drain_time: (int|float) number of seconds in which the visible backlog should be handled
+        :param scale_down_ratio: (float) see above
+        :param scale_down_after: (int) see above
+        :param on_decision: (function) called with a ScalingDecision after every evaluation
+        """
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError('Expected 1 <= min_workers <= max_workers')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.target_drain_time = target_drain_time
+        self.scale_down_ratio = scale_down_ratio
+        self.scale_down_after = scale_down_after
+        self._on_decision = on_decision
+        self._per_worker = None
+        self._low_evaluations = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def decide(self, workers, visible, not_visible, throughput):
+        """
+        :param workers: (int) number of active workers
+        :param visible: (int) messages waiting in the queue
+        :param not_visible: (int) messages in flight, in this listener or others
+        :param throughput: (float) messages finished per second by this listener
+        :return: (int) the number of workers to use from now on
+        """
+        if visible and throughput > 0 and workers:
+            # with a backlog every worker is busy, so this is what one worker handles per second
+            self._per_worker = throughput / float(workers)
+
+        if not visible and not not_visible:
+            desired = self.min_workers
+        elif not self._per_worker:
+            # nothing finished yet: no basis for an estimate
+            desired = workers * 2 if visible else workers
+        else:
+            needed = throughput + visible / float(self.target_drain_time)
+            desired = int(math.ceil(needed / self._per_worker))
+        desired = max(self.min_workers, min(self.max_workers, desired))
+
+        if desired > workers:
+            self._low_evaluations = 0
+            return min(desired, max(workers * 2, workers + 1))
+        if desired < workers * self.scale_down_ratio:
+            self._low_evaluations += 1
+            if self._low_evaluations >= self.scale_down_after:
+                self._low_evaluations = 0
+                return desired
+        else:
+            self._low_evaluations = 0
+        return workers
+
+    def start(self, listener):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(listener,), name='sqs-autoscaler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, listener):
+        last_time = time.time()
+        last_completed = listener.completed
+        while not self._stop.wait(self.interval):
+            try:
+                visible, not_visible = listener.queue_depth()
+            except Exception:
+                sqs_logger.exception("Unable to sample the queue depth")
+                continue
+            now = time.time()
+            completed = listener.completed
+            throughput = (completed - last_completed) / max(now - last_time, 1e-6)
+            last_time, last_completed = now, completed
+
+            workers = listener.active_workers
+            target = self.decide(workers, visible, not_visible, throughput)
+            action = SCALE_UP if target > workers else SCALE_DOWN if target < workers else HOLD
+            decision = ScalingDecision(now, action, workers, target, visible, not_visible, throughput)
+            if action != HOLD:
+                sqs_logger.info("Scaling workers {} from {} to {} (visible {}, not visible {}, {:.1f} msgs/s)".format(
+                    action, workers, target, visible, not_visible, throughput))
+                listener.scale_workers(target)
+            if self._on_decision is not None:
+                try:
+                    self._on_decision(decision)
+                except Exception:
+                    sqs_logger.exception("Scaling decision callback failed")
@@ -0,0 +1,220 @@
+"""
+batched acknowledgement (deletion) of handled messages
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import threading
+import time
+
+from sqs_listener.metrics import DELETE_LATENCY
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+# SQS accepts at most 10 entries per batch request
+MAX_BATCH_ENTRIES = 10
+
+
+def chunks(items, size=MAX_BATCH_ENTRIES):
+    """
+    split a list into consecutive slices of at most `size` items
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class DeleteBatcher(object):
+    """
+    Collects receipt handles of successfully handled messages and deletes them with ``delete_message_batch``.
+    Handles are flushed once `max_size` of them are pending, or once the oldest pending handle is older than
+    `max_wait` seconds.  A `max_wait` of 0 means the owner flushes after every receive.
+    """
+
+    def __init__(self, client, queue_url, max_size=MAX_BATCH_ENTRIES, max_wait=0, max_retries=3, metrics=None):
+        """
+        :param client: boto3 sqs client
+        :param queue_url: (str) url of the queue the handles belong to
+        :param max_size: (int) number of pending handles which triggers a flush
+        :param max_wait: (int|float) max number of seconds a handle may stay pending, across polls
+        :param max_retries: (int) number of times a failed batch entry is retried before giving up
+        :param metrics: (MetricsSink) reports the latency of every delete request
+        """
+        self._client = client
+        self._queue_url = queue_url
+        self._max_size = max(1, max_size)
+        self._max_wait = max_wait
+        self._max_retries = max_retries
+        self._metrics = metrics
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def add(self, receipt_handle):
+        """
+        queue a receipt handle for deletion, flushing if the size bound is reached
+        """
+        with self._lock:
+            self._pending.append(receipt_handle)
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._pending) >= self._max_size
+        if full:
+            self.flush()
+
+    def is_due(self):
+        with self._lock:
+            if not self._pending:
+                return False
+            if len(self._pending) >= self._max_size:
+                return True
+            return time.time() - self._oldest >= self._max_wait
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        """
+        delete all pending handles
+        """
+        with self._lock:
+            handles = self._pending
+            self._pending = []
+            self._oldest = None
+        self.delete(handles)
+
+    def delete(self, receipt_handles):
+        """
+        immediately delete the given receipt handles, bypassing the pending buffer.  Never raises: handles which can't be
+        deleted are logged and returned, and their messages will be delivered again
+        :param receipt_handles: (list) of str
+        :return: (list) receipt handles which could not be deleted
+        """
+        failed = []
+        for chunk in chunks(list(receipt_handles)):
+            failed.extend(self._delete_chunk(chunk))
+        return failed
+
+    def _delete_chunk(self, receipt_handles):
+        entries = dict((str(i), handle) for i, handle in enumerate(receipt_handles))
+        failed = []
+        attempt = 0
+        while entries:
+            started = time.time()
+            try:
+                response = self._client.delete_message_batch(
+                    QueueUrl=self._queue_url,
+                    Entries=[{'Id': i, 'ReceiptHandle': handle} for i, handle in entries.items()]
+                )
+            except Exception:
+                # e.g. a connection error: the whole request is retried, and never raised into the receive loop
+                sqs_logger.exception("Unable to delete {} messages".format(len(entries)))
+                response = {'Failed': [{'Id': i} for i in entries]}
+            if self._metrics is not None:
+                self._metrics.timing(DELETE_LATENCY, time.time() - started)
+            retry = {}
+            for failure in response.get('Failed', []):
+                handle = entries[failure['Id']]
+                if failure.get('SenderFault'):
+                    # an invalid or expired receipt handle will not succeed on retry
+                    sqs_logger.error("Unable to delete message: {} ({})".format(failure.get('Message'), failure.get('Code')))
+                    failed.append(handle)
+                else:
+                    retry[failure['Id']] = handle
+            attempt += 1
+            if retry and attempt > self._max_retries:
+                sqs_logger.error("Giving up on deleting {} messages after {} retries".format(len(retry), self._max_retries))
+                failed.extend(retry.values())
+                break
+            if retry:
+                sqs_logger.warning("Retrying deletion of {} messages".format(len(retry)))
+                time.sleep(min(0.1 * 2 ** (attempt - 1), 2))
+            entries = retry
+        return failed
+
+
+# SQS limit on the total payload of a single send_message_batch request
+MAX_BATCH_BYTES = 256 * 1024
+
+
+def entry_size(entry):
+    """
+    :return: (int) the number of bytes a send_message_batch entry counts against the payload limit
+    """
+    size = len(entry['MessageBody'].encode('utf-8'))
+    for name, attribute in entry.get('MessageAttributes', {}).items():
+        size += len(name.encode('utf-8')) + len(attribute.get('DataType', '').encode('utf-8'))
+        value = attribute.get('StringValue', attribute.get('BinaryValue', b''))
+        size += len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+    return size
+
+
+def pack_entries(entries, max_entries=MAX_BATCH_ENTRIES, max_bytes=MAX_BATCH_BYTES):
+    """
+    group send_message_batch entries into batches respecting both the entry count and the payload size limits.
+    `entries` may be a generator; it is consumed lazily, one batch at a time
+    """
+    batch = []
+    size = 0
+    for entry in entries:
+        current = entry_size(entry)
+        if batch and (len(batch) >= max_entries or size + current > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(entry)
+        size += current
+    if batch:
+        yield batch
+
+
+def _request_failure(ex):
+    # a Failed result entry standing for a request which raised, e.g. on throttling or a connection error
+    error = getattr(ex, 'response', None)
+    error = error.get('Error', {}) if isinstance(error, dict) else {}
+    return {'Code': error.get('Code', type(ex).__name__), 'Message': error.get('Message', str(ex)), 'SenderFault': False}
+
+
+def send_message_batch(client, queue_url, entries, max_retries=3):
+    """
+    send a single batch of entries, retrying the entries which failed on the server side, and the whole request if it
+    raised, with exponential backoff.  Never raises: entries still failing after `max_retries` retries are reported as
+    Failed
+    :param client: boto3 sqs client
+    :param queue_url: (str)
+    :param entries: (list) send_message_batch entries, with unique `Id`s
+    :param max_retries: (int)
+    :return: (dict) Id -> the Successful or Failed result entry returned by SQS
+    """
+    results = {}
+    pending = dict((entry['Id'], entry) for entry in entries)
+    attempt = 0
+    while pending:
+        try:
+            response = client.send_message_batch(QueueUrl=queue_url, Entries=list(pending.values()))
+        except Exception as ex:
+            sqs_logger.exception("Unable to send {} messages".format(len(pending)))
+            failure = _request_failure(ex)
+            response = {'Failed': [dict(failure, Id=i) for i in pending]}
+        for success in response.get('Successful', []):
+            results[success['Id']] = success
+            del pending[success['Id']]
+        retry = {}
+        for failure in response.get('Failed', []):
+            results[failure['Id']] = failure
+            if not failure.get('SenderFault'):
+                retry[failure['Id']] = pending[failure['Id']]
+        attempt += 1
+        if not retry or attempt > max_retries:
+            break
+        sqs_logger.warning("Retrying {} failed messages".format(len(retry)))
+        time.sleep(min(0.1 * 2 ** (attempt - 1), 2))
+        pending = retry
+    return results
@@ -0,0 +1,184 @@
+"""
+claim-check offloading of large message bodies
+
+The launcher stores bodies above a size threshold in a blob store and sends a small pointer instead; the listener
+fetches the body back before decoding it.  The pointer travels in the `claim-check` message attribute.
+"""
+
+# ================
+# start imports
+# ================
+
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from sqs_listener import registry
+from sqs_listener.batching import entry_size
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+CLAIM_CHECK_ATTRIBUTE = 'claim-check'
+
+# leaves room for message attributes below the 256 KiB SQS limit
+DEFAULT_OFFLOAD_THRESHOLD = 250 * 1024
+
+
+class BlobStore(object):
+    """
+    Base class for blob stores.  Subclass it to offload bodies to another backend.
+    """
+
+    def put(self, data):
+        """
+        :param data: (bytes)
+        :return: (str) the key the data can be fetched with
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        :return: (bytes)
+        """
+        raise NotImplementedError
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Stores blobs as files in a local directory.  Useful for testing, or for producers and consumers sharing a volume.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        if os.path.basename(key) != key or key in ('', '.', '..'):
+            raise ValueError('Invalid blob key ' + key)
+        return os.path.join(self._directory, key)
+
+    def put(self, data):
+        key = uuid.uuid4().hex
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        # never let a consumer see a partially written blob
+        os.rename(tmp_path, self._path(key))
+        return key
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+
+class S3BlobStore(BlobStore):
+    """
+    Stores blobs as objects in an S3 bucket.  Consider a lifecycle rule on the bucket (or prefix) to expire old blobs.
+    """
+
+    def __init__(self, bucket, prefix='', client=None, chunk_size=64 * 1024):
+        """
+        :param bucket: (str) bucket name
+        :param prefix: (str) prepended to every object key
+        :param client: a boto3 s3 client.  Defaults to one created from the shared session
+        :param chunk_size: (int) number of bytes read at a time when downloading
+        """
+        if client is None:
+            client = registry.get_session().client('s3')
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+        self._chunk_size = chunk_size
+
+    def put(self, data):
+        key = self._prefix + uuid.uuid4().hex
+        self._client.put_object(Bucket=self._bucket, Key=key, Body=data)
+        return key
+
+    def get(self, key):
+        body = self._client.get_object(Bucket=self._bucket, Key=key)['Body']
+        try:
+            return b''.join(body.iter_chunks(self._chunk_size))
+        finally:
+            body.close()
+
+
+class CachingBlobStore(BlobStore):
+    """
+    Wraps a blob store, keeping recently fetched blobs in memory (up to `max_bytes`), so redelivered messages don't
+    download their body again.
+    """
+
+    def __init__(self, store, max_bytes=64 * 1024 * 1024):
+        self._store = store
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        return self._store.put(data)
+
+    def get(self, key):
+        with self._lock:
+            data = self._cache.pop(key, None)
+            if data is not None:
+                self._cache[key] = data
+                return data
+        data = self._store.get(key)
+        if len(data) <= self._max_bytes:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._size += len(data)
+                while self._size > self._max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._size -= len(evicted)
+        return data
+
+
+def offload_entry(entry, store, threshold=DEFAULT_OFFLOAD_THRESHOLD):
+    """
+    replace the body of a send_message entry with a pointer, if it is larger than `threshold` bytes
+    :param entry: (dict) send_message arguments, including MessageBody and optionally MessageAttributes
+    :return: (dict) the entry, possibly modified
+    """
+    if entry_size(entry) <= threshold:
+        return entry
+    key = store.put(entry['MessageBody'].encode('utf-8'))
+    sqs_logger.info("Offloaded message body to blob {}".format(key))
+    entry = dict(entry)
+    entry['MessageBody'] = json.dumps({'claim_check': key})
+    entry['MessageAttributes'] = dict(
+        entry.get('MessageAttributes', {}),
+        **{CLAIM_CHECK_ATTRIBUTE: {'DataType': 'String', 'StringValue': key}}
+    )
+    return entry
+
+
+def claim_check_key(message):
+    """
+    :return: (str) the blob key of a message received from SQS, or None if its body wasn't offloaded
+    """
+    attribute = (message.get('MessageAttributes') or {}).get(CLAIM_CHECK_ATTRIBUTE)
+    if attribute is None:
+        return None
+    return attribute.get('StringValue')
+
+
+def retrieve_body(message, store):
+    """
+    :return: (dict) the message, with its original body fetched back from the store if it was offloaded
+    """
+    key = claim_check_key(message)
+    if key is None:
+        return message
+    return dict(message, Body=store.get(key).decode('utf-8'))
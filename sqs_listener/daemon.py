@@ -6,7 +6,8 @@ import sys
 import os
 import time
 import atexit
-from signal import SIGTERM
+import errno
+from signal import SIGKILL, SIGTERM
 
 
 class Daemon:
@@ -16,12 +17,15 @@ class Daemon:
     Usage: subclass the Daemon class and override the run() method
     """
 
-    def __init__(self, pidfile, overwrite=False, stdout='/dev/stdout', stderr='/dev/stderr', stdin='/dev/null'):
+    def __init__(self, pidfile, overwrite=False, stdout='/dev/stdout', stderr='/dev/stderr', stdin='/dev/null',
+                 stop_timeout=30):
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
         self.pidfile = pidfile
         self.overwrite_output = overwrite
+        # number of seconds stop() waits for the daemon to drain and exit, before killing it
+        self.stop_timeout = stop_timeout
 
     def daemonize(self):
         """
@@ -104,9 +108,10 @@ class Daemon:
         self.daemonize()
         self.run()
 
-    def stop(self):
+    def stop(self, timeout=None):
         """
-        Stop the daemon
+        Stop the daemon: send it SIGTERM, so a listener can finish the messages it's handling, and kill it if it's
+        still running after `timeout` seconds (`stop_timeout` by default)
         """
         # Get the pid from the pidfile
         try:
@@ -123,14 +128,22 @@ class Daemon:
             sys.stderr.write(message % self.pidfile)
             return  # not an error in a restart
 
-        # Try killing the daemon process
+        # Try stopping the daemon process
         try:
-            while 1:
-                os.kill(pid, SIGTERM)
+            os.kill(pid, SIGTERM)
+            deadline = time.time() + (self.stop_timeout if timeout is None else timeout)
+            while time.time() < deadline:
                 time.sleep(0.1)
+                os.kill(pid, 0)
+            sys.stderr.write("daemon did not stop within its timeout, killing it\n")
+            os.kill(pid, SIGKILL)
+            for _ in range(50):
+                time.sleep(0.1)
+                os.kill(pid, 0)
+            sys.stderr.write("daemon process %d still exists after being killed\n" % pid)
+            sys.exit(1)
         except OSError as err:
-            err = str(err)
-            if err.find("No such process") > 0:
+            if err.errno == errno.ESRCH:
                 if os.path.exists(self.pidfile):
                     os.remove(self.pidfile)
             else:
@@ -0,0 +1,165 @@
+"""
+duplicate suppression for at-least-once delivery
+
+The listener looks up the key of every received message in a dedup store before handling it.  A message whose key is
+already there was handled before: it is deleted without calling the handler.  Keys are added once a handler succeeds,
+so a message which failed is still retried.  Two deliveries of the same message handled at the same moment (e.g. by
+two listeners) can both get through; the store suppresses the redeliveries which arrive after a message was handled.
+redis is used by RedisDedupStore when installed.
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+
+def message_id_key(m):
+    """
+    the default dedup key: the MessageId assigned by SQS, which is the same for every delivery of a message
+    """
+    return m['MessageId']
+
+
+class DedupStore(object):
+    """
+    Base class for dedup stores.  Subclass it to keep the keys in another backend.  Must be thread safe.
+    """
+
+    def contains(self, key):
+        """
+        :param key: (str)
+        :return: (boolean) True if the key was added, and didn't expire yet
+        """
+        raise NotImplementedError
+
+    def add(self, key):
+        raise NotImplementedError
+
+
+class MemoryDedupStore(DedupStore):
+    """
+    Keeps up to `max_size` keys in memory, dropping the least recently added ones first.  Only suppresses the
+    duplicates delivered to this process.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        :param max_size: (int)
+        :param ttl: (int|float) number of seconds a key is kept.  Not set by default: keys are only dropped for room
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        # key -> expiry time, oldest first
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def contains(self, key):
+        with self._lock:
+            expires = self._keys.get(key, None)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._keys[key]
+                return False
+            return True
+
+    def add(self, key):
+        expires = time.time() + self._ttl if self._ttl is not None else float('inf')
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = expires
+            while len(self._keys) > self._max_size:
+                self._keys.popitem(last=False)
+
+
+class SqliteDedupStore(DedupStore):
+    """
+    Keeps the keys in an SQLite database, shared by the listeners of one host and kept across restarts.
+    """
+
+    def __init__(self, path, ttl=86400, table='sqs_dedup'):
+        """
+        :param path: (str) database file, created if needed
+        :param ttl: (int|float) number of seconds a key is kept.  Should be longer than the queue's retention period
+                    for full protection.  Set to one day by default
+        :param table: (str)
+        """
+        self._ttl = ttl
+        self._table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._last_purge = 0
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, expires REAL NOT NULL)'.format(self._table)
+            )
+
+    def contains(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM {} WHERE key = ? AND expires >= ?'.format(self._table), (key, time.time())
+            ).fetchone()
+        return row is not None
+
+    def add(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO {} (key, expires) VALUES (?, ?)'.format(self._table), (key, now + self._ttl)
+            )
+            if now - self._last_purge > 60:
+                self._last_purge = now
+                self._connection.execute('DELETE FROM {} WHERE expires < ?'.format(self._table), (now,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class RedisDedupStore(DedupStore):
+    """
+    Keeps the keys in Redis, shared by every listener of the queue.  Keys expire through Redis' own TTL.
+    """
+
+    def __init__(self, client=None, url=None, ttl=86400, prefix='sqs-dedup:'):
+        """
+        :param client: a redis client (e.g. redis.Redis), or any object with compatible `exists` and `set` methods
+        :param url: (str) with no client, connect to this url.  Requires the redis package
+        :param ttl: (int) number of seconds a key is kept.  Set to one day by default
+        :param prefix: (str) prepended to every key
+        """
+        if client is None:
+            if url is None:
+                raise ValueError('Either a client or a url is required')
+            if redis is None:
+                raise ImportError('RedisDedupStore requires the redis package')
+            client = redis.Redis.from_url(url)
+        self._client = client
+        self._ttl = int(ttl)
+        self._prefix = prefix
+
+    def contains(self, key):
+        return bool(self._client.exists(self._prefix + key))
+
+    def add(self, key):
+        self._client.set(self._prefix + key, 1, ex=self._ttl)
@@ -0,0 +1,216 @@
+"""
+background publishing of error records to the error queue
+"""
+
+# ================
+# start imports
+# ================
+
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from sqs_listener.batching import MAX_BATCH_BYTES, MAX_BATCH_ENTRIES, entry_size, send_message_batch
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+_STOP = object()
+
+# message attribute carrying the error record of a message too large to be wrapped in one
+ERROR_ATTRIBUTE = 'sqs-listener-error'
+
+# SQS limits on a single message
+MAX_MESSAGE_BYTES = 256 * 1024
+MAX_MESSAGE_ATTRIBUTES = 10
+
+
+class RecordTooLarge(ValueError):
+    """
+    raised by ErrorPublisher.publish() for a record which can't fit in an SQS message
+    """
+
+
+def _json_default(value):
+    # binary message attributes
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    return str(value)
+
+
+def serialize_record(record):
+    return json.dumps(record, default=_json_default)
+
+
+def error_record(message, exc_info):
+    """
+    build the error queue record for a message whose handler raised
+    :param message: (dict) the message as received from SQS
+    :param exc_info: the sys.exc_info() tuple
+    :return: (dict)
+    """
+    exc_type, ex, exc_tb = exc_info
+    return {
+        'exception_type': str(exc_type),
+        'error_message': str(ex.args),
+        'traceback': ''.join(traceback.format_exception(exc_type, ex, exc_tb)),
+        'body': message.get('Body'),
+        'message_attributes': message.get('MessageAttributes'),
+        'attributes': message.get('Attributes'),
+        'message_id': message.get('MessageId')
+    }
+
+
+def error_entry(record, serializer=serialize_record):
+    """
+    build the send_message_batch entry (without an Id) for an error record.  Escaping the message body inside the record
+    can push it past the SQS size limit: such a record is sent as the original body, unchanged, with its original
+    message attributes and the rest of the record serialized in the ``sqs-listener-error`` attribute.  The traceback is
+    dropped if that is still too large.
+    :param record: (dict) see error_record()
+    :param serializer: (function dict -> str)
+    :return: (dict)
+    :raises RecordTooLarge: if the record doesn't fit either way
+    """
+    entry = {'MessageBody': serializer(record)}
+    if entry_size(entry) <= MAX_MESSAGE_BYTES:
+        return entry
+    body = record.get('body')
+    attributes = dict(
+        (name, dict((key, value) for key, value in attribute.items()
+                    if key in ('DataType', 'StringValue', 'BinaryValue')))
+        for name, attribute in (record.get('message_attributes') or {}).items()
+    )
+    if body is not None and len(attributes) < MAX_MESSAGE_ATTRIBUTES:
+        metadata = dict((key, value) for key, value in record.items() if key not in ('body', 'message_attributes'))
+        for trimmed in (metadata, dict(metadata, traceback=None)):
+            attributes[ERROR_ATTRIBUTE] = {'DataType': 'String', 'StringValue': serializer(trimmed)}
+            entry = {'MessageBody': body, 'MessageAttributes': attributes}
+            if entry_size(entry) <= MAX_MESSAGE_BYTES:
+                return entry
+    raise RecordTooLarge('error record for message {} is too large for SQS'.format(record.get('message_id')))
+
+
+class ErrorPublisher(object):
+    """
+    Created once per listener.  Error records are put on a bounded in-memory queue and sent from a background thread
+    with ``send_message_batch``, so a burst of failures costs one request per 10 records instead of a new client and a
+    queue lookup per record.  When the queue is full, records are dropped after `put_timeout` seconds rather than
+    stalling the receive loop.
+    """
+
+    def __init__(self, client, queue_url, serializer=serialize_record, max_queued=1000, put_timeout=1, max_wait=0.5,
+                 max_retries=3, on_sent=None):
+        """
+        :param client: boto3 sqs client
+        :param queue_url: (str) url of the error queue
+        :param serializer: (function dict -> str) used to serialize the error records
+        :param max_queued: (int) max number of records waiting to be sent
+        :param put_timeout: (int|float) max number of seconds publish() blocks on a full queue before dropping the record
+        :param max_wait: (int|float) max number of seconds a record waits for a batch to fill up
+        :param max_retries: (int) number of times failed batch entries are retried
+        :param on_sent: (function list -> None) called from the background thread after every batch, with the tokens
+                        of the records in it which reached the error queue
+        """
+        self._client = client
+        self._queue_url = queue_url
+        self._serializer = serializer
+        self._records = queue.Queue(maxsize=max_queued)
+        self._put_timeout = put_timeout
+        self._max_wait = max_wait
+        self._max_retries = max_retries
+        self._on_sent = on_sent
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, record, token=None):
+        """
+        queue a record for the error queue
+        :param record: (dict)
+        :param token: passed to `on_sent` once the record was sent.  Records without a token aren't reported
+        :return: (boolean) False if the record was dropped
+        :raises RecordTooLarge: if the record can't fit in an SQS message
+        """
+        entry = error_entry(record, self._serializer)
+        self._ensure_thread()
+        try:
+            self._records.put((entry, token), timeout=self._put_timeout)
+        except queue.Full:
+            sqs_logger.error("Error queue buffer full, dropping error record")
+            return False
+        return True
+
+    def close(self, timeout=None):
+        """
+        send the records already queued, and stop the background thread
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._records.put(_STOP)
+        thread.join(timeout)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqs-error-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._records.get()
+            if item is _STOP:
+                return
+            entry, token = item
+            batch = [entry]
+            tokens = [token]
+            size = entry_size(entry)
+            deadline = time.time() + self._max_wait
+            while len(batch) < MAX_BATCH_ENTRIES:
+                try:
+                    item = self._records.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                entry, token = item
+                current = entry_size(entry)
+                if size + current > MAX_BATCH_BYTES:
+                    self._send(batch, tokens)
+                    batch, tokens, size = [], [], 0
+                batch.append(entry)
+                tokens.append(token)
+                size += current
+            self._send(batch, tokens)
+
+    def _send(self, batch, tokens):
+        entries = [dict(entry, Id=str(i)) for i, entry in enumerate(batch)]
+        try:
+            results = send_message_batch(self._client, self._queue_url, entries, max_retries=self._max_retries)
+        except Exception:
+            sqs_logger.exception("Unable to push {} records to error queue".format(len(entries)))
+            return
+        sent = []
+        for i, token in enumerate(tokens):
+            result = results.get(str(i), {})
+            if 'Code' in result:
+                sqs_logger.error("Error queue rejected record: {} ({})".format(result.get('Message'), result.get('Code')))
+            elif 'MessageId' in result and token is not None:
+                sent.append(token)
+        if sent and self._on_sent is not None:
+            try:
+                self._on_sent(sent)
+            except Exception:
+                sqs_logger.exception("Error queue callback failed")
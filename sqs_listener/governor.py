@@ -0,0 +1,257 @@
+"""
+throughput governors for the listener: a token bucket rate limit, and a circuit breaker which stops receiving while
+the handlers' downstream dependencies are failing
+
+Both hand out an allowance of messages before every receive (take), and get back what wasn't received (give_back).
+"""
+
+# ================
+# start imports
+# ================
+
+import collections
+import logging
+import threading
+import time
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BreakerEvent = collections.namedtuple('BreakerEvent', ['time', 'previous', 'state', 'reason'])
+BreakerEvent.__doc__ = """
+A circuit breaker state transition, as passed to its `on_state_change` callbacks
+"""
+
+_OK = 0
+_ERROR = 1
+_SLOW = 2
+
+
+class TokenBucket(object):
+    """
+    Limits the number of messages received per second.  The bucket holds up to `capacity` tokens and is refilled at
+    `rate` tokens per second; every received message takes one.  Thread safe, so one bucket can be shared by several
+    listeners to limit them together.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: (int|float) messages per second
+        :param capacity: (int) max burst.  Set to one second's worth of messages, at least 1, by default
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, wanted):
+        """
+        :return: (int) number of tokens taken, up to `wanted`.  0 if the bucket is empty; never blocks
+        """
+        with self._lock:
+            self._refill()
+            taken = min(wanted, int(self._tokens))
+            self._tokens -= taken
+            return taken
+
+    def give_back(self, count):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + count)
+
+    def retry_after(self):
+        """
+        :return: (float) number of seconds until a token is available
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+
+class CircuitBreaker(object):
+    """
+    Watches the outcome of the handler calls.  Once at least `min_calls` of the last `window` calls were recorded, and
+    the share of calls which raised, or took longer than `latency_threshold` seconds, reaches `error_rate`, the
+    breaker opens: the listener stops receiving altogether, instead of feeding messages to a dependency which is
+    struggling.
+
+    After `reset_timeout` seconds the breaker is half open: `probes` messages are let through.  When they all succeed,
+    twice as many are let through, and so on, until a step of `window` messages succeeded and the breaker closes
+    again.  Any failure while half open opens the breaker again.  Probes which never reach the handler (e.g.
+    undecodable or duplicate messages) are handed back with give_back(); if a step still makes no progress for
+    `probe_timeout` seconds, its probes are let through again.
+
+    Every state transition is logged and passed to the `on_state_change` callbacks as a BreakerEvent.  Pass an
+    instance as the listener's `circuit_breaker` kwarg.
+    """
+
+    def __init__(self, error_rate=0.5, latency_threshold=None, window=20, min_calls=10, reset_timeout=30, probes=1,
+                 probe_timeout=None, on_state_change=None):
+        """
+        :param error_rate: (float) share of failed calls which opens the breaker, between 0 and 1
+        :param latency_threshold: (float) calls taking longer than this number of seconds count as failed.  Not set by
+                                  default
+        :param window: (int) number of recent calls considered
+        :param min_calls: (int) number of calls needed before the breaker opens
+        :param reset_timeout: (int|float) number of seconds the breaker stays open before probing
+        :param probes: (int) number of messages let through by the first half open step
+        :param probe_timeout: (int|float) see above.  Set to `reset_timeout` by default
+        :param on_state_change: (function) called with a BreakerEvent on every transition
+        """
+        if not 0 < error_rate <= 1:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.error_rate = error_rate
+        self.latency_threshold = latency_threshold
+        self.window = window
+        self.min_calls = min(min_calls, window)
+        self.reset_timeout = reset_timeout
+        self.probes = max(1, probes)
+        self.probe_timeout = reset_timeout if probe_timeout is None else probe_timeout
+        self._callbacks = [on_state_change] if on_state_change is not None else []
+        self._state = CLOSED
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._step = self.probes
+        self._step_taken = 0
+        self._step_succeeded = 0
+        self._step_progress = None
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """
+        :param callback: (function) called with a BreakerEvent on every state transition
+        """
+        self._callbacks.append(callback)
+
+    @property
+    def state(self):
+        with self._lock:
+            event = self._check_timeout()
+        self._emit(event)
+        return self._state
+
+    def take(self, wanted):
+        """
+        :return: (int) number of messages which may be received now, up to `wanted`.  0 while the breaker is open
+        """
+        with self._lock:
+            event = self._check_timeout()
+            if self._state == CLOSED:
+                taken = wanted
+            elif self._state == OPEN:
+                taken = 0
+            else:
+                if self._step_taken >= self._step and time.time() - self._step_progress >= self.probe_timeout:
+                    # the outcome of the probes never came back: probe again rather than stall
+                    sqs_logger.warning("Circuit breaker probes got no outcome in {} seconds, probing again".format(
+                        self.probe_timeout))
+                    self._step_taken = self._step_succeeded
+                    self._step_progress = time.time()
+                taken = max(0, min(wanted, self._step - self._step_taken))
+                if taken:
+                    self._step_taken += taken
+                    self._step_progress = time.time()
+        self._emit(event)
+        return taken
+
+    def give_back(self, count):
+        """
+        return an allowance which wasn't used: messages which weren't received, or never reached the handler
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._step_taken = max(0, self._step_taken - count)
+
+    def retry_after(self):
+        """
+        :return: (float) number of seconds after which take() may let messages through again
+        """
+        with self._lock:
+            if self._state == OPEN:
+                return max(0.0, self._opened_at + self.reset_timeout - time.time())
+        # while half open, the outcome of the probes can come in any moment
+        return 0.0
+
+    def record(self, duration, success=True, count=1):
+        """
+        record the outcome of a handler call
+        :param duration: (float) seconds
+        :param success: (boolean) False if the handler raised
+        :param count: (int) number of messages the call handled
+        """
+        if not success:
+            outcome = _ERROR
+        elif self.latency_threshold is not None and duration > self.latency_threshold:
+            outcome = _SLOW
+        else:
+            outcome = _OK
+
+        event = None
+        with self._lock:
+            if self._state == CLOSED:
+                self._outcomes.extend([outcome] * count)
+                failed = sum(1 for o in self._outcomes if o != _OK)
+                if len(self._outcomes) >= self.min_calls and failed >= self.error_rate * len(self._outcomes):
+                    slow = sum(1 for o in self._outcomes if o == _SLOW)
+                    event = self._transition(OPEN, '{} errors and {} slow calls in the last {} calls'.format(
+                        failed - slow, slow, len(self._outcomes)))
+            elif self._state == HALF_OPEN:
+                if outcome != _OK:
+                    event = self._transition(OPEN, 'probe {}'.format('failed' if outcome == _ERROR else 'too slow'))
+                else:
+                    self._step_succeeded += count
+                    self._step_progress = time.time()
+                    if self._step_succeeded >= self._step:
+                        if self._step >= self.window:
+                            event = self._transition(CLOSED, '{} probes succeeded'.format(self._step))
+                        else:
+                            self._step_taken = 0
+                            self._step_succeeded = 0
+                            self._step = min(self.window, self._step * 2)
+            # calls finishing while the breaker is open were let through before it opened, and tell nothing new
+        self._emit(event)
+
+    def _check_timeout(self):
+        if self._state == OPEN and time.time() - self._opened_at >= self.reset_timeout:
+            return self._transition(HALF_OPEN, 'probing after {} seconds'.format(self.reset_timeout))
+        return None
+
+    def _transition(self, state, reason):
+        # called holding the lock
+        event = BreakerEvent(time.time(), self._state, state, reason)
+        self._state = state
+        if state == OPEN:
+            self._opened_at = event.time
+        elif state == HALF_OPEN:
+            self._step = self.probes
+            self._step_taken = 0
+            self._step_succeeded = 0
+            self._step_progress = event.time
+        else:
+            self._outcomes.clear()
+        return event
+
+    def _emit(self, event):
+        if event is None:
+            return
+        log = sqs_logger.warning if event.state == OPEN else sqs_logger.info
+        log("Circuit breaker {} -> {}: {}".format(event.previous, event.state, event.reason))
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception:
+                sqs_logger.exception("Circuit breaker callback failed")
@@ -0,0 +1,103 @@
+"""
+visibility timeout heartbeat, keeping long-running messages invisible while they're handled
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import threading
+import time
+
+from sqs_listener.batching import chunks
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+
+class VisibilityHeartbeat(object):
+    """
+    Registry of in-flight receipt handles.  A background thread extends the visibility of every registered handle
+    with ``change_message_visibility_batch`` once every `interval` seconds, until the handle is unregistered (the message
+    was deleted or failed).  This allows a short base visibility timeout, so messages of a crashed listener are quickly
+    redelivered, without slow handlers having their messages redelivered while still running.
+    """
+
+    def __init__(self, client, queue_url, visibility_timeout=60, interval=None):
+        """
+        :param client: boto3 sqs client
+        :param queue_url: (str)
+        :param visibility_timeout: (int) number of seconds each extension keeps the message invisible
+        :param interval: (int|float) number of seconds between extensions of a message.  Should be shorter than the
+                         queue's own visibility timeout.  Defaults to a third of `visibility_timeout`
+        """
+        self._client = client
+        self._queue_url = queue_url
+        self._visibility_timeout = int(visibility_timeout)
+        self._interval = interval or self._visibility_timeout / 3.0
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, receipt_handle):
+        with self._lock:
+            self._handles[receipt_handle] = time.time()
+
+    def unregister(self, receipt_handle):
+        with self._lock:
+            self._handles.pop(receipt_handle, None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sqs-visibility-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        tick = min(1.0, self._interval / 2.0)
+        while not self._stop.wait(tick):
+            now = time.time()
+            with self._lock:
+                due = [handle for handle, extended in self._handles.items() if now - extended >= self._interval]
+            for chunk in chunks(due):
+                try:
+                    self.extend(chunk)
+                except Exception:
+                    sqs_logger.exception("Unable to extend visibility of {} messages".format(len(chunk)))
+
+    def extend(self, receipt_handles):
+        """
+        extend the visibility of the given handles right away
+        """
+        entries = dict((str(i), handle) for i, handle in enumerate(receipt_handles))
+        response = self._client.change_message_visibility_batch(
+            QueueUrl=self._queue_url,
+            Entries=[
+                {'Id': i, 'ReceiptHandle': handle, 'VisibilityTimeout': self._visibility_timeout}
+                for i, handle in entries.items()
+            ]
+        )
+        now = time.time()
+        with self._lock:
+            for success in response.get('Successful', []):
+                handle = entries[success['Id']]
+                if handle in self._handles:
+                    self._handles[handle] = now
+            for failure in response.get('Failed', []):
+                # usually the message was deleted in the meantime, or its handle expired
+                sqs_logger.warning("Unable to extend visibility: {} ({})".format(failure.get('Message'), failure.get('Code')))
+                if failure.get('SenderFault'):
+                    self._handles.pop(entries[failure['Id']], None)
@@ -0,0 +1,70 @@
+"""
+message containers for batch handlers
+"""
+
+# ================
+# start imports
+# ================
+
+import time
+from collections import namedtuple
+
+# ================
+# start class
+# ================
+
+BatchMessage = namedtuple('BatchMessage', ['body', 'message_attributes', 'attributes', 'message_id'])
+BatchMessage.__doc__ = """
+A deserialized message, as passed to ``SqsListener.handle_messages``.
+`body` is the deserialized body; `message_attributes` and `attributes` are the MessageAttributes and Attributes
+returned by SQS (or None)
+"""
+
+
+class MessageAccumulator(object):
+    """
+    Collects received messages into micro-batches, across polls.  A batch is ready once `max_size` messages are
+    collected, or once the oldest collected message is `max_wait` seconds old.  With no `max_size`, batches are
+    bounded by time only.
+    """
+
+    def __init__(self, max_size, max_wait=0):
+        self._max_size = max_size
+        self._max_wait = max_wait
+        self._messages = []
+        self._started = None
+
+    def add(self, messages):
+        """
+        :param messages: (list) messages as received from SQS
+        :return: (list) of batches which are ready to be handled
+        """
+        if not self._messages:
+            self._started = time.time()
+        self._messages.extend(messages)
+        ready = []
+        while self._max_size and len(self._messages) >= self._max_size:
+            ready.append(self._messages[:self._max_size])
+            self._messages = self._messages[self._max_size:]
+            self._started = time.time()
+        due = self.due()
+        if due:
+            ready.append(due)
+        return ready
+
+    def due(self):
+        """
+        :return: (list) all collected messages if the oldest one is `max_wait` seconds old, otherwise an empty list
+        """
+        if self._messages and time.time() - self._started >= self._max_wait:
+            return self.drain()
+        return []
+
+    def drain(self):
+        """
+        :return: (list) all collected messages, regardless of the bounds
+        """
+        messages = self._messages
+        self._messages = []
+        self._started = None
+        return messages
@@ -0,0 +1,265 @@
+"""
+metrics sinks and a slow handler profiler for the listener's receive / handle / delete loop
+
+A listener reports to the sink passed as its `metrics` kwarg.  Without one, the loop skips instrumentation entirely.
+prometheus_client is used by PrometheusMetrics when installed.
+"""
+
+# ================
+# start imports
+# ================
+
+import collections
+import logging
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+# metric names
+RECEIVES = 'receives'  # counter, every receive call
+EMPTY_RECEIVES = 'empty_receives'  # counter, receives which returned no messages
+RECEIVE_ERRORS = 'receive_errors'  # counter
+MESSAGES_RECEIVED = 'messages_received'  # counter
+RECEIVE_LATENCY = 'receive_latency'  # timing, seconds per receive call
+DECODE_TIME = 'decode_time'  # timing, seconds per message body
+HANDLER_TIME = 'handler_time'  # timing, seconds per handle_message / handle_messages call
+HANDLER_ERRORS = 'handler_errors'  # counter
+DELETE_LATENCY = 'delete_latency'  # timing, seconds per delete_message(_batch) call
+ERROR_QUEUE_PUSHES = 'error_queue_pushes'  # counter
+IN_FLIGHT = 'in_flight'  # gauge, messages received but not finished
+SLOW_HANDLERS = 'slow_handlers'  # counter
+RETRIES = 'retries'  # counter, failed messages scheduled for another delivery by the retry policy
+DUPLICATES = 'duplicates'  # counter, messages deleted by the dedup store without being handled
+
+
+class MetricsSink(object):
+    """
+    Base class for metrics sinks.  Subclass it to report to another backend; every method may be called from several
+    threads at once.
+    """
+
+    def increment(self, name, value=1):
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        """
+        record one observation of a duration (a histogram)
+        """
+        raise NotImplementedError
+
+    def gauge(self, name, value):
+        raise NotImplementedError
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    Keeps every counter, gauge and timing in memory.  Meant for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.timings = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def percentile(self, name, percent):
+        """
+        :return: (float) the given percentile (0-100) of a timing, or None if it has no observations
+        """
+        with self._lock:
+            values = sorted(self.timings.get(name, []))
+        if not values:
+            return None
+        index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+        return values[index]
+
+    @property
+    def empty_receive_ratio(self):
+        with self._lock:
+            receives = self.counters.get(RECEIVES, 0)
+            if not receives:
+                return 0.0
+            return self.counters.get(EMPTY_RECEIVES, 0) / float(receives)
+
+
+class StatsdMetrics(MetricsSink):
+    """
+    Sends metrics to a StatsD (or DogStatsD / Telegraf) server over UDP.  Timings are sent in milliseconds.
+    Sending never blocks or raises; metrics are dropped on errors.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='sqs_listener'):
+        self._address = (host, port)
+        self._prefix = prefix + '.' if prefix else ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, value, kind):
+        try:
+            self._socket.sendto('{}{}:{}|{}'.format(self._prefix, name, value, kind).encode('ascii'), self._address)
+        except (socket.error, OSError):
+            pass
+
+    def increment(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def timing(self, name, seconds):
+        self._send(name, int(round(seconds * 1000)), 'ms')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+    def close(self):
+        self._socket.close()
+
+
+class PrometheusMetrics(MetricsSink):
+    """
+    Reports to prometheus_client metrics, created on first use: counters as ``<namespace>_<name>_total``, timings as
+    ``<namespace>_<name>_seconds`` histograms, and gauges.  Expose them with ``prometheus_client.start_http_server``.
+    """
+
+    def __init__(self, namespace='sqs_listener', registry=None, buckets=None):
+        """
+        :param namespace: (str) prefix of every metric name
+        :param registry: prometheus_client registry.  Defaults to the global one
+        :param buckets: (list) histogram buckets, in seconds.  Defaults to prometheus_client's
+        """
+        if prometheus_client is None:
+            raise ImportError('PrometheusMetrics requires the prometheus_client package')
+        self._namespace = namespace
+        self._registry = registry if registry is not None else prometheus_client.REGISTRY
+        self._buckets = buckets
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, kind, name, **kwargs):
+        metric = self._metrics.get((kind, name))
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get((kind, name))
+                if metric is None:
+                    metric = kind(name, name.replace('_', ' '), namespace=self._namespace, registry=self._registry, **kwargs)
+                    self._metrics[(kind, name)] = metric
+        return metric
+
+    def increment(self, name, value=1):
+        self._metric(prometheus_client.Counter, name).inc(value)
+
+    def timing(self, name, seconds):
+        kwargs = {'buckets': self._buckets} if self._buckets else {}
+        self._metric(prometheus_client.Histogram, name + '_seconds', **kwargs).observe(seconds)
+
+    def gauge(self, name, value):
+        self._metric(prometheus_client.Gauge, name).set(value)
+
+
+class SlowHandlerProfiler(object):
+    """
+    A sampling profiler for slow handlers.  A background thread watches the running handlers; once a handler has run
+    longer than `threshold` seconds, the stack of its thread is sampled every `interval` seconds until it returns.
+    `callback(message_ids, duration, samples)` is then called with the sampled stacks, as a list of
+    ``(stack, count)`` tuples, most frequent first.  By default the most frequent stack is logged.
+    """
+
+    def __init__(self, threshold, callback=None, interval=0.01):
+        """
+        :param threshold: (float) number of seconds after which a handler is profiled
+        :param callback: (function) see above
+        :param interval: (float) number of seconds between samples
+        """
+        self._threshold = threshold
+        self._callback = callback or self._log
+        self._interval = interval
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sqs-slow-handler-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def begin(self, message_ids):
+        """
+        called by the listener's thread before running a handler
+        :return: a token to pass to end()
+        """
+        token = [threading.current_thread().ident, list(message_ids), time.time(), collections.Counter()]
+        with self._lock:
+            self._running[id(token)] = token
+        return token
+
+    def end(self, token):
+        """
+        called by the listener's thread once the handler returned
+        :return: (boolean) True if the handler was slow
+        """
+        with self._lock:
+            self._running.pop(id(token), None)
+        ident, message_ids, started, samples = token
+        duration = time.time() - started
+        if duration < self._threshold:
+            return False
+        try:
+            self._callback(message_ids, duration, samples.most_common())
+        except Exception:
+            sqs_logger.exception("Slow handler callback failed")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            now = time.time()
+            with self._lock:
+                slow = [token for token in self._running.values() if now - token[2] >= self._threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for ident, _, _, samples in slow:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = tuple(
+                        '{}:{} {}'.format(f.filename, f.lineno, f.name) for f in traceback.extract_stack(frame)
+                    )
+                    samples[stack] += 1
+
+    @staticmethod
+    def _log(message_ids, duration, samples):
+        hottest = '\n'.join(samples[0][0]) if samples else '(no samples)'
+        sqs_logger.warning("Slow handler for messages {}: {:.3f} seconds. Most sampled stack:\n{}".format(
+            ', '.join(str(i) for i in message_ids), duration, hottest))
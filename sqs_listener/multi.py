@@ -0,0 +1,390 @@
+"""
+a listener consuming several queues in one process, sharing their clients and one pool of handler threads
+
+Not imported by the ``sqs_listener`` package itself; use
+``from sqs_listener.multi import MultiQueueListener, Subscription``
+"""
+
+# ================
+# start imports
+# ================
+
+import collections
+import copy
+import logging
+import signal
+import threading
+import time
+
+from sqs_listener import SqsListener
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+# SqsListener options which decide the boto3 client a queue is received with
+_CLIENT_OPTIONS = ('region_name', 'endpoint_name', 'aws_access_key', 'aws_secret_key', 'shared_client')
+
+
+class Subscription(object):
+    """
+    A queue consumed by a MultiQueueListener, and how to handle its messages
+    """
+
+    def __init__(self, queue, handler, weight=1, max_number_of_messages=10, max_buffered=None, **kwargs):
+        """
+        :param queue: (str) name of the queue
+        :param handler: (function) called as handler(body, attributes, messages_attributes), like
+                        SqsListener.handle_message
+        :param weight: (int|float) share of the handler threads the queue gets while other queues are busy too
+        :param max_number_of_messages: (int) batch size of each receive, up to 10
+        :param max_buffered: (int) max number of the queue's messages received but not finished.  Defaults to
+                             `max_number_of_messages`
+        :param kwargs: SqsListener options for this queue only (e.g. deserializer, error_queue, visibility_timeout),
+                       overriding the listener-wide ones
+        """
+        if weight <= 0:
+            raise ValueError('weight must be positive')
+        self.queue = queue
+        self.handler = handler
+        self.weight = weight
+        self.max_number_of_messages = max_number_of_messages
+        self.max_buffered = max_buffered or max_number_of_messages
+        self.options = kwargs
+
+
+class _QueueListener(SqsListener):
+    """
+    Handles the messages of one subscription: decoding, deletion and the error queue work as in SqsListener, but
+    receiving and scheduling are done by the MultiQueueListener
+    """
+
+    def __init__(self, queue, handler, **kwargs):
+        self._handler = handler
+        SqsListener.__init__(self, queue, **kwargs)
+
+    def handle_message(self, body, attributes, messages_attributes):
+        return self._handler(body, attributes, messages_attributes)
+
+
+class WeightedFairQueue(object):
+    """
+    One FIFO per subscription, served in weighted fair order (start-time fair queuing).  Each item is tagged with a
+    virtual start time when it is added: the later of the current virtual time and the previous item of its queue's
+    finish time, its finish time being start + cost / weight.  get() serves the item with the lowest start tag, so a
+    queue with twice the weight gets twice the service while queues compete, and a flooded queue can't push the
+    others' items back.  An idle queue doesn't bank credit for later.
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._weights = {}
+        self._capacities = {}
+        self._finish = {}
+        self._outstanding = {}
+        self._virtual_time = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def add_queue(self, name, weight=1, capacity=10):
+        with self._condition:
+            self._items[name] = collections.deque()
+            self._weights[name] = float(weight)
+            self._capacities[name] = capacity
+            self._finish[name] = 0.0
+            self._outstanding[name] = 0
+
+    def wait_for_room(self, name, timeout=None):
+        """
+        block until the queue has room for more items.  Items count against the capacity until done() is called
+        :return: (int) number of free slots, 0 if the timeout expired or the scheduler was closed
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._closed or self._outstanding[name] < self._capacities[name], timeout
+            )
+            if self._closed:
+                return 0
+            return max(0, self._capacities[name] - self._outstanding[name])
+
+    def put(self, name, item, cost=1):
+        with self._condition:
+            start = max(self._virtual_time, self._finish[name])
+            self._finish[name] = start + cost / self._weights[name]
+            self._items[name].append((start, cost, item))
+            self._outstanding[name] += cost
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        :return: (tuple) (queue name, item, cost) of the next item to handle, or None if the scheduler was closed or
+                 the timeout expired
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or any(self._items.values()), timeout)
+            candidates = [(items[0][0], name) for name, items in self._items.items() if items]
+            if self._closed or not candidates:
+                return None
+            start, name = min(candidates)
+            _, cost, item = self._items[name].popleft()
+            self._virtual_time = start
+            return name, item, cost
+
+    def done(self, name, cost=1):
+        with self._condition:
+            self._outstanding[name] -= cost
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        stop serving items
+        :return: (dict) the items which weren't served, by queue name
+        """
+        with self._condition:
+            self._closed = True
+            remaining = dict((name, [entry[2] for entry in items]) for name, items in self._items.items() if items)
+            for items in self._items.values():
+                items.clear()
+            self._condition.notify_all()
+            return remaining
+
+
+class MultiQueueListener(object):
+    """
+    Consumes several queues in one process.  Every queue is long-polled by its own thread, and the received messages
+    are handled by a shared pool of `workers` threads, scheduled with weighted fair queuing so that a flood on one
+    queue can't starve the others.  Queues with the same region, endpoint and credentials share a boto3 client.
+    Messages of FIFO queues are scheduled a message group at a time, keeping each group in order.
+
+    Usage::
+
+        listener = MultiQueueListener([
+            Subscription('orders', handle_order, weight=3),
+            Subscription('emails', handle_email, deserializer=str),
+        ], error_queue='my-error-queue', workers=20)
+        listener.listen()
+    """
+
+    def __init__(self, subscriptions, **kwargs):
+        """
+        :param subscriptions: (list) of Subscription
+        :param kwargs: the SqsListener options, applied to every queue unless its subscription overrides them, plus:
+            workers (int) - number of handler threads shared by all queues. Set to 10 by default
+        `wait_time` is set to 20 (long polling) by default, and `interval` to 0.  `workers`, `max_in_flight`,
+        `handle_signals`, `shutdown_timeout` and `lazy` apply to the MultiQueueListener as a whole.  A `polling` strategy
+        is copied for every queue.
+        """
+        if not subscriptions:
+            raise ValueError('At least one subscription is required')
+        self._workers = kwargs.pop('workers', 10)
+        kwargs.pop('max_in_flight', None)
+        self._shutdown_timeout = kwargs.pop('shutdown_timeout', 20)
+        self._handle_signals = kwargs.pop('handle_signals', True)
+        lazy = kwargs.pop('lazy', False)
+        kwargs.setdefault('wait_time', 20)
+        kwargs.setdefault('interval', 0)
+        self._subscriptions = collections.OrderedDict()
+        self._listeners = {}
+        self._scheduler = WeightedFairQueue()
+        self._stop_requested = threading.Event()
+        client = kwargs.pop('client', None)
+        # queues with the same region, endpoint and credentials share a client
+        clients = {}
+        for subscription in subscriptions:
+            if subscription.queue in self._subscriptions:
+                raise ValueError('Queue {} is subscribed twice'.format(subscription.queue))
+            own_client = 'client' in subscription.options
+            if client is not None and not own_client and any(name in subscription.options for name in _CLIENT_OPTIONS):
+                raise ValueError('Queue {} overrides the client options of the client passed to '
+                                 'MultiQueueListener; pass it its own client instead'.format(subscription.queue))
+            options = dict(kwargs)
+            if options.get('polling') is not None:
+                # a polling strategy keeps state about its queue's traffic: every queue gets its own copy
+                options['polling'] = copy.deepcopy(options['polling'])
+            options.update(subscription.options)
+            key = tuple(options.get(name) for name in _CLIENT_OPTIONS)
+            if not own_client:
+                options['client'] = client if client is not None else clients.get(key)
+            options.update(
+                lazy=True,
+                workers=0,
+                handle_signals=False,
+                max_number_of_messages=subscription.max_number_of_messages
+            )
+            listener = _QueueListener(subscription.queue, subscription.handler, **options)
+            if not own_client:
+                clients.setdefault(key, listener._client)
+            self._subscriptions[subscription.queue] = subscription
+            self._listeners[subscription.queue] = listener
+            self._scheduler.add_queue(subscription.queue, subscription.weight, subscription.max_buffered)
+        if not lazy:
+            for listener in self._listeners.values():
+                listener._resolve_queues()
+
+    def listen(self):
+        sqs_logger.info("Listening to queues " + ', '.join(self._subscriptions))
+        for listener in self._listeners.values():
+            if not listener._queues_resolved:
+                listener._resolve_queues()
+            if listener._heartbeat:
+                listener._heartbeat.start()
+            if listener._profiler is not None:
+                listener._profiler.start()
+        workers = [
+            self._start_thread(self._work, 'sqs-worker-{}'.format(i)) for i in range(self._workers)
+        ]
+        for name in self._subscriptions:
+            self._start_thread(self._poll, 'sqs-poller-{}'.format(name), name)
+
+        previous_handlers = self._install_signal_handlers()
+        try:
+            while not self._stop_requested.wait(1):
+                # a queue's pending deletes may wait for no other message
+                self._flush_deletes()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self._stop_requested.set()
+            self._shutdown(workers)
+
+    def _flush_deletes(self):
+        for listener in self._listeners.values():
+            if listener._delete_batcher:
+                listener._delete_batcher.flush_if_due()
+
+    def stop(self):
+        """
+        stop listening.  listen() returns once the messages being handled are finished, or after `shutdown_timeout`
+        seconds.  Received messages which weren't handled yet are made visible again right away
+        """
+        self._stop_requested.set()
+
+    def _start_thread(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _install_signal_handlers(self):
+        if not self._handle_signals or threading.current_thread() is not threading.main_thread():
+            return {}
+        previous = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handler = signal.signal(signum, self._handle_stop_signal)
+            if handler is not None:
+                previous[signum] = handler
+        return previous
+
+    def _handle_stop_signal(self, signum, frame):
+        if self._stop_requested.is_set():
+            sqs_logger.warning("Received signal {} again, stopping right away".format(signum))
+            raise KeyboardInterrupt
+        sqs_logger.info("Received signal {}, stopping".format(signum))
+        self.stop()
+
+    def _poll(self, name):
+        listener = self._listeners[name]
+        polling = listener._polling
+        while not self._stop_requested.is_set():
+            free = self._scheduler.wait_for_room(name, timeout=1)
+            if not free:
+                continue
+            wait_time, max_number_of_messages = polling.receive_options()
+            wanted = listener._govern(min(max_number_of_messages, free))
+            if not wanted:
+                # rate limited, or the queue's circuit breaker is open
+                self._stop_requested.wait(listener._governor_pause())
+                continue
+            started = time.time()
+            try:
+                response = listener._client.receive_message(
+                    QueueUrl=listener._queue_url,
+                    MessageAttributeNames=listener._message_attribute_names,
+                    AttributeNames=listener._attribute_names,
+                    WaitTimeSeconds=wait_time,
+                    MaxNumberOfMessages=wanted
+                )
+            except Exception as ex:
+                listener._ungovern(wanted)
+                try:
+                    pause = polling.on_error(ex)
+                except Exception:
+                    # one failing queue must not stop the others
+                    sqs_logger.exception("Unable to receive messages from queue " + name)
+                    pause = listener._poll_interval or 1
+                self._stop_requested.wait(pause)
+                continue
+            messages = response.get('Messages', [])
+            listener._ungovern(wanted - len(messages))
+            if listener._metrics is not None:
+                listener._record_receive(started, len(messages))
+            if messages and self._stop_requested.is_set():
+                listener._abandon(messages)
+                break
+            if not messages:
+                if listener._delete_batcher:
+                    listener._delete_batcher.flush()
+                pause = polling.on_empty()
+            else:
+                sqs_logger.info("{} messages received from queue {}".format(len(messages), name))
+                pause = polling.on_messages(len(messages))
+                self._schedule(name, listener, messages)
+            if pause:
+                self._stop_requested.wait(pause)
+
+    def _schedule(self, name, listener, messages):
+        if listener._force_delete and listener._delete_batcher:
+            listener._delete_batcher.delete([m['ReceiptHandle'] for m in messages])
+        if listener._heartbeat and not listener._force_delete:
+            for m in messages:
+                listener._heartbeat.register(m['ReceiptHandle'])
+        if listener._fifo:
+            groups = collections.OrderedDict()
+            for m in messages:
+                groups.setdefault((m.get('Attributes') or {}).get('MessageGroupId'), []).append(m)
+            for group in groups.values():
+                self._scheduler.put(name, group, cost=len(group))
+        else:
+            for m in messages:
+                self._scheduler.put(name, [m])
+
+    def _work(self):
+        while True:
+            scheduled = self._scheduler.get()
+            if scheduled is None:
+                return
+            name, messages, cost = scheduled
+            listener = self._listeners[name]
+            try:
+                if listener._fifo:
+                    listener._process_group(messages)
+                else:
+                    listener._process_message(messages[0])
+                if listener._delete_batcher:
+                    listener._delete_batcher.flush_if_due()
+            except Exception:
+                sqs_logger.exception("Unexpected error in worker")
+            finally:
+                self._scheduler.done(name, cost)
+
+    def _shutdown(self, workers):
+        deadline = None if self._shutdown_timeout is None else time.time() + self._shutdown_timeout
+        for name, scheduled in self._scheduler.close().items():
+            self._listeners[name]._abandon([m for messages in scheduled for m in messages])
+        sqs_logger.info("Waiting for the messages being handled")
+        for worker in workers:
+            worker.join(None if deadline is None else max(0, deadline - time.time()))
+        running = sum(1 for worker in workers if worker.is_alive())
+        if running:
+            sqs_logger.warning("Abandoning {} running handlers after {} seconds".format(running, self._shutdown_timeout))
+        for listener in self._listeners.values():
+            if listener._heartbeat:
+                listener._heartbeat.stop()
+            if listener._profiler is not None:
+                listener._profiler.stop()
+            if listener._delete_batcher:
+                listener._delete_batcher.flush()
+            if listener._error_publisher:
+                listener._error_publisher.close()
@@ -0,0 +1,132 @@
+"""
+polling strategies, deciding how the listener receives and how long it pauses between receives
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import random
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+# SQS limits
+MAX_WAIT_TIME = 20
+MAX_NUMBER_OF_MESSAGES = 10
+
+
+class PollingStrategy(object):
+    """
+    Base class for polling strategies.  A strategy object is consulted before every receive, and told about the outcome
+    of every receive.  Subclass it and pass an instance as the listener's `polling` kwarg to tune polling per queue.
+    """
+
+    def receive_options(self):
+        """
+        :return: (tuple) (WaitTimeSeconds, MaxNumberOfMessages) for the next receive
+        """
+        raise NotImplementedError
+
+    def on_messages(self, count):
+        """
+        called after a receive returned `count` messages
+        :return: (float) number of seconds to pause before the next receive
+        """
+        return 0
+
+    def on_empty(self):
+        """
+        called after a receive returned no messages
+        :return: (float) number of seconds to pause before the next receive
+        """
+        return 0
+
+    def on_error(self, error):
+        """
+        called when a receive raised `error`.  Re-raise it to stop the listener
+        :return: (float) number of seconds to pause before the next receive
+        """
+        raise error
+
+
+class FixedPolling(PollingStrategy):
+    """
+    The listener's default: a fixed wait time and batch size, and a fixed pause after every empty receive.
+    Receive errors stop the listener.
+    """
+
+    def __init__(self, wait_time=0, max_number_of_messages=1, interval=60):
+        self.wait_time = wait_time
+        self.max_number_of_messages = max_number_of_messages
+        self.interval = interval
+
+    def receive_options(self):
+        return self.wait_time, self.max_number_of_messages
+
+    def on_empty(self):
+        return self.interval
+
+
+class AdaptivePolling(PollingStrategy):
+    """
+    Receives full batches while messages keep arriving.  As soon as the queue runs empty it switches to long polling,
+    so new messages are picked up as they arrive instead of after a fixed sleep.  Repeated empty receives, and receive
+    errors, add an exponentially growing pause with jitter.  The first receive returning messages resets everything.
+    """
+
+    def __init__(self, max_number_of_messages=MAX_NUMBER_OF_MESSAGES, busy_wait_time=0, idle_wait_time=MAX_WAIT_TIME,
+                 base_delay=1, max_delay=20, max_error_delay=60):
+        """
+        :param max_number_of_messages: (int) batch size, up to 10
+        :param busy_wait_time: (int) WaitTimeSeconds while messages are arriving
+        :param idle_wait_time: (int) WaitTimeSeconds once the queue ran empty, up to 20
+        :param base_delay: (float) first pause, in seconds, of the exponential backoff
+        :param max_delay: (float) max pause after repeated empty receives. 0 disables pausing between long polls
+        :param max_error_delay: (float) max pause after repeated receive errors
+        """
+        self.max_number_of_messages = min(max_number_of_messages, MAX_NUMBER_OF_MESSAGES)
+        self.busy_wait_time = busy_wait_time
+        self.idle_wait_time = min(idle_wait_time, MAX_WAIT_TIME)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_error_delay = max_error_delay
+        self._empty_receives = 0
+        self._errors = 0
+
+    @property
+    def idle(self):
+        return self._empty_receives > 0
+
+    def receive_options(self):
+        if self.idle:
+            return self.idle_wait_time, self.max_number_of_messages
+        return self.busy_wait_time, self.max_number_of_messages
+
+    def on_messages(self, count):
+        self._empty_receives = 0
+        self._errors = 0
+        return 0
+
+    def on_empty(self):
+        self._errors = 0
+        self._empty_receives += 1
+        # the first empty receive just switches to long polling, which is a wait in itself
+        return self._backoff(self._empty_receives - 1, self.max_delay)
+
+    def on_error(self, error):
+        self._errors += 1
+        delay = self._backoff(self._errors, self.max_error_delay)
+        sqs_logger.warning("Receive failed ({}), retrying in {:.1f} seconds".format(error, delay))
+        return delay
+
+    def _backoff(self, attempt, max_delay):
+        if attempt <= 0 or max_delay <= 0:
+            return 0
+        delay = min(max_delay, self.base_delay * 2 ** (attempt - 1))
+        # equal jitter: spread polls of many listeners without ever dropping to zero
+        return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,189 @@
+"""
+prefetching: receiving the next messages while the previous ones are being handled
+"""
+
+# ================
+# start imports
+# ================
+
+import collections
+import logging
+import threading
+import time
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+EXPIRY_RELEASE = 'release'
+EXPIRY_EXTEND = 'extend'
+
+
+class PrefetchBuffer(object):
+    """
+    A background thread keeps up to `capacity` received messages buffered, so the listener's loop takes messages from
+    memory instead of waiting for a receive round trip.  The thread is driven by the listener's polling strategy.
+
+    Buffered messages still count against their visibility timeout.  Once a buffered message is within `margin`
+    seconds of becoming visible again, it is either released (made visible right away, for any listener to pick up)
+    or its visibility is extended, depending on `on_expiry`.
+    """
+
+    def __init__(self, receive, change_visibility, polling, capacity, visibility_timeout, margin=None,
+                 on_expiry=EXPIRY_RELEASE):
+        """
+        :param receive: (function (wait_time, max_number_of_messages) -> list) receives messages, with a visibility
+                        timeout of `visibility_timeout`
+        :param change_visibility: (function (receipt_handles, visibility_timeout)) changes the visibility of messages
+        :param polling: (PollingStrategy)
+        :param capacity: (int) max number of buffered messages
+        :param visibility_timeout: (int) number of seconds received messages stay invisible
+        :param margin: (int|float) see above.  Defaults to a fifth of `visibility_timeout`
+        :param on_expiry: (str) 'release' or 'extend'
+        """
+        if on_expiry not in (EXPIRY_RELEASE, EXPIRY_EXTEND):
+            raise ValueError('Unsupported on_expiry ' + str(on_expiry))
+        self._receive = receive
+        self._change_visibility = change_visibility
+        self._polling = polling
+        self._capacity = max(1, capacity)
+        self._visibility_timeout = visibility_timeout
+        self._margin = visibility_timeout / 5.0 if margin is None else margin
+        self._on_expiry = on_expiry
+        # (deadline, message) tuples, oldest first
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._error = None
+        self._idle = False
+        self._thread = None
+
+    def __repr__(self):
+        return 'PrefetchBuffer(capacity={})'.format(self._capacity)
+
+    @property
+    def idle(self):
+        """
+        True if the last receive came back empty and nothing is buffered, rather than get() just timing out while a
+        receive is in progress
+        """
+        with self._condition:
+            return self._idle and not self._buffer
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='sqs-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self, max_count, timeout=None):
+        """
+        take up to `max_count` buffered messages, waiting up to `timeout` seconds for at least one
+        :return: (list) messages, oldest first.  Empty if the timeout expired
+        :raise: the error which stopped the receiving thread, if any
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or self._error is not None or self._closed, timeout)
+            if self._error is not None:
+                raise self._error
+            messages = []
+            while self._buffer and len(messages) < max_count:
+                messages.append(self._buffer.popleft()[1])
+            self._condition.notify_all()
+            return messages
+
+    def close(self):
+        """
+        stop receiving
+        :return: (list) the messages which were still buffered
+        """
+        with self._condition:
+            self._closed = True
+            messages = [message for _, message in self._buffer]
+            self._buffer.clear()
+            self._condition.notify_all()
+            return messages
+
+    def _run(self):
+        while True:
+            self._expire()
+            with self._condition:
+                # wake up regularly, to expire buffered messages while the handlers are busy
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._buffer) < self._capacity, min(1.0, self._margin / 2.0)
+                )
+                if self._closed:
+                    return
+                free = self._capacity - len(self._buffer)
+            if free <= 0:
+                continue
+
+            wait_time, max_number_of_messages = self._polling.receive_options()
+            try:
+                messages = self._receive(wait_time, min(max_number_of_messages, free))
+            except Exception as ex:
+                try:
+                    pause = self._polling.on_error(ex)
+                except Exception as error:
+                    self._fail(error)
+                    return
+                self._sleep(pause)
+                continue
+
+            with self._condition:
+                self._idle = not messages
+            if messages:
+                deadline = time.time() + self._visibility_timeout
+                with self._condition:
+                    closed = self._closed
+                    if not closed:
+                        self._buffer.extend((deadline, message) for message in messages)
+                        self._condition.notify_all()
+                if closed:
+                    # stopped while receiving: hand the messages straight back
+                    self._change_visibility([m['ReceiptHandle'] for m in messages], 0)
+                    return
+            try:
+                pause = self._polling.on_messages(len(messages)) if messages else self._polling.on_empty()
+            except Exception as error:
+                self._fail(error)
+                return
+            self._sleep(pause)
+
+    def _fail(self, error):
+        # raised by get(), in the listener's thread
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def _sleep(self, seconds):
+        if not seconds:
+            return
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed, seconds)
+
+    def _expire(self):
+        now = time.time()
+        with self._condition:
+            expiring = [entry for entry in self._buffer if entry[0] - self._margin <= now]
+            if not expiring:
+                return
+            for entry in expiring:
+                self._buffer.remove(entry)
+            if self._on_expiry == EXPIRY_EXTEND:
+                # extended messages keep their place in line
+                deadline = now + self._visibility_timeout
+                for _, message in reversed(expiring):
+                    self._buffer.appendleft((deadline, message))
+            self._condition.notify_all()
+
+        handles = [message['ReceiptHandle'] for _, message in expiring]
+        if self._on_expiry == EXPIRY_EXTEND:
+            sqs_logger.info("Extending the visibility of {} buffered messages".format(len(handles)))
+            self._change_visibility(handles, self._visibility_timeout)
+        else:
+            sqs_logger.info("Releasing {} buffered messages close to their visibility timeout".format(len(handles)))
+            self._change_visibility(handles, 0)
@@ -0,0 +1,160 @@
+"""
+process-wide registry of boto3 sessions, sqs clients and queue urls
+
+Creating a session and a client, and looking up a queue url, is by far the most expensive part of instantiating a
+listener or a launcher.  Sessions and clients are shared per (region, endpoint, credentials) and queue urls are cached
+with a TTL.  Everything is discarded in a forked child, since boto3 objects can't be shared across a fork.
+"""
+
+# ================
+# start imports
+# ================
+
+import logging
+import os
+import threading
+import time
+
+import boto3.session
+from botocore.exceptions import ClientError
+
+# ================
+# start class
+# ================
+
+sqs_logger = logging.getLogger('sqs_listener')
+
+NON_EXISTENT_QUEUE_CODES = ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist')
+
+_lock = threading.RLock()
+_pid = os.getpid()
+_sessions = {}
+_clients = {}
+
+
+def _check_fork():
+    global _pid
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        _sessions.clear()
+        _clients.clear()
+        queue_urls.invalidate()
+
+
+def get_session(aws_access_key=None, aws_secret_key=None):
+    """
+    :return: a boto3 session, shared with every caller using the same credentials
+    """
+    key = (aws_access_key or None, aws_secret_key or None)
+    with _lock:
+        _check_fork()
+        session = _sessions.get(key)
+        if session is None:
+            if key[0] and key[1]:
+                session = boto3.session.Session(aws_access_key_id=key[0], aws_secret_access_key=key[1])
+            else:
+                session = boto3.session.Session()
+            _sessions[key] = session
+        return session
+
+
+def get_client(region_name=None, endpoint_url=None, use_ssl=True, aws_access_key=None, aws_secret_key=None):
+    """
+    :return: an sqs client, shared with every caller using the same region, endpoint and credentials.
+             boto3 clients are thread safe
+    """
+    key = (region_name, endpoint_url, use_ssl, aws_access_key or None, aws_secret_key or None)
+    with _lock:
+        _check_fork()
+        client = _clients.get(key)
+        if client is None:
+            session = get_session(aws_access_key, aws_secret_key)
+            client = session.client('sqs', region_name=region_name, endpoint_url=endpoint_url, use_ssl=use_ssl)
+            _clients[key] = client
+        return client
+
+
+def clear():
+    """
+    drop all shared sessions, clients and cached queue urls
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        queue_urls.invalidate()
+
+
+class QueueUrlCache(object):
+    """
+    Caches queue name -> queue url lookups, per client, for `ttl` seconds
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, client, queue_name):
+        with self._lock:
+            entry = self._entries.get((id(client), queue_name))
+        if entry is None:
+            return None
+        entry_client, url, expires = entry
+        # ids can be reused once a client is garbage collected
+        if entry_client is not client or expires < time.time():
+            return None
+        return url
+
+    def set(self, client, queue_name, url):
+        with self._lock:
+            self._entries[(id(client), queue_name)] = (client, url, time.time() + self.ttl)
+
+    def invalidate(self, queue_name=None):
+        """
+        :param queue_name: (str) forget this queue only; forget everything if None
+        """
+        with self._lock:
+            if queue_name is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[1] == queue_name]:
+                    del self._entries[key]
+
+
+queue_urls = QueueUrlCache()
+
+
+def invalidate_queue_url(queue_name=None):
+    queue_urls.invalidate(queue_name)
+
+
+def resolve_queue_url(client, queue_name, create=False, attributes=None, owner_account_id=None):
+    """
+    look up a queue url, through the cache
+    :param client: sqs client
+    :param queue_name: (str)
+    :param create: (boolean) create the queue if it doesn't exist
+    :param attributes: (dict) attributes for queue creation
+    :param owner_account_id: (str) account id owning the queue
+    :return: (str) the queue url, or None if the queue doesn't exist and `create` is False
+    """
+    url = queue_urls.get(client, queue_name)
+    if url is not None:
+        return url
+
+    kwargs = {'QueueName': queue_name}
+    if owner_account_id:
+        kwargs['QueueOwnerAWSAccountId'] = owner_account_id
+    try:
+        url = client.get_queue_url(**kwargs)['QueueUrl']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in NON_EXISTENT_QUEUE_CODES:
+            raise
+        if not create:
+            return None
+        sqs_logger.warning("queue {} not found, creating now".format(queue_name))
+        # creation is idempotent, no harm in calling on a queue if it already exists.
+        url = client.create_queue(QueueName=queue_name, Attributes=attributes or {})['QueueUrl']
+
+    queue_urls.set(client, queue_name, url)
+    return url
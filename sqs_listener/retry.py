@@ -0,0 +1,67 @@
+"""
+retry policies, deciding when a message whose handler failed is delivered again
+"""
+
+# ================
+# start imports
+# ================
+
+import random
+
+# ================
+# start class
+# ================
+
+RECEIVE_COUNT_ATTRIBUTE = 'ApproximateReceiveCount'
+
+# SQS limit on a message's visibility timeout, 12 hours
+MAX_VISIBILITY_TIMEOUT = 43200
+
+
+def receive_count(m):
+    """
+    :param m: (dict) a message as received from SQS
+    :return: (int) the number of times the message was delivered, including this time
+    """
+    return int((m.get('Attributes') or {}).get(RECEIVE_COUNT_ATTRIBUTE, 1))
+
+
+class RetryPolicy(object):
+    """
+    Retries a failed message with exponential backoff: the message stays on the queue, and its visibility timeout is
+    set to the delay before its next delivery.  The attempt number is the message's ApproximateReceiveCount.  Once
+    `max_attempts` deliveries failed, the message is moved to the error queue.  Subclass it and override delay() for
+    other schedules.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=10, max_delay=900, jitter=True):
+        """
+        :param max_attempts: (int) number of deliveries before a message is given up on
+        :param base_delay: (int) seconds before the second delivery.  Doubles with every further attempt
+        :param max_delay: (int) max seconds between two deliveries, up to 12 hours
+        :param jitter: (boolean) spread the delays, so messages which failed together aren't all retried together
+        """
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = min(max_delay, MAX_VISIBILITY_TIMEOUT)
+        self.jitter = jitter
+
+    def exhausted(self, attempt):
+        """
+        :param attempt: (int) number of the delivery which just failed, starting at 1
+        :return: (boolean) True if the message shouldn't be retried anymore
+        """
+        return attempt >= self.max_attempts
+
+    def delay(self, attempt):
+        """
+        :param attempt: (int) number of the delivery which just failed, starting at 1
+        :return: (int) number of seconds before the next delivery
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            # equal jitter: never retry much sooner than planned
+            delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        return int(round(delay))
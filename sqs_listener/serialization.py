@@ -0,0 +1,241 @@
+"""
+codec registry for message bodies
+
+The content type and encoding of a body travel in the `content-type` and `content-encoding` message attributes.
+Binary codecs (msgpack) and compressed bodies are base64 encoded, since SQS bodies must be text.
+orjson, msgpack and zstandard are used when installed.
+"""
+
+# ================
+# start imports
+# ================
+
+import base64
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ================
+# start class
+# ================
+
+CONTENT_TYPE_ATTRIBUTE = 'content-type'
+CONTENT_ENCODING_ATTRIBUTE = 'content-encoding'
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+BASE64 = 'base64'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+
+class MessageDecodeError(ValueError):
+    """
+    raised when a message body can't be decoded
+    """
+
+
+class Codec(object):
+    """
+    :param content_type: (str) value of the `content-type` attribute
+    :param encode: (function obj -> str|bytes)
+    :param decode: (function str|bytes -> obj)
+    """
+
+    def __init__(self, content_type, encode, decode):
+        self.content_type = content_type
+        self.encode = encode
+        self.decode = decode
+
+
+_codecs = {}
+_compressors = {}
+
+
+def register_codec(content_type, encode, decode):
+    _codecs[content_type] = Codec(content_type, encode, decode)
+
+
+def get_codec(content_type):
+    """
+    :raise ValueError: if no codec is registered for the content type
+    """
+    try:
+        return _codecs[content_type]
+    except KeyError:
+        raise ValueError('No codec registered for content type ' + str(content_type))
+
+
+def register_compression(name, compress, decompress):
+    _compressors[name] = (compress, decompress)
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj)
+
+
+def json_loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN, which the json module accepts
+            pass
+    return json.loads(data)
+
+
+register_codec(JSON, json_dumps, json_loads)
+if msgpack is not None:
+    register_codec(MSGPACK, lambda obj: msgpack.packb(obj, use_bin_type=True), lambda data: msgpack.unpackb(data, raw=False))
+
+register_compression(ZLIB, zlib.compress, zlib.decompress)
+if zstandard is not None:
+    register_compression(
+        ZSTD,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)
+    )
+
+
+def encode_body(obj, content_type=JSON, compression=None, compress_threshold=0):
+    """
+    :param obj: the message contents
+    :param content_type: (str) a registered content type
+    :param compression: (str) 'zlib' or 'zstd', or None
+    :param compress_threshold: (int) only compress bodies larger than this number of bytes
+    :return: (tuple) the body (str), and the message attributes describing it (dict)
+    """
+    data = get_codec(content_type).encode(obj)
+    encoding = None
+    if compression is not None:
+        raw = data.encode('utf-8') if not isinstance(data, bytes) else data
+        if len(raw) > compress_threshold:
+            try:
+                compress = _compressors[compression][0]
+            except KeyError:
+                raise ValueError('Unsupported compression ' + str(compression))
+            data = compress(raw)
+            encoding = compression
+    if isinstance(data, bytes):
+        data = base64.b64encode(data).decode('ascii')
+        encoding = encoding or BASE64
+
+    attributes = {CONTENT_TYPE_ATTRIBUTE: {'DataType': 'String', 'StringValue': content_type}}
+    if encoding is not None:
+        attributes[CONTENT_ENCODING_ATTRIBUTE] = {'DataType': 'String', 'StringValue': encoding}
+    return data, attributes
+
+
+def _attribute(message, name):
+    attribute = (message.get('MessageAttributes') or {}).get(name)
+    if attribute is None:
+        return None
+    return attribute.get('StringValue')
+
+
+def decode_message(message, default=json.loads):
+    """
+    decode the body of a message as received from SQS, according to its content-type and content-encoding attributes
+    :param message: (dict)
+    :param default: (function str -> obj) used for messages without a content-type attribute
+    :raise MessageDecodeError: if the body is invalid, or has an unknown content type or encoding
+    """
+    try:
+        return _decode(message, default)
+    except Exception as ex:
+        raise MessageDecodeError('Unable to decode message {}: {}'.format(message.get('MessageId'), ex))
+
+
+def _decode(message, default):
+    body = message['Body']
+    content_type = _attribute(message, CONTENT_TYPE_ATTRIBUTE)
+    encoding = _attribute(message, CONTENT_ENCODING_ATTRIBUTE)
+    if encoding is not None:
+        body = base64.b64decode(body)
+        if encoding != BASE64:
+            try:
+                decompress = _compressors[encoding][1]
+            except KeyError:
+                raise ValueError('Unsupported content encoding ' + encoding)
+            body = decompress(body)
+    if content_type is None:
+        return default(body)
+    return get_codec(content_type).decode(body)
+
+
+class LazyBody(object):
+    """
+    Stands in for a message body, decoding it only when first accessed.  Handlers which only route or filter on
+    attributes never pay for decoding.  Supports read access like the decoded dict (``body['key']``, ``body.get()``,
+    ``in``, iteration); the decoded object itself is available as ``body.value``, the raw text as ``body.raw``.
+    A MessageDecodeError is raised on first access if the body can't be decoded.
+    """
+
+    _UNSET = object()
+
+    def __init__(self, message, decode):
+        self._message = message
+        self._decode = decode
+        self._value = self._UNSET
+
+    @property
+    def raw(self):
+        return self._message['Body']
+
+    @property
+    def decoded(self):
+        return self._value is not self._UNSET
+
+    @property
+    def value(self):
+        if self._value is self._UNSET:
+            self._value = self._decode(self._message)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def get(self, key, default=None):
+        return self.value.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyBody):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self.decoded:
+            return 'LazyBody({!r})'.format(self._value)
+        return 'LazyBody(<not decoded>)'
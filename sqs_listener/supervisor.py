@@ -0,0 +1,160 @@
+"""
+a pre-forking daemon, running several listener processes under one supervisor
+"""
+
+import errno
+import json
+import os
+import signal
+import sys
+import time
+
+from sqs_listener.daemon import Daemon
+
+
+def default_process_count():
+    return os.cpu_count() or 1
+
+
+class SupervisorDaemon(Daemon):
+    """
+    A daemon which forks several listener processes and restarts them when they crash.
+
+    Usage: subclass the SupervisorDaemon class and override the create_listener() method.  It is called inside each
+    child process, so every child builds its own boto3 session and client - these can't be shared across a fork.
+
+    The state of each child is written to a json file next to the pidfile, named <pidfile>.<index>.health
+    """
+
+    def __init__(self, pidfile, processes=None, restart_delay=1, stop_timeout=30, **kwargs):
+        """
+        :param pidfile: (str) path of the supervisor's pidfile
+        :param processes: (int) number of listener processes. Defaults to the number of CPUs
+        :param restart_delay: (int|float) number of seconds to wait before restarting a crashed child
+        :param stop_timeout: (int|float) number of seconds children have to drain after SIGTERM, before being killed
+        :param kwargs: passed on to Daemon
+        """
+        # the supervisor itself gets a little longer than its children to stop, to kill and reap them
+        kwargs.setdefault('stop_timeout', stop_timeout + 5)
+        Daemon.__init__(self, pidfile, **kwargs)
+        self.processes = processes or default_process_count()
+        self.restart_delay = restart_delay
+        self.child_stop_timeout = stop_timeout
+        self._children = {}
+        self._restarts = [0] * self.processes
+        self._stopping = False
+        self._listener = None
+
+    def create_listener(self):
+        """
+        You should override this method when you subclass SupervisorDaemon. It is called once in every child process,
+        and should return an SqsListener instance.
+        """
+        raise NotImplementedError
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        signal.signal(signal.SIGINT, self._handle_sigterm)
+        for index in range(self.processes):
+            self._spawn(index)
+        self._supervise()
+
+    def health_file(self, index):
+        return "%s.%d.health" % (self.pidfile, index)
+
+    def _write_health(self, index, pid, status, exit_code=None):
+        health = {
+            'index': index,
+            'pid': pid,
+            'status': status,
+            'exit_code': exit_code,
+            'restarts': self._restarts[index],
+            'updated': time.time()
+        }
+        with open(self.health_file(index), 'w') as f:
+            json.dump(health, f)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(index)
+        self._children[pid] = index
+        self._write_health(index, pid, 'running')
+
+    def _run_child(self, index):
+        # never returns: runs the listener and exits the child process
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, self._handle_child_sigterm)
+            self._listener = self.create_listener()
+            self._listener.listen()
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def _handle_child_sigterm(self, signum, frame):
+        # while listening, the listener's own signal handlers take over and drain before exiting
+        if self._listener is not None:
+            self._listener.stop()
+        else:
+            raise SystemExit(0)
+
+    def _handle_sigterm(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        for pid in list(self._children):
+            self._signal_child(pid, signal.SIGTERM)
+
+    def _signal_child(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _supervise(self):
+        deadline = None
+        while self._children:
+            if self._stopping and deadline is None:
+                deadline = time.time() + self.child_stop_timeout
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                if deadline is not None and time.time() > deadline:
+                    for child in list(self._children):
+                        self._signal_child(child, signal.SIGKILL)
+                time.sleep(0.1)
+                continue
+            self._reap(pid, status)
+
+        for index in range(self.processes):
+            if os.path.exists(self.health_file(index)):
+                os.remove(self.health_file(index))
+
+    def _reap(self, pid, status):
+        index = self._children.pop(pid, None)
+        if index is None:
+            return
+        if os.WIFSIGNALED(status):
+            exit_code = -os.WTERMSIG(status)
+        else:
+            exit_code = os.WEXITSTATUS(status)
+
+        if self._stopping:
+            self._write_health(index, pid, 'stopped', exit_code)
+            return
+
+        sys.stderr.write("listener process %d exited with code %d, restarting\n" % (pid, exit_code))
+        self._write_health(index, pid, 'restarting', exit_code)
+        time.sleep(self.restart_delay)
+        if not self._stopping:
+            self._restarts[index] += 1
+            self._spawn(index)
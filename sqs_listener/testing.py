@@ -0,0 +1,425 @@
+"""
+in-process stand-in for an sqs client, for tests and benchmarks
+
+``FakeSqsClient`` implements the client calls used by the listeners and the launcher, with visibility timeouts,
+long polling, delayed messages, FIFO queues (per-group ordering and deduplication) and optional latency injection.
+Pass it as the ``client`` of a listener or launcher; no AWS credentials are needed.
+"""
+
+# ================
+# start imports
+# ================
+
+import hashlib
+import itertools
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from sqs_listener.batching import MAX_BATCH_BYTES, MAX_BATCH_ENTRIES, entry_size
+
+# ================
+# start class
+# ================
+
+FIFO_DEDUPLICATION_INTERVAL = 5 * 60
+MAX_WAIT_TIME = 20
+
+
+def _error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}}, operation)
+
+
+class _FakeMessage(object):
+
+    def __init__(self, body, message_attributes, sent, visible_at, group_id=None, deduplication_id=None, sequence_number=None):
+        self.message_id = str(uuid.uuid4())
+        self.body = body
+        self.message_attributes = message_attributes or {}
+        self.sent = sent
+        self.visible_at = visible_at
+        self.group_id = group_id
+        self.deduplication_id = deduplication_id
+        self.sequence_number = sequence_number
+        self.receive_count = 0
+        self.first_received = None
+        self.receipt_handle = None
+
+
+class _FakeQueue(object):
+
+    def __init__(self, name, url, attributes):
+        self.name = name
+        self.url = url
+        self.attributes = dict(attributes or {})
+        self.attributes.setdefault('VisibilityTimeout', '30')
+        self.fifo = name.endswith('.fifo')
+        # insertion order is send order, which is also the delivery order within a FIFO group
+        self.messages = OrderedDict()
+        self.deduplication_ids = {}
+        self.sequence = itertools.count(1)
+
+    @property
+    def visibility_timeout(self):
+        return int(self.attributes['VisibilityTimeout'])
+
+
+class FakeSqsClient(object):
+    """
+    Thread safe, in-memory implementation of the boto3 sqs client calls used by this package.  Errors are raised as
+    botocore ``ClientError`` with the same codes as SQS.
+    """
+
+    def __init__(self, latency=0, account_id='000000000000', region_name='us-east-1', clock=time.time):
+        """
+        :param latency: (float|function) number of seconds every call sleeps before returning, or a function of the
+                        operation name (e.g. 'receive_message') returning that number, to emulate network round trips
+        :param account_id: (str) used in queue urls
+        :param region_name: (str) used in queue urls
+        :param clock: (function) returns the current time, in seconds
+        """
+        self._latency = latency
+        self._account_id = account_id
+        self._region_name = region_name
+        self._clock = clock
+        self._queues = {}
+        self._handles = {}
+        self._lock = threading.Condition()
+        self.calls = []
+
+    # ================
+    # helpers
+    # ================
+
+    def _call(self, operation):
+        self.calls.append(operation)
+        latency = self._latency(operation) if callable(self._latency) else self._latency
+        if latency:
+            time.sleep(latency)
+
+    def _queue(self, queue_url, operation):
+        queue = self._queues.get(queue_url.rstrip('/').split('/')[-1])
+        if queue is None or queue.url != queue_url:
+            raise _error('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist.', operation)
+        return queue
+
+    def _send(self, queue, operation, MessageBody, MessageAttributes=None, DelaySeconds=None, MessageGroupId=None,
+              MessageDeduplicationId=None, **kwargs):
+        if len(MessageBody.encode('utf-8')) > MAX_BATCH_BYTES:
+            raise _error('InvalidParameterValue', 'Message must be shorter than 262144 bytes.', operation)
+        now = self._clock()
+        if queue.fifo:
+            if MessageGroupId is None:
+                raise _error('MissingParameter', 'The request must contain the parameter MessageGroupId.', operation)
+            if MessageDeduplicationId is None:
+                if queue.attributes.get('ContentBasedDeduplication') != 'true':
+                    raise _error('InvalidParameterValue', 'The queue should either have ContentBasedDeduplication '
+                                                          'enabled or MessageDeduplicationId provided explicitly', operation)
+                MessageDeduplicationId = hashlib.sha256(MessageBody.encode('utf-8')).hexdigest()
+            sent = queue.deduplication_ids.get(MessageDeduplicationId)
+            if sent is not None and now - sent[1] < FIFO_DEDUPLICATION_INTERVAL:
+                return {'MessageId': sent[0], 'SequenceNumber': sent[2]}
+        delay = DelaySeconds if DelaySeconds is not None else int(queue.attributes.get('DelaySeconds', 0))
+        message = _FakeMessage(
+            MessageBody,
+            MessageAttributes,
+            sent=now,
+            visible_at=now + delay,
+            group_id=MessageGroupId,
+            deduplication_id=MessageDeduplicationId,
+            sequence_number=str(next(queue.sequence)).zfill(20) if queue.fifo else None
+        )
+        queue.messages[message.message_id] = message
+        response = {'MessageId': message.message_id, 'MD5OfMessageBody': hashlib.md5(MessageBody.encode('utf-8')).hexdigest()}
+        if queue.fifo:
+            queue.deduplication_ids[MessageDeduplicationId] = (message.message_id, now, message.sequence_number)
+            response['SequenceNumber'] = message.sequence_number
+        self._lock.notify_all()
+        return response
+
+    def _check_batch(self, entries, operation):
+        if not entries:
+            raise _error('AWS.SimpleQueueService.EmptyBatchRequest', 'There should be at least one entry in the request.', operation)
+        if len(entries) > MAX_BATCH_ENTRIES:
+            raise _error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'Maximum number of entries per request are 10.', operation)
+        ids = [entry['Id'] for entry in entries]
+        if len(set(ids)) != len(ids):
+            raise _error('AWS.SimpleQueueService.BatchEntryIdsNotDistinct', 'Two or more batch entries have the same Id.', operation)
+
+    def _in_flight(self, queue, receipt_handle, operation):
+        """
+        :return: the message a receipt handle was issued for, if it is still in flight with that handle
+        """
+        if receipt_handle not in self._handles:
+            raise _error('ReceiptHandleIsInvalid', 'The input receipt handle is invalid.', operation)
+        message = queue.messages.get(self._handles[receipt_handle])
+        if message is None or message.receipt_handle != receipt_handle or message.visible_at <= self._clock():
+            return None
+        return message
+
+    def _receivable(self, queue, count, now):
+        # a FIFO group is blocked while any of its messages is in flight
+        blocked_groups = set(m.group_id for m in queue.messages.values() if m.receive_count and m.visible_at > now)
+        received = []
+        for message in queue.messages.values():
+            if len(received) >= count:
+                break
+            if queue.fifo:
+                # later messages of a group wait for a delayed one, to keep the group in order
+                if message.group_id in blocked_groups:
+                    continue
+                if message.visible_at > now:
+                    blocked_groups.add(message.group_id)
+                    continue
+            elif message.visible_at > now:
+                continue
+            received.append(message)
+        return received
+
+    @staticmethod
+    def _wanted(names, name):
+        for wanted in names or []:
+            if wanted in ('All', '.*') or wanted == name:
+                return True
+            if wanted.endswith('.*') and name.startswith(wanted[:-1]):
+                return True
+        return False
+
+    def _format(self, queue, message, attribute_names, message_attribute_names):
+        result = {
+            'MessageId': message.message_id,
+            'ReceiptHandle': message.receipt_handle,
+            'MD5OfBody': hashlib.md5(message.body.encode('utf-8')).hexdigest(),
+            'Body': message.body
+        }
+        attributes = {
+            'SenderId': self._account_id,
+            'SentTimestamp': str(int(message.sent * 1000)),
+            'ApproximateReceiveCount': str(message.receive_count),
+            'ApproximateFirstReceiveTimestamp': str(int(message.first_received * 1000))
+        }
+        if queue.fifo:
+            attributes['MessageGroupId'] = message.group_id
+            attributes['MessageDeduplicationId'] = message.deduplication_id
+            attributes['SequenceNumber'] = message.sequence_number
+        attributes = dict((name, value) for name, value in attributes.items() if self._wanted(attribute_names, name))
+        if attributes:
+            result['Attributes'] = attributes
+        message_attributes = dict(
+            (name, value) for name, value in message.message_attributes.items() if self._wanted(message_attribute_names, name)
+        )
+        if message_attributes:
+            result['MessageAttributes'] = message_attributes
+        return result
+
+    # ================
+    # queues
+    # ================
+
+    def create_queue(self, QueueName, Attributes=None, **kwargs):
+        self._call('create_queue')
+        if QueueName.endswith('.fifo') != ((Attributes or {}).get('FifoQueue') == 'true'):
+            raise _error('InvalidParameterValue', 'The name of a FIFO queue can only include alphanumeric characters, '
+                                                  'hyphens, or underscores, must end with .fifo suffix', 'CreateQueue')
+        if not re.match(r'^[\w-]{1,80}$', QueueName[:-5] if QueueName.endswith('.fifo') else QueueName):
+            raise _error('InvalidParameterValue', 'Invalid queue name ' + QueueName, 'CreateQueue')
+        with self._lock:
+            queue = self._queues.get(QueueName)
+            if queue is None:
+                url = 'https://sqs.{}.amazonaws.com/{}/{}'.format(self._region_name, self._account_id, QueueName)
+                queue = self._queues[QueueName] = _FakeQueue(QueueName, url, Attributes)
+            return {'QueueUrl': queue.url}
+
+    def get_queue_url(self, QueueName, QueueOwnerAWSAccountId=None):
+        self._call('get_queue_url')
+        with self._lock:
+            queue = self._queues.get(QueueName)
+            if queue is None:
+                raise _error('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist.', 'GetQueueUrl')
+            return {'QueueUrl': queue.url}
+
+    def list_queues(self, QueueNamePrefix=''):
+        self._call('list_queues')
+        with self._lock:
+            return {'QueueUrls': [q.url for name, q in sorted(self._queues.items()) if name.startswith(QueueNamePrefix)]}
+
+    def delete_queue(self, QueueUrl):
+        self._call('delete_queue')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'DeleteQueue')
+            del self._queues[queue.name]
+            return {}
+
+    def purge_queue(self, QueueUrl):
+        self._call('purge_queue')
+        with self._lock:
+            self._queue(QueueUrl, 'PurgeQueue').messages.clear()
+            return {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self._call('get_queue_attributes')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'GetQueueAttributes')
+            now = self._clock()
+            attributes = dict(queue.attributes)
+            attributes['ApproximateNumberOfMessages'] = str(sum(1 for m in queue.messages.values() if m.visible_at <= now))
+            attributes['ApproximateNumberOfMessagesNotVisible'] = str(sum(
+                1 for m in queue.messages.values() if m.visible_at > now and m.receive_count
+            ))
+            attributes['ApproximateNumberOfMessagesDelayed'] = str(sum(
+                1 for m in queue.messages.values() if m.visible_at > now and not m.receive_count
+            ))
+            attributes['QueueArn'] = 'arn:aws:sqs:{}:{}:{}'.format(self._region_name, self._account_id, queue.name)
+            if not self._wanted(AttributeNames, 'All'):
+                attributes = dict((name, value) for name, value in attributes.items() if name in (AttributeNames or []))
+            return {'Attributes': attributes}
+
+    def set_queue_attributes(self, QueueUrl, Attributes):
+        self._call('set_queue_attributes')
+        with self._lock:
+            self._queue(QueueUrl, 'SetQueueAttributes').attributes.update(Attributes)
+            return {}
+
+    # ================
+    # messages
+    # ================
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call('send_message')
+        with self._lock:
+            return self._send(self._queue(QueueUrl, 'SendMessage'), 'SendMessage', MessageBody, **kwargs)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call('send_message_batch')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'SendMessageBatch')
+            self._check_batch(Entries, 'SendMessageBatch')
+            if sum(entry_size(entry) for entry in Entries) > MAX_BATCH_BYTES:
+                raise _error('AWS.SimpleQueueService.BatchRequestTooLong', 'Batch requests cannot be longer than 262144 bytes.', 'SendMessageBatch')
+            response = {'Successful': [], 'Failed': []}
+            for entry in Entries:
+                entry = dict(entry)
+                entry_id = entry.pop('Id')
+                try:
+                    result = self._send(queue, 'SendMessageBatch', **entry)
+                except ClientError as ex:
+                    response['Failed'].append({
+                        'Id': entry_id,
+                        'SenderFault': True,
+                        'Code': ex.response['Error']['Code'],
+                        'Message': ex.response['Error']['Message']
+                    })
+                    continue
+                result['Id'] = entry_id
+                response['Successful'].append(result)
+            return response
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None,
+                        AttributeNames=None, MessageAttributeNames=None, **kwargs):
+        self._call('receive_message')
+        if not 1 <= MaxNumberOfMessages <= MAX_BATCH_ENTRIES:
+            raise _error('InvalidParameterValue', 'Value {} for parameter MaxNumberOfMessages is invalid.'.format(MaxNumberOfMessages), 'ReceiveMessage')
+        deadline = time.time() + min(WaitTimeSeconds or 0, MAX_WAIT_TIME)
+        with self._lock:
+            queue = self._queue(QueueUrl, 'ReceiveMessage')
+            while True:
+                now = self._clock()
+                received = self._receivable(queue, MaxNumberOfMessages, now)
+                remaining = deadline - time.time()
+                if received or remaining <= 0:
+                    break
+                # visibility timeouts expire without notification, so wake up regularly
+                self._lock.wait(min(remaining, 0.05))
+            timeout = queue.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+            messages = []
+            for message in received:
+                message.receive_count += 1
+                if message.first_received is None:
+                    message.first_received = now
+                message.visible_at = now + timeout
+                message.receipt_handle = uuid.uuid4().hex
+                self._handles[message.receipt_handle] = message.message_id
+                messages.append(self._format(queue, message, AttributeNames, MessageAttributeNames))
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self._call('delete_message')
+        with self._lock:
+            self._delete(self._queue(QueueUrl, 'DeleteMessage'), ReceiptHandle, 'DeleteMessage')
+            return {}
+
+    def _delete(self, queue, receipt_handle, operation):
+        if receipt_handle not in self._handles:
+            raise _error('ReceiptHandleIsInvalid', 'The input receipt handle is invalid.', operation)
+        # like SQS, deleting is idempotent, and deleting with an outdated handle still deletes the message
+        message = queue.messages.pop(self._handles[receipt_handle], None)
+        if message is not None:
+            # the next message of a FIFO group may now be delivered
+            self._lock.notify_all()
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call('delete_message_batch')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'DeleteMessageBatch')
+            self._check_batch(Entries, 'DeleteMessageBatch')
+            response = {'Successful': [], 'Failed': []}
+            for entry in Entries:
+                try:
+                    self._delete(queue, entry['ReceiptHandle'], 'DeleteMessageBatch')
+                except ClientError as ex:
+                    response['Failed'].append(
+                        {'Id': entry['Id'], 'SenderFault': True, 'Code': ex.response['Error']['Code'], 'Message': ex.response['Error']['Message']}
+                    )
+                else:
+                    response['Successful'].append({'Id': entry['Id']})
+            return response
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self._call('change_message_visibility')
+        with self._lock:
+            self._change_visibility(self._queue(QueueUrl, 'ChangeMessageVisibility'), ReceiptHandle, VisibilityTimeout,
+                                    'ChangeMessageVisibility')
+            return {}
+
+    def _change_visibility(self, queue, receipt_handle, visibility_timeout, operation):
+        message = self._in_flight(queue, receipt_handle, operation)
+        if message is None:
+            raise _error('AWS.SimpleQueueService.MessageNotInflight', 'Message does not exist or is not available for '
+                                                                      'visibility timeout change.', operation)
+        message.visible_at = self._clock() + visibility_timeout
+        if visibility_timeout == 0:
+            self._lock.notify_all()
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._call('change_message_visibility_batch')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'ChangeMessageVisibilityBatch')
+            self._check_batch(Entries, 'ChangeMessageVisibilityBatch')
+            response = {'Successful': [], 'Failed': []}
+            for entry in Entries:
+                try:
+                    self._change_visibility(queue, entry['ReceiptHandle'], entry['VisibilityTimeout'],
+                                            'ChangeMessageVisibilityBatch')
+                except ClientError as ex:
+                    response['Failed'].append(
+                        {'Id': entry['Id'], 'SenderFault': True, 'Code': ex.response['Error']['Code'], 'Message': ex.response['Error']['Message']}
+                    )
+                else:
+                    response['Successful'].append({'Id': entry['Id']})
+            return response
+
+    # ================
+    # inspection, for assertions in tests
+    # ================
+
+    def messages(self, queue_name):
+        """
+        :return: (list) bodies of the messages in a queue which were not deleted yet, in send order
+        """
+        with self._lock:
+            queue = self._queues.get(queue_name)
+            return [m.body for m in queue.messages.values()] if queue is not None else []
@@ -0,0 +1,77 @@
+"""
+thread pool helpers for concurrent message handling
+"""
+
+# ================
+# start imports
+# ================
+
+import threading
+
+# ================
+# start class
+# ================
+
+
+class InFlightLimiter(object):
+    """
+    Counts messages which have been received but not yet finished, blocking the receive loop
+    once `limit` of them are in flight
+    """
+
+    def __init__(self, limit):
+        self._limit = max(1, limit)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def wait_for_capacity(self, timeout=None):
+        """
+        block until at least one slot is free
+        :param timeout: (float) max number of seconds to wait, or None to wait indefinitely
+        :return: (int) number of free slots, 0 if the timeout expired
+        """
+        with self._condition:
+            if self._in_flight >= self._limit:
+                self._condition.wait_for(lambda: self._in_flight < self._limit, timeout)
+            return max(0, self._limit - self._in_flight)
+
+    def acquire(self, block=False, timeout=None):
+        """
+        :param block: (boolean) wait for a free slot first.  Otherwise the slot is taken even beyond the limit
+        :param timeout: (float) with `block`, max number of seconds to wait, or None to wait indefinitely
+        :return: (boolean) True if a slot was taken, False if the timeout expired
+        """
+        with self._condition:
+            if block and not self._condition.wait_for(lambda: self._in_flight < self._limit, timeout):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def resize(self, limit):
+        """
+        change the limit.  When shrinking, slots already taken beyond the new limit are kept until released
+        """
+        with self._condition:
+            self._limit = max(1, limit)
+            self._condition.notify_all()
+
+    def wait_until_idle(self, timeout=None):
+        """
+        block until nothing is in flight
+        :return: (boolean) True if idle, False if the timeout expired
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._in_flight == 0, timeout)
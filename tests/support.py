@@ -0,0 +1,72 @@
+"""
+helpers shared by the tests: queues on a FakeSqsClient, and listeners run on a background thread
+"""
+
+# ================
+# start imports
+# ================
+
+import json
+import threading
+import time
+
+from sqs_listener.testing import FakeSqsClient
+
+# ================
+# start class
+# ================
+
+
+def make_client(queue='q', bodies=(), attributes=None, **kwargs):
+    """
+    :param bodies: (list) messages sent to the queue, json encoded unless they're str
+    :return: (tuple) the FakeSqsClient and the queue url
+    """
+    client = FakeSqsClient()
+    attributes = dict({'VisibilityTimeout': '600'}, **(attributes or {}))
+    client.create_queue(QueueName=queue, Attributes=attributes)
+    queue_url = client.get_queue_url(QueueName=queue)['QueueUrl']
+    for body in bodies:
+        client.send_message(
+            QueueUrl=queue_url,
+            MessageBody=body if isinstance(body, str) else json.dumps(body),
+            **kwargs
+        )
+    return client, queue_url
+
+
+def visible(client, queue_url):
+    """
+    :return: (int) number of messages which can be received right away.  Receives them, so call it last
+    """
+    count = 0
+    while True:
+        messages = client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            return count
+        count += len(messages)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def listen_until(listener, condition, timeout=10):
+    """
+    run listener.listen() on a background thread until `condition()` holds, then stop it
+    :return: (boolean) whether the condition held
+    """
+    thread = threading.Thread(target=listener.listen)
+    thread.daemon = True
+    thread.start()
+    held = wait_for(condition, timeout)
+    listener.stop()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise AssertionError('listen() did not return after stop()')
+    return held
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import unittest
+
+from sqs_listener.async_listener import AsyncSqsListener
+from tests.support import make_client
+
+
+class RecordingListener(AsyncSqsListener):
+
+    def __init__(self, queue, failing=(), **kwargs):
+        self.handled = []
+        self.failing = list(failing)
+        AsyncSqsListener.__init__(self, queue, wait_time=0, interval=0.01, max_number_of_messages=10, **kwargs)
+
+    async def handle_message(self, body, attributes, messages_attributes):
+        self.handled.append(body)
+        if body in self.failing:
+            raise ValueError('failed on {}'.format(body))
+
+
+def listen_until(listener, condition, timeout=10):
+    async def main():
+        task = asyncio.ensure_future(listener.listen())
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+        listener.stop()
+        await asyncio.wait_for(task, timeout)
+        return condition()
+
+    return asyncio.run(main())
+
+
+class AsyncListenerTest(unittest.TestCase):
+
+    def test_handled_messages_are_deleted(self):
+        client, _ = make_client(bodies=range(5))
+        listener = RecordingListener('q', client=client, handler_concurrency=3)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(sorted(listener.handled), list(range(5)))
+
+    def test_failed_message_is_pushed_to_the_error_queue_and_kept(self):
+        client, _ = make_client(bodies=[1, 2])
+        listener = RecordingListener('q', client=client, failing=[2], error_queue='errors')
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 1))
+        self.assertEqual(client.messages('q'), ['2'])
+
+    def test_undecodable_message_is_moved_to_the_error_queue(self):
+        client, _ = make_client(bodies=['not json{', 1])
+        listener = RecordingListener('q', client=client, error_queue='errors')
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(listener.handled, [1])
+        self.assertEqual(json.loads(client.messages('errors')[0])['body'], 'not json{')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import unittest
+
+from sqs_launcher import SqsLauncher
+from sqs_listener.batching import DeleteBatcher, MAX_BATCH_BYTES, pack_entries, send_message_batch
+from tests.support import make_client
+
+
+def flaky(call, failures):
+    """
+    :return: a client method raising on its first `failures` calls
+    """
+    calls = [0]
+
+    def method(**kwargs):
+        calls[0] += 1
+        if calls[0] <= failures:
+            raise IOError('connection reset')
+        return call(**kwargs)
+
+    return method
+
+
+class DeleteBatcherTest(unittest.TestCase):
+
+    def receipt_handles(self, client, url):
+        return [m['ReceiptHandle'] for m in client.receive_message(QueueUrl=url, MaxNumberOfMessages=10)['Messages']]
+
+    def test_flushes_once_full(self):
+        client, url = make_client(bodies=range(3))
+        batcher = DeleteBatcher(client, url, max_size=3, max_wait=60)
+        handles = self.receipt_handles(client, url)
+        batcher.add(handles[0])
+        batcher.add(handles[1])
+        self.assertFalse(batcher.is_due())
+        self.assertEqual(len(client.messages('q')), 3)
+        batcher.add(handles[2])
+        self.assertEqual(client.messages('q'), [])
+        self.assertEqual(client.calls.count('delete_message_batch'), 1)
+
+    def test_retries_a_request_error(self):
+        client, url = make_client(bodies=range(2))
+        client.delete_message_batch = flaky(client.delete_message_batch, 1)
+        batcher = DeleteBatcher(client, url)
+        self.assertEqual(batcher.delete(self.receipt_handles(client, url)), [])
+        self.assertEqual(client.messages('q'), [])
+
+    def test_returns_the_handles_it_gave_up_on(self):
+        client, url = make_client(bodies=range(2))
+        client.delete_message_batch = flaky(client.delete_message_batch, 10)
+        batcher = DeleteBatcher(client, url, max_retries=1)
+        handles = self.receipt_handles(client, url)
+        self.assertEqual(sorted(batcher.delete(handles)), sorted(handles))
+        self.assertEqual(len(client.messages('q')), 2)
+
+
+class SendMessageBatchTest(unittest.TestCase):
+
+    def test_pack_entries_respects_count_and_size(self):
+        small = [{'Id': str(i), 'MessageBody': 'x'} for i in range(25)]
+        self.assertEqual([len(b) for b in pack_entries(small)], [10, 10, 5])
+        large = [{'Id': str(i), 'MessageBody': 'x' * (MAX_BATCH_BYTES // 3)} for i in range(5)]
+        self.assertEqual([len(b) for b in pack_entries(large)], [3, 2])
+
+    def test_request_error_is_retried(self):
+        client, url = make_client()
+        client.send_message_batch = flaky(client.send_message_batch, 1)
+        results = send_message_batch(client, url, [{'Id': '0', 'MessageBody': 'x'}])
+        self.assertIn('MessageId', results['0'])
+        self.assertEqual(client.messages('q'), ['x'])
+
+    def test_request_error_is_reported_as_failed(self):
+        client, url = make_client()
+        client.send_message_batch = flaky(client.send_message_batch, 10)
+        results = send_message_batch(client, url, [{'Id': '0', 'MessageBody': 'x'}], max_retries=1)
+        self.assertEqual(results['0']['Code'], 'OSError')
+        self.assertFalse(results['0']['SenderFault'])
+
+    def test_launch_messages_keeps_the_results_of_the_batches_sent(self):
+        client, url = make_client()
+        launcher = SqsLauncher('q', client=client)
+        sent = client.send_message_batch
+
+        def failing_after_two(**kwargs):
+            if client.calls.count('send_message_batch') >= 2:
+                raise IOError('connection reset')
+            return sent(**kwargs)
+
+        client.send_message_batch = failing_after_two
+        results = launcher.launch_messages([{'n': i} for i in range(25)], max_retries=1)
+        self.assertEqual(len(results), 25)
+        self.assertEqual(sum(1 for r in results if 'MessageId' in r), 20)
+        self.assertEqual([r['Code'] for r in results[20:]], ['OSError'] * 5)
+        self.assertEqual(sorted(json.loads(b)['n'] for b in client.messages('q')), list(range(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from sqs_listener.governor import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, TokenBucket
+from sqs_listener.retry import RetryPolicy
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_takes_at_most_the_tokens_left(self):
+        bucket = TokenBucket(rate=0.001, capacity=5)
+        self.assertEqual(bucket.take(3), 3)
+        self.assertEqual(bucket.take(3), 2)
+        self.assertEqual(bucket.take(3), 0)
+        self.assertGreater(bucket.retry_after(), 0)
+
+    def test_give_back(self):
+        bucket = TokenBucket(rate=0.001, capacity=5)
+        bucket.take(5)
+        bucket.give_back(2)
+        self.assertEqual(bucket.take(5), 2)
+
+    def test_rate_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_on_errors(self):
+        events = []
+        breaker = CircuitBreaker(window=4, min_calls=4, reset_timeout=60, on_state_change=events.append)
+        for success in (True, False, True):
+            breaker.record(0.1, success)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(0.1, False)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.take(10), 0)
+        self.assertEqual([(e.previous, e.state) for e in events], [(CLOSED, OPEN)])
+
+    def test_slow_calls_count_as_failed(self):
+        breaker = CircuitBreaker(window=2, min_calls=2, latency_threshold=1)
+        breaker.record(2)
+        breaker.record(2)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open_probes_then_closes(self):
+        breaker = CircuitBreaker(window=2, min_calls=2, reset_timeout=0, probes=1, probe_timeout=60)
+        breaker.record(0, False, count=2)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(breaker.take(10), 1)
+        self.assertEqual(breaker.take(10), 0)
+        breaker.record(0)
+        self.assertEqual(breaker.take(10), 2)
+        breaker.record(0, count=2)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker(window=2, min_calls=2, reset_timeout=0.2)
+        breaker.record(0, False, count=2)
+        breaker._opened_at -= 1
+        self.assertEqual(breaker.take(10), 1)
+        breaker.record(0, False)
+        self.assertEqual(breaker.state, OPEN)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_delay_doubles_up_to_max_delay(self):
+        policy = RetryPolicy(base_delay=10, max_delay=60, jitter=False)
+        self.assertEqual([policy.delay(a) for a in range(1, 5)], [10, 20, 40, 60])
+
+    def test_jitter_never_halves_the_delay_more(self):
+        policy = RetryPolicy(base_delay=10)
+        for _ in range(100):
+            self.assertTrue(5 <= policy.delay(1) <= 10)
+
+    def test_exhausted(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertFalse(policy.exhausted(2))
+        self.assertTrue(policy.exhausted(3))
+        with self.assertRaises(ValueError):
+            RetryPolicy(max_attempts=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
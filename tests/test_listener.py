@@ -0,0 +1,217 @@
+import json
+import threading
+import time
+import unittest
+
+from sqs_listener import SqsListener
+from sqs_listener.retry import RetryPolicy
+from tests.support import listen_until, make_client, wait_for
+
+OPTIONS = {'wait_time': 0, 'interval': 0.01, 'max_number_of_messages': 10}
+
+
+class RecordingListener(SqsListener):
+    """
+    records the bodies it handles, and raises for those listed in `failing`
+    """
+
+    def __init__(self, queue, failing=(), delay=0, **kwargs):
+        self.handled = []
+        self.failing = list(failing)
+        self.delay = delay
+        self._lock = threading.Lock()
+        SqsListener.__init__(self, queue, **dict(OPTIONS, **kwargs))
+
+    def handle_message(self, body, attributes, messages_attributes):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.handled.append(body)
+        if body in self.failing:
+            raise ValueError('failed on {}'.format(body))
+
+
+class DeleteTest(unittest.TestCase):
+
+    def test_handled_messages_are_deleted(self):
+        client, _ = make_client(bodies=range(5))
+        listener = RecordingListener('q', client=client)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(sorted(listener.handled), list(range(5)))
+        self.assertIn('delete_message', client.calls)
+
+    def test_batch_delete(self):
+        client, _ = make_client(bodies=range(15))
+        listener = RecordingListener('q', client=client, batch_delete=True)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(sorted(listener.handled), list(range(15)))
+        self.assertNotIn('delete_message', client.calls)
+        self.assertGreaterEqual(client.calls.count('delete_message_batch'), 2)
+
+    def test_batch_delete_flushes_pending_deletes_while_idle(self):
+        client, _ = make_client(bodies=range(3))
+        listener = RecordingListener('q', client=client, batch_delete=True, delete_batch_wait=60)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q'), timeout=5))
+
+    def test_force_delete_deletes_failed_messages(self):
+        client, _ = make_client(bodies=[1, 2])
+        listener = RecordingListener('q', client=client, failing=[2], force_delete=True, error_queue='errors')
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 1))
+        self.assertEqual(client.messages('q'), [])
+        self.assertEqual(json.loads(json.loads(client.messages('errors')[0])['body']), 2)
+
+    def test_force_delete_with_batch_delete(self):
+        client, _ = make_client(bodies=range(12))
+        listener = RecordingListener('q', client=client, force_delete=True, batch_delete=True)
+        self.assertTrue(listen_until(listener, lambda: len(listener.handled) == 12))
+        self.assertEqual(client.messages('q'), [])
+        self.assertNotIn('delete_message', client.calls)
+
+    def test_failed_message_is_pushed_to_the_error_queue_and_kept(self):
+        client, url = make_client(bodies=[1, 2])
+        listener = RecordingListener('q', client=client, failing=[2], error_queue='errors')
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 1))
+        record = json.loads(client.messages('errors')[0])
+        self.assertIn('ValueError', record['exception_type'])
+        self.assertEqual(client.messages('q'), ['2'])
+
+
+class WorkersTest(unittest.TestCase):
+
+    def test_workers_handle_messages_concurrently(self):
+        client, _ = make_client(bodies=range(8))
+        running = []
+        peak = [0]
+        lock = threading.Lock()
+
+        class Listener(RecordingListener):
+            def handle_message(self, body, attributes, messages_attributes):
+                with lock:
+                    running.append(body)
+                    peak[0] = max(peak[0], len(running))
+                time.sleep(0.1)
+                with lock:
+                    running.remove(body)
+                RecordingListener.handle_message(self, body, attributes, messages_attributes)
+
+        listener = Listener('q', client=client, workers=4)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(sorted(listener.handled), list(range(8)))
+        self.assertGreater(peak[0], 1)
+        self.assertLessEqual(peak[0], 4)
+
+    def test_fifo_groups_are_handled_in_order(self):
+        client, url = make_client(queue='q.fifo', attributes={'FifoQueue': 'true', 'ContentBasedDeduplication': 'true'})
+        for i in range(20):
+            client.send_message(QueueUrl=url, MessageBody=json.dumps([i % 2, i]), MessageGroupId=str(i % 2))
+        listener = RecordingListener('q.fifo', client=client, workers=4, delay=0.01)
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q.fifo')))
+        for group in (0, 1):
+            handled = [i for g, i in listener.handled if g == group]
+            self.assertEqual(handled, list(range(group, 20, 2)))
+
+    def test_fifo_failure_holds_back_the_rest_of_the_group(self):
+        client, url = make_client(queue='q.fifo', attributes={'FifoQueue': 'true', 'ContentBasedDeduplication': 'true'})
+        for i in range(3):
+            client.send_message(QueueUrl=url, MessageBody=json.dumps(i), MessageGroupId='g')
+        listener = RecordingListener('q.fifo', client=client, failing=[1])
+        listen_until(listener, lambda: len(listener.handled) >= 2, timeout=2)
+        self.assertEqual(listener.handled[:2], [0, 1])
+        self.assertNotIn(2, listener.handled)
+        self.assertEqual(client.messages('q.fifo'), ['1', '2'])
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_retry_then_move_to_the_error_queue(self):
+        client, _ = make_client(bodies=[1])
+        listener = RecordingListener(
+            'q', client=client, failing=[1], error_queue='errors',
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=0, jitter=False)
+        )
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 1))
+        self.assertTrue(wait_for(lambda: not client.messages('q')))
+        self.assertEqual(listener.handled, [1, 1, 1])
+        record = json.loads(client.messages('errors')[0])
+        self.assertEqual(record['attributes']['ApproximateReceiveCount'], '3')
+
+    def test_retry_until_success(self):
+        client, _ = make_client(bodies=[1])
+
+        class Listener(RecordingListener):
+            def handle_message(self, body, attributes, messages_attributes):
+                RecordingListener.handle_message(self, body, attributes, messages_attributes)
+                if len(self.handled) < 2:
+                    raise ValueError('transient')
+
+        listener = Listener('q', client=client, error_queue='errors',
+                            retry_policy=RetryPolicy(max_attempts=3, base_delay=0, jitter=False))
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(listener.handled, [1, 1])
+        self.assertEqual(client.messages('errors'), [])
+
+
+class UndecodableTest(unittest.TestCase):
+
+    def test_undecodable_message_is_moved_to_the_error_queue(self):
+        client, _ = make_client(bodies=['not json{', 1])
+        listener = RecordingListener('q', client=client, error_queue='errors')
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(listener.handled, [1])
+        self.assertEqual(json.loads(client.messages('errors')[0])['body'], 'not json{')
+
+    def test_undecodable_message_is_kept_while_the_error_queue_is_unavailable(self):
+        client, url = make_client(bodies=['not json{'])
+        client.create_queue(QueueName='errors')
+
+        def unavailable(**kwargs):
+            raise IOError('unavailable')
+
+        client.send_message_batch = unavailable
+        listener = RecordingListener('q', client=client, error_queue='errors')
+        listen_until(listener, lambda: False, timeout=1)
+        self.assertEqual(client.messages('q'), ['not json{'])
+        self.assertEqual(client.messages('errors'), [])
+
+    def test_undecodable_message_without_error_queue_is_kept(self):
+        client, _ = make_client(bodies=['not json{'])
+        listener = RecordingListener('q', client=client)
+        listen_until(listener, lambda: False, timeout=0.5)
+        self.assertEqual(client.messages('q'), ['not json{'])
+
+    def test_oversized_error_record_keeps_the_original_body(self):
+        body = json.dumps({'quotes': '"' * 100000})
+        client, _ = make_client(bodies=[body])
+        listener = RecordingListener('q', client=client, error_queue='errors', deserializer=lambda b: 'x',
+                                     failing=['x'], retry_policy=RetryPolicy(max_attempts=1))
+        self.assertTrue(listen_until(listener, lambda: not client.messages('q')))
+        self.assertEqual(client.messages('errors'), [body])
+
+
+class BatchHandlerTest(unittest.TestCase):
+
+    def test_only_successful_messages_are_deleted(self):
+        client, _ = make_client(bodies=range(4))
+
+        class Listener(SqsListener):
+            def handle_messages(self, messages):
+                return [m.body % 2 == 0 for m in messages]
+
+        listener = Listener('q', client=client, error_queue='errors', **OPTIONS)
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 2))
+        self.assertEqual(sorted(client.messages('q')), ['1', '3'])
+
+    def test_invalid_result_fails_the_whole_batch(self):
+        client, _ = make_client(bodies=range(3))
+
+        class Listener(SqsListener):
+            def handle_messages(self, messages):
+                return [True]
+
+        listener = Listener('q', client=client, error_queue='errors', **OPTIONS)
+        self.assertTrue(listen_until(listener, lambda: len(client.messages('errors')) == 3))
+        self.assertEqual(len(client.messages('q')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
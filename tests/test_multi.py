@@ -0,0 +1,59 @@
+import json
+import threading
+import unittest
+
+from sqs_listener.multi import MultiQueueListener, Subscription
+from sqs_listener.polling import AdaptivePolling
+from tests.support import listen_until, make_client
+
+
+class MultiQueueListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client, _ = make_client(queue='a', bodies=range(5))
+        url = self.client.create_queue(QueueName='b', Attributes={'VisibilityTimeout': '600'})['QueueUrl']
+        for i in range(5, 10):
+            self.client.send_message(QueueUrl=url, MessageBody=json.dumps(i))
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def handle(self, body, attributes, messages_attributes):
+        with self.lock:
+            self.handled.append(body)
+
+    def drained(self):
+        return not self.client.messages('a') and not self.client.messages('b')
+
+    def test_messages_of_every_queue_are_handled(self):
+        listener = MultiQueueListener([Subscription('a', self.handle), Subscription('b', self.handle, weight=2)],
+                                      client=self.client, wait_time=0, workers=2, handle_signals=False)
+        self.assertTrue(listen_until(listener, self.drained))
+        self.assertEqual(sorted(self.handled), list(range(10)))
+
+    def test_batched_deletes_are_flushed_while_idle(self):
+        listener = MultiQueueListener([Subscription('a', self.handle), Subscription('b', self.handle)],
+                                      client=self.client, wait_time=0, handle_signals=False, batch_delete=True,
+                                      delete_batch_wait=60)
+        self.assertTrue(listen_until(listener, self.drained, timeout=5))
+        self.assertNotIn('delete_message', self.client.calls)
+
+    def test_every_queue_gets_its_own_polling_strategy(self):
+        polling = AdaptivePolling(idle_wait_time=0)
+        listener = MultiQueueListener([Subscription('a', self.handle), Subscription('b', self.handle)],
+                                      client=self.client, polling=polling, handle_signals=False)
+        strategies = [listener._listeners[name]._polling for name in ('a', 'b')]
+        self.assertIsNot(strategies[0], strategies[1])
+        self.assertNotIn(polling, strategies)
+
+    def test_client_options_cannot_override_a_passed_client(self):
+        with self.assertRaises(ValueError):
+            MultiQueueListener([Subscription('a', self.handle), Subscription('b', self.handle, region_name='eu-west-1')],
+                               client=self.client)
+
+    def test_queue_subscribed_twice(self):
+        with self.assertRaises(ValueError):
+            MultiQueueListener([Subscription('a', self.handle), Subscription('a', self.handle)], client=self.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
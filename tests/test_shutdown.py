@@ -0,0 +1,96 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+import unittest
+
+from sqs_listener import SqsListener
+from sqs_listener.async_listener import AsyncSqsListener
+from tests.support import listen_until, make_client, visible, wait_for
+
+OPTIONS = {'wait_time': 0, 'interval': 0.01, 'max_number_of_messages': 10}
+
+
+class SlowListener(SqsListener):
+
+    def __init__(self, queue, delay, **kwargs):
+        self.delay = delay
+        self.started = threading.Event()
+        SqsListener.__init__(self, queue, **dict(OPTIONS, **kwargs))
+
+    def handle_message(self, body, attributes, messages_attributes):
+        self.started.set()
+        time.sleep(self.delay)
+
+
+class StopTest(unittest.TestCase):
+
+    def test_stop_waits_for_the_message_being_handled(self):
+        client, url = make_client(bodies=[1])
+        listener = SlowListener('q', 0.3, client=client)
+        listen_until(listener, listener.started.is_set)
+        self.assertEqual(client.messages('q'), [])
+
+    def test_stop_releases_prefetched_messages(self):
+        client, url = make_client(bodies=range(5))
+        listener = SlowListener('q', 0.2, client=client, prefetch=10, max_number_of_messages=1)
+        listen_until(listener, listener.started.is_set)
+        left = len(client.messages('q'))
+        self.assertGreater(left, 0)
+        self.assertEqual(visible(client, url), left)
+
+    @unittest.skipIf(threading.current_thread() is not threading.main_thread(), 'signals need the main thread')
+    def test_deadline_releases_the_message_being_handled(self):
+        client, url = make_client(bodies=[1, 2])
+        listener = SlowListener('q', 30, client=client, shutdown_timeout=0.5)
+        timer = threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        started = time.time()
+        listener.listen()
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(visible(client, url), 2)
+
+    def test_worker_deadline_releases_the_messages_being_handled(self):
+        client, url = make_client(bodies=[1, 2])
+        listener = SlowListener('q', 2, client=client, workers=2, shutdown_timeout=0.3)
+        started = time.time()
+        listen_until(listener, listener.started.is_set)
+        self.assertLess(time.time() - started, 1.5)
+        self.assertEqual(visible(client, url), 2)
+
+
+class AsyncStopTest(unittest.TestCase):
+
+    def test_stop_while_every_handler_slot_is_busy(self):
+        client, url = make_client(bodies=range(3))
+        receives = []
+
+        class Listener(AsyncSqsListener):
+            async def handle_message(self, body, attributes, messages_attributes):
+                await asyncio.sleep(8)
+
+        listener = Listener('q', client=client, wait_time=0, interval=0, shutdown_timeout=0.5, handler_concurrency=1,
+                            max_number_of_messages=1)
+        receive = client.receive_message
+
+        def counting(**kwargs):
+            receives.append(time.time())
+            return receive(**kwargs)
+
+        client.receive_message = counting
+
+        async def main():
+            asyncio.get_running_loop().call_later(0.3, listener.stop)
+            await listener.listen()
+
+        started = time.time()
+        asyncio.run(main())
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual([r for r in receives if r > started + 0.3], [])
+        client.receive_message = receive
+        self.assertEqual(visible(client, url), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()